@@ -1,7 +1,7 @@
 from upload_flashcards import upload_flashcards
-from langchain_config.config import llm
+from langchain_config.config import get_llm
 from backend.review_mistakes import review_mistakes, render_mistake_card
-from pyvis.network import Network
+from backend.schema import start_background_warmup
 
 
 # main.py
@@ -23,6 +23,8 @@ if "total_cards" not in st.session_state:
 st.session_state['current_batch'] = 1
 
 def main():
+    # Connects to the graph and creates its constraints and indexes off the request path, once per process
+    start_background_warmup()
     st.title("Intelligent Tutoring System")
 
     st.header("Step 1: Upload Flashcards")
@@ -50,11 +52,11 @@ def main():
 
         # Pathway selection logic
         if pathway == "Start from Random Flashcard":
-            pathway_random.start_from_random(st, llm)
+            pathway_random.start_from_random(st, get_llm())
         elif pathway == "Start Based on Student Interest":
-            pathway_interest.start_from_student_interest(st, llm)
+            pathway_interest.start_from_student_interest(st, get_llm())
         elif pathway == "Guided Path Based on Fundamental Concept":
-            pathway_metanode.start_from_metanode(st, llm)
+            pathway_metanode.start_from_metanode(st, get_llm())
 
         # Mistake Review Sidebar
         st.sidebar.header("Mistake Review")
@@ -1,9 +1,12 @@
 from backend.functionality_util import *
 import logging
+from functools import partial
 import streamlit as st
 from backend.ask_question import answer_student_question
-from langchain_config.config import embedding_model
-from langchain_config.config import llm
+from backend.batch_prefetch import get_batch_prefetcher, should_prefetch
+from backend.vector_index import search_flashcards
+from backend.graph_snapshot import get_metanode_names
+from backend.query_cache import SHARED, query_cache
 
 """
 This section get flashcards from students interests. Graph will automatically
@@ -12,10 +15,12 @@ automatically
 """
 
 
-@st.cache_resource
 def get_student_interest(student_input, visited_nodes, batch_size=10):
     """
-    Caches the resource to retrieve student interest flashcards based on input and visited nodes.
+    Retrieves the flashcards matching a student's interest, cached per input, visited nodes and graph version.
+
+    The flashcards are ranked with the in-process vector index, which is rebuilt from the graph
+    whenever the graph version changes, so the query does not need a database round trip.
 
     Args:
         student_input (str): The current input from the student.
@@ -25,39 +30,31 @@ def get_student_interest(student_input, visited_nodes, batch_size=10):
     Returns:
         list: A list of flashcards (each represented by a dictionary) containing 'question', 'answer', and 'id' keys.
     """
-    student_input_embedded = embedding_model.embed_query(student_input)
-    visited_nodes_str = "'" + "', '".join(map(str, visited_nodes)) + "'"
-    # Use Neo4j Graph Data Science API to find the K-nearest neighbors
-    cosine_query = f"""
-         MATCH (q1:Flashcard)
-         WHERE NOT q1.id IN [{visited_nodes_str}] 
-         WITH q1, gds.similarity.cosine(q1.embedding, {student_input_embedded}) AS similarity
-         RETURN q1.question AS question, q1.answer AS answer, q1.id as id
-         ORDER BY similarity DESC
-         LIMIT {batch_size}
-         """
-    flashcards = run_query(cosine_query)
-    logging.warning(f"the flashcards queried are {flashcards}")
-    if len(flashcards) == 0:
-        st.write("You've learned all the flashcards")
-        return []
-    return flashcards
+    def load():
+        # The ingest stack is only loaded once a student asks for an interest
+        from backend.knowledge_graph import get_node_embeddings
+
+        student_input_embedded = get_node_embeddings(student_input)
+        # Use the in-process vector index over the flashcard embeddings to find the K-nearest neighbors
+        flashcards = search_flashcards(student_input_embedded, k=batch_size, exclude=visited_nodes)
+        logging.warning(f"the flashcards queried are {flashcards}")
+        return flashcards
+
+    return query_cache.get_or_load(SHARED, 'student_interest', {
+        'student_input': student_input, 'visited_nodes': frozenset(visited_nodes), 'batch_size': batch_size,
+    }, load)
 
 def get_all_metanodes():
     """
-    Fetches all distinct metanode names from the database, stripping the "metanode" suffix.
+    Fetches all distinct metanode names from the shared graph snapshot, stripping the "metanode" suffix.
 
     Returns:
         list: A list of metanode names with the "metanode" suffix removed.
     """
-    query = """
-        MATCH (m:Metanode)
-        RETURN DISTINCT m.name AS metanode_name
-    """
-    metanodes = run_query(query)
+    metanodes = get_metanode_names()
     # removing the " metanode" suffix
     if len(metanodes) > 0:
-        metanode_name = [record.value().rsplit(' ', 2)[0] for record in metanodes]
+        metanode_name = [name.rsplit(' ', 2)[0] for name in metanodes]
         return metanode_name
     else:
         return []
@@ -95,36 +92,52 @@ def start_from_student_interest(st, llm, batch_size=10, lookback_size=10):
     logging.warning(f"current index is {index}")
 
     student_question = st.text_input("Please enter your questions regarding this topic")
-    available_metanodes = get_all_metanodes()
-    selected_metanode = []
-    if available_metanodes:
-        selected_metanode.extend(st.multiselect("Select a pathway to explore", available_metanodes))
-    # Check if the input box has been filled
-    logging.warning(f"student_question {student_question}, selected_metanode {selected_metanode} ")
     if student_question != '':
         st.session_state['input_provided'] = True  # Set the flag to True when input is provided
+    # The selection of the multiselect is known before it is drawn, from its widget state
+    selected_metanode = list(st.session_state.get('interest_metanodes', []))
+    question_query = student_question + ". I am interested in the following topics: " + ', '.join(selected_metanode)
+    questions_explored = st.session_state["explored"]
+    prefetcher = get_batch_prefetcher(st.session_state)
+    rerun_query = st.session_state.get('input_provided', False) and st.session_state.get('rerun_query', True)
+    if rerun_query:
+        visited_nodes = frozenset(questions_explored[max(0, len(questions_explored) - lookback_size):])
+        # The metanodes and the flashcards of the interest are looked up at the same time, the
+        # flashcards being taken from the prefetch buffer when they were fetched during the last batch
+        available_metanodes, (flashcards, hints) = gather_queries(
+            get_all_metanodes,
+            partial(prefetcher.take, ('interest', question_query, visited_nodes, batch_size),
+                    partial(get_student_interest, question_query, visited_nodes=visited_nodes, batch_size=batch_size)))
     else:
+        available_metanodes = get_all_metanodes()
+    if available_metanodes:
+        st.multiselect("Select a pathway to explore", available_metanodes, key='interest_metanodes')
+    # Check if the input box has been filled
+    logging.warning(f"student_question {student_question}, selected_metanode {selected_metanode} ")
+    if student_question == '':
         st.warning("Please enter your question to proceed.")
 
     # Proceed only if input is provided
     if st.session_state.get('input_provided', False):
-        question_query = student_question + ". I am interested in the following topics: " + ', '.join(selected_metanode)
-        questions_explored = st.session_state["explored"]
-
-        if st.session_state.get('rerun_query', True):
-            flashcards = get_student_interest(question_query,
-                                 visited_nodes=set(questions_explored[max(0, len(questions_explored) - lookback_size):]),
-                                 batch_size=batch_size)
+        if rerun_query:
             st.session_state['rerun_query'] = False
             st.session_state['learning_path'] = flashcards
+            st.session_state['batch_hints'] = hints
         else:
             flashcards = st.session_state['learning_path']
 
         if len(flashcards) == 0:
+            st.write("You've learned all the flashcards")
             st.session_state['learning_finished'] = True
             return
 
         flashcard = flashcards[index]
+        if should_prefetch(index, len(flashcards)):
+            # The flashcards left in this batch are explored before the next one is shown
+            next_explored = list(questions_explored) + [card['id'] for card in flashcards[index:]]
+            next_visited = frozenset(next_explored[max(0, len(next_explored) - lookback_size):])
+            prefetcher.prefetch(('interest', question_query, next_visited, batch_size),
+                                partial(get_student_interest, question_query, visited_nodes=next_visited, batch_size=batch_size))
 
         # logging.warning(f"mistake_Cards = {[card['id'] for card in st.session_state['mistake_card']]}")
         # logging.warning(f"explored_flashcards = {st.session_state['explored']}")
@@ -144,7 +157,7 @@ def start_from_student_interest(st, llm, batch_size=10, lookback_size=10):
                 check_answer(st, student_answer, flashcard, logging)
 
             if st.button("Show Hint"):
-                getting_hint(st, llm, flashcard, logging)
+                getting_hint(st, llm, flashcard, logging, hints=st.session_state.get('batch_hints'))
 
             if st.button("Show Answer"):
                 st.write(f"The correct answer is {flashcard['answer']}")
@@ -177,8 +190,6 @@ def start_from_student_interest(st, llm, batch_size=10, lookback_size=10):
                 #                                   visited_nodes=set(
                 #                                       questions_explored[max(0, len(questions_explored) - lookback_size):]),
                 #                                   batch_size=batch_size)
-
-                st.cache_resource.clear()
             st.rerun(scope="fragment")
 
         st.progress(len(st.session_state['explored'])/st.session_state['total_cards'])
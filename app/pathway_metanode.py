@@ -1,13 +1,11 @@
-from random import random
-
-from numpy.distutils.misc_util import blue_text
-from pyvis.network import Network
-import networkx as nx
 from backend.functionality_util import *
 import logging
+from functools import partial
 import streamlit as st
 from backend.find_learning_path import *
 from backend.ask_question import answer_student_question
+from backend.batch_prefetch import get_batch_prefetcher, should_prefetch
+from backend.query_cache import SHARED
 
 
 """
@@ -17,22 +15,20 @@ the key topic of the flashcard has the highest entropy
 """
 
 
-@st.cache_resource
-def query_flashcard(batch_size=1, logging=logging):
+def query_flashcard(batch_size=1, visited_nodes=(), logging=logging):
     """
-    Caches the resource using Streamlit's caching mechanism.
+    Plans the study path from the flashcard with the highest entropy.
 
     Args:
-        batch_size (int, optional): The number of flashcards to include in the study path. Defaults to 1.
+        batch_size (int, optional): The number of nearest neighbours considered when the walk is stuck. Defaults to 1.
+        visited_nodes (iterable, optional): The ids of the flashcards already explored.
         logging (module, optional): Logging module to use. Defaults to the standard logging module.
 
     Returns:
-        study_path (object): The study path generated by the walk_with_entropy function.
+        study_path (tuple): The ordered flashcard ids planned by the plan_learning_path function.
     """
-    study_path = walk_with_entropy(
-        k=batch_size,
-        visited_nodes=set(st.session_state['explored']),
-        starting_node_id='', logging=logging)
+    study_path = plan_learning_path(visited_nodes=visited_nodes, k=batch_size)
+    logging.info(f"planned a study path of {len(study_path)} flashcards")
     return study_path
 
 def recover_learning_path(flashcard_id):
@@ -43,18 +39,14 @@ def recover_learning_path(flashcard_id):
         flashcard_id (list): A list of flashcard IDs to retrieve from the database.
 
     Returns:
-        list: A list of flashcards represented as dictionaries containing 'question', 'answer', and 'id' fields.
+        list: A list of flashcards represented as dictionaries containing 'question', 'answer', and 'id' fields,
+        in the order of the given IDs.
     """
-    flashcard_id_str = "'" + "', '".join(map(str, flashcard_id)) + "'"
-    logging.warning(f'input flashcard is {flashcard_id_str}')
-    query = f"""
-         MATCH (q1:Flashcard)
-         WHERE q1.id IN [{flashcard_id_str}] 
-         RETURN q1.question AS question, q1.answer AS answer, q1.id as id
-        """
-    logging.warning(f"query is {query}")
-    result = run_query(query)
-    return result
+    logging.warning(f'input flashcard is {flashcard_id}')
+    result = run_named_query('flashcards_by_id', {'ids': list(flashcard_id)}, scope=SHARED)
+    # Keep the order of the learning path
+    position = {card_id: i for i, card_id in enumerate(flashcard_id)}
+    return sorted(result, key=lambda card: position[card['id']])
 
 
 @st.fragment
@@ -74,7 +66,8 @@ def start_from_metanode(st, llm, batch_size=3):
     current_batch (int): Stores the current batch number.
     current_flashcard_index (int): Index to track the current flashcard within the batch.
     rerun_query (bool): Flag to indicate whether to fetch new flashcards.
-    learning_path (list): The list of flashcards for the current learning session.
+    learning_plan (tuple): The ordered ids of the flashcards planned for the learning session.
+    learning_path (list): The flashcards of the current batch of the plan.
     learning_finished (bool): Flag to indicate if learning is complete.
     explored (list): List of flashcard IDs that have been explored.
     mistake_card (list): List of flashcards that were answered incorrectly.
@@ -83,7 +76,7 @@ def start_from_metanode(st, llm, batch_size=3):
     Logic flow:
 
     Initializes session state variables if not already set.
-    Fetches a batch of flashcards if rerun_query is True, otherwise uses the current learning path.
+    Plans the learning path if rerun_query is True, then recovers the flashcards of the current batch of the plan.
     Displays the current flashcard and provides options for the student to submit an answer, request a hint, or view the correct answer.
     Allows the student to explore the flashcard further or add it to the mistake list.
     Marks the flashcard as explored and proceeds to the next one on clicking the "Next Question and Mark the Question Explored" button.
@@ -96,15 +89,25 @@ def start_from_metanode(st, llm, batch_size=3):
     start_idx = (current_batch - 1) * batch_size
     end_idx = current_batch * batch_size  # Ensure end_idx doesn't overflow
 
-    # Fetch flashcards that have not been explored yet
-    if st.session_state.get('rerun_query', True):
-        flashcard_ids = list(query_flashcard(batch_size, logging))
+    # Plan the path over the flashcards that have not been explored yet
+    if st.session_state.get('rerun_query', True) or 'learning_plan' not in st.session_state:
+        st.session_state['learning_plan'] = query_flashcard(batch_size, tuple(st.session_state['explored']), logging)
+        st.session_state['learning_path_batch'] = None
+        st.session_state['rerun_query'] = False
+
+    # Page through the plan, recovering only the flashcards of the current batch
+    prefetcher = get_batch_prefetcher(st.session_state)
+    if st.session_state.get('learning_path_batch') != current_batch:
+        flashcard_ids = tuple(st.session_state['learning_plan'][start_idx:end_idx])
         logging.warning(f"flashcards {flashcard_ids}, with size {len(flashcard_ids)}")
-        # recover the flashcard with flashcard id, due to the previous calculation step is intense
-        flashcards = recover_learning_path(flashcard_ids)
+        # Taken from the prefetch buffer when the batch was recovered while the previous one was shown
+        flashcards, hints = [], {}
+        if flashcard_ids:
+            flashcards, hints = prefetcher.take(('metanode', flashcard_ids), partial(recover_learning_path, flashcard_ids))
         logging.warning(f"results {flashcards}")
-        st.session_state['rerun_query'] = False
         st.session_state['learning_path'] = flashcards
+        st.session_state['batch_hints'] = hints
+        st.session_state['learning_path_batch'] = current_batch
     else:
         flashcards = st.session_state['learning_path']
 
@@ -115,13 +118,16 @@ def start_from_metanode(st, llm, batch_size=3):
 
     logging.warning(f"the current flashcard is {index}")
 
-    flashcard = flashcards[start_idx+index]
+    flashcard = flashcards[index]
+    next_ids = tuple(st.session_state['learning_plan'][end_idx:end_idx + batch_size])
+    if next_ids and should_prefetch(index, len(flashcards)):
+        prefetcher.prefetch(('metanode', next_ids), partial(recover_learning_path, next_ids))
     # flashcard = query_one_node_with_id(flashcard_id)
     #
     logging.warning(f"The flashcard being explored is {flashcard}")
     display_learning_path(st, explored_flashcards=st.session_state['explored'],
                                       mistake_cards=[card['id'] for card in st.session_state['mistake_card']],
-                                      learning_path=flashcards[start_idx:min(end_idx, len(flashcards))])
+                                      learning_path=flashcards)
 
 
 
@@ -135,7 +141,7 @@ def start_from_metanode(st, llm, batch_size=3):
             check_answer(st, student_answer, flashcard, logging)
 
         if st.button("Show Hint"):
-            getting_hint(st, llm, flashcard, logging)
+            getting_hint(st, llm, flashcard, logging, hints=st.session_state.get('batch_hints'))
 
         if st.button("Show Answer"):
             st.write(f"The correct answer is {flashcard['answer']}")
@@ -160,14 +166,11 @@ def start_from_metanode(st, llm, batch_size=3):
         logging.warning(f"the current flashcard explored are {st.session_state['explored']}")
         # Increment the current flashcard index and reload to show next flashcard
         st.session_state['current_flashcard_index'] += 1
-        if st.session_state['current_flashcard_index'] >= batch_size:
+        if st.session_state['current_flashcard_index'] >= len(flashcards):
             # st.session_state["rerun_query"] = True
             st.session_state['current_batch'] = current_batch + 1
             logging.warning("refreshing the card search now")
             st.session_state['current_flashcard_index'] = 0
-            # flashcards = query_flashcard(batch_size, logging)
-
-            st.cache_resource.clear()
         st.rerun(scope="fragment")
 
     st.progress(len(st.session_state['explored']) / st.session_state['total_cards'])
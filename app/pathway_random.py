@@ -1,14 +1,15 @@
 # pathway_random.py
-from requests import session
 
 from backend.functionality_util import *
 import logging
+from functools import partial
 import streamlit as st
 from backend.ask_question import answer_student_question
+from backend.batch_prefetch import get_batch_prefetcher, should_prefetch
+from backend.query_cache import session_scope
 
 
-@st.cache_resource
-def query_flashcard(batch_size=1, logging=logging):
+def query_flashcard(batch_size=1, visited_nodes=(), logging=logging):
     """
 
     Function to query flashcards randomly from a database.
@@ -16,29 +17,21 @@ def query_flashcard(batch_size=1, logging=logging):
     This function executes a Cypher query that retrieves a specified number of flashcards
     from a database, ensuring that previously explored flashcards are not included in the
     results. The flashcards are returned in random order based on a randomly generated value.
-    If no new flashcards are available, a message is displayed to the user.
+    When it runs in the script, the batch is cached for the session. It does not read the session
+    state, so the next batch can also be prefetched in a worker thread.
 
     Parameters:
     - batch_size (int): The number of flashcards to retrieve. Default is 1.
+    - visited_nodes (iterable): The ids of the flashcards explored before the batch.
     - logging: Logging module for creating log messages. Default is the `logging` module.
 
     Returns:
     - list: A list of dictionaries containing the 'question', 'answer', and 'id' of each flashcard
       if new flashcards are found. If no new flashcards are available, an empty list is returned.
     """
-    query = f'''
-    MATCH (f:Flashcard)
-    WITH f, rand() AS randomValue
-    WHERE NOT f.id IN {st.session_state.get('explored', [])}
-    RETURN f.question AS question, f.answer AS answer, f.id as id
-    ORDER BY randomValue
-    LIMIT {batch_size}
-    '''
-    flashcards = run_query(query)
+    flashcards = run_named_query('random_flashcards', {'ids': list(visited_nodes), 'limit': batch_size},
+                                 scope=session_scope())
     logging.warning(f"queried flashcard is {flashcards}")
-    if len(flashcards) == 0:
-        st.write("You've learned all the flashcards!")
-        return []
     # output = {"stored_flashcards": flashcards}
     return flashcards
 
@@ -67,11 +60,29 @@ def start_from_random(st, llm, batch_size=1):
     # flashcards = query_flashcard(batch_size, logging)
     index = st.session_state['current_flashcard_index']
     logging.warning(f"current index is {index}")
-    flashcards = query_flashcard(batch_size, logging)
+    # The explored flashcards are only taken into account at the start of a batch
+    if 'random_batch_visited' not in st.session_state:
+        st.session_state['random_batch_visited'] = tuple(st.session_state['explored'])
+    visited = st.session_state['random_batch_visited']
+    prefetcher = get_batch_prefetcher(st.session_state)
+    if st.session_state.get('random_batch_key') != frozenset(visited):
+        # Taken from the prefetch buffer when the batch was fetched while the previous one was shown
+        flashcards, hints = prefetcher.take(('random', frozenset(visited)),
+                                            partial(query_flashcard, batch_size, visited, logging))
+        st.session_state['random_batch'] = flashcards
+        st.session_state['batch_hints'] = hints
+        st.session_state['random_batch_key'] = frozenset(visited)
+    flashcards = st.session_state['random_batch']
     if len(flashcards) == 0:
+        st.write("You've learned all the flashcards!")
         st.session_state['learning_finished'] = True
         return
     flashcard = flashcards[index]
+    if should_prefetch(index, len(flashcards)):
+        # The next batch excludes the flashcards of this one, which the student explores first
+        next_visited = tuple(visited) + tuple(card['id'] for card in flashcards)
+        prefetcher.prefetch(('random', frozenset(next_visited)),
+                            partial(query_flashcard, batch_size, next_visited, logging))
 
     # for flashcard in flashcards:
     st.subheader(f"Question: {flashcard['question']}")
@@ -84,7 +95,7 @@ def start_from_random(st, llm, batch_size=1):
             check_answer(st, student_answer, flashcard, logging)
 
         if st.button("Show Hint"):
-            getting_hint(st, llm, flashcard, logging)
+            getting_hint(st, llm, flashcard, logging, hints=st.session_state.get('batch_hints'))
 
         if st.button("Show Answer"):
             st.write(f"The correct answer is {flashcard['answer']}")
@@ -111,9 +122,8 @@ def start_from_random(st, llm, batch_size=1):
         if st.session_state['current_flashcard_index'] >= len(flashcards):
             logging.warning("refreshing the card search now")
             st.session_state['current_flashcard_index'] = 0
-            # flashcards = query_flashcard(batch_size, logging)
-
-            st.cache_resource.clear()
+            # The next batch excludes the flashcards explored so far
+            st.session_state['random_batch_visited'] = tuple(st.session_state['explored'])
         st.rerun(scope="fragment")
 
     st.write(f"You've explored  {st.session_state['explored']} ")
@@ -1,16 +1,16 @@
+import codecs
 import os
 
 import streamlit as st
-from io import StringIO
 
-from backend.functionality_util import run_query, interactive_graph
-from backend.knowledge_graph import extract_and_store_graph
+from backend.functionality_util import gather_queries, interactive_graph, run_named_query_async
+from backend.query_cache import SHARED
+from backend.ingest_jobs import get_ingest_job_runner, QUEUED, RUNNING, FAILED
 from langchain.schema import Document
 from langchain.text_splitter import TextSplitter
 
 
 # Setting up path for examples
-import logging
 FLASHCARD_PATH = 'assets/flashcards'
 
 
@@ -35,6 +35,12 @@ class LineTextSplitter(TextSplitter):
          split_documents(documents):
              Splits the page content of each document in the given list into chunks.
 
+         lazy_split_text(lines):
+             Lazily yields chunks from an iterable of lines, such as an open file.
+
+         lazy_split_documents(lines):
+             Lazily yields a Document for each chunk of an iterable of lines.
+
          def __init__(self, chunk_size: int, chunk_overlap: int = 0):
 
          Initializes the LineTextSplitter with the specified chunk size and overlap.
@@ -62,6 +68,17 @@ class LineTextSplitter(TextSplitter):
 
          Returns:
          list: A list of Document objects, each containing a chunk of text.
+
+         def lazy_split_text(self, lines):
+
+         Chunks the lines as they are read, so that only the current chunk is held in memory and the
+         first chunk is available before the whole file has been read.
+
+         Parameters:
+         lines (iterable): An iterable of lines, such as an open text file.
+
+         Returns:
+         generator: The text chunks, in order.
     """
     def __init__(self, chunk_size: int, chunk_overlap: int = 0):
         super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
@@ -69,17 +86,29 @@ class LineTextSplitter(TextSplitter):
         self.chunk_overlap = chunk_overlap
 
     def split_text(self, text: str):
-        # Split text into lines
-        lines = text.splitlines()
-
-        # Chunk the text by lines, respecting chunk size and overlap
-        chunks = []
-        for i in range(0, len(lines), self.chunk_size - self.chunk_overlap):
-            chunk_lines = lines[i:i + self.chunk_size]
-            chunk = '\n'.join(chunk_lines)
-            chunks.append(chunk)
-
-        return chunks
+        # Split text into lines and chunk them, respecting chunk size and overlap
+        return list(self.lazy_split_text(text.splitlines()))
+
+    def lazy_split_text(self, lines):
+        # Chunk the lines as they are read, only the current chunk is held in memory
+        step = max(1, self.chunk_size - self.chunk_overlap)
+        chunk_lines = []
+        new_lines = 0
+        for line in lines:
+            chunk_lines.append(line.rstrip('\r\n'))
+            new_lines += 1
+            if len(chunk_lines) >= self.chunk_size:
+                yield '\n'.join(chunk_lines)
+                # Keep the overlapping lines for the next chunk
+                chunk_lines = chunk_lines[step:]
+                new_lines = 0
+        if new_lines:
+            yield '\n'.join(chunk_lines)
+
+    def lazy_split_documents(self, lines):
+        # Yield a Document for each chunk of an iterable of lines, such as an open file
+        for chunk in self.lazy_split_text(lines):
+            yield Document(page_content=chunk)
 
     def split_documents(self, documents):
         # Split each document's text into chunks
@@ -90,6 +119,56 @@ class LineTextSplitter(TextSplitter):
             split_docs.extend([Document(page_content=chunk) for chunk in text_chunks])
         return split_docs
 
+class TokenBudgetTextSplitter(LineTextSplitter):
+    """
+         class TokenBudgetTextSplitter(LineTextSplitter):
+
+         A LineTextSplitter that packs whole flashcard lines into a chunk until a token budget is
+         reached, instead of using a fixed number of lines. Short cards share one extraction call and
+         long cards never overflow the context window. A single line longer than the budget is sent
+         on its own.
+
+         Attributes:
+         token_budget (int): The maximum number of tokens per chunk, measured with tiktoken.
+
+         Methods:
+         for_topic(topic):
+             Creates a splitter whose budget accounts for the extraction prompt and few-shot example of the topic.
+
+         lazy_split_text(lines):
+             Lazily yields chunks of whole lines that fit in the token budget.
+    """
+    def __init__(self, token_budget: int):
+        super().__init__(chunk_size=token_budget, chunk_overlap=0)
+        self.token_budget = token_budget
+
+    @classmethod
+    def for_topic(cls, topic):
+        from backend.kg_building_util import get_chunk_token_budget
+        from backend.knowledge_graph import load_topic_example
+
+        example, results = load_topic_example(topic)
+        return cls(token_budget=get_chunk_token_budget(example, results))
+
+    def lazy_split_text(self, lines):
+        from backend.kg_building_util import count_tokens
+
+        chunk_lines = []
+        chunk_tokens = 0
+        for line in lines:
+            line = line.rstrip('\r\n')
+            # Count the newline joining the line to the chunk
+            line_tokens = count_tokens(line) + 1
+            if chunk_lines and chunk_tokens + line_tokens > self.token_budget:
+                yield '\n'.join(chunk_lines)
+                chunk_lines = []
+                chunk_tokens = 0
+            chunk_lines.append(line)
+            chunk_tokens += line_tokens
+        if chunk_lines:
+            yield '\n'.join(chunk_lines)
+
+
 def results_check(selection=''):
     """
         results_check(selection='')
@@ -102,19 +181,36 @@ def results_check(selection=''):
         Parameters:
         selection (str): An optional string to tailor the query or display messages.
     """
-    query = """
-        MATCH (f:Flashcard)
-        RETURN COUNT(f) AS total_flashcards
-        """
     try:
-        result = run_query(query)[0]['total_flashcards']
+        # The count and the relationships shown in the graph are read at the same time
+        counts, edges = gather_queries(run_named_query_async('count_flashcards', scope=SHARED),
+                                       run_named_query_async('flashcard_edges', {'limit': 50}, scope=SHARED))
+        result = counts[0]['total_flashcards']
         st.write(f"Finished loading for {selection} and in total {result} flashcards are found")
         st.session_state['total_cards'] = result
     except Exception as e:
         st.write(f"Problem occurred: {e}. Problem occurred with the flashcards writing")
         st.stop()
 
-    interactive_graph(st, display_batch=50)
+    interactive_graph(st, display_batch=50, edges=edges)
+
+
+@st.fragment(run_every=2)
+def show_ingest_progress(job_id):
+    """
+    Polls the progress of a background ingestion job and reruns the app once the job has finished.
+
+    Parameters:
+    job_id (str): The id of the job returned by the job runner.
+    """
+    progress = get_ingest_job_runner().progress(job_id)
+    done, total = progress['done'], progress['total']
+    text = f"Building knowledge graph for {progress['name']}: {done}/{total} chunks stored"
+    if progress['stage'] != 'extract':
+        text += f", {progress['stage'].replace('_', ' ')}"
+    st.progress(done / total if total else 0.0, text=text)
+    if progress['status'] not in (QUEUED, RUNNING):
+        st.rerun()
 
 
 def upload_flashcards():
@@ -128,13 +224,19 @@ def upload_flashcards():
     3. Entering custom content directly to build a knowledge graph.
 
     In case a file is uploaded:
-    - The uploaded file is read and processed to extract content.
-    - The content is split into smaller chunks using LineTextSplitter.
-    - Each chunk is passed to the extract_and_store_graph function to build the knowledge dataset.
+    - The uploaded file is read line by line and lazily split into chunks of whole lines that fit the
+      extraction token budget using TokenBudgetTextSplitter,
+      so extraction starts before the whole file is read and memory stays flat for large decks.
+    - The chunks are passed to the extract_and_store_graphs function, which extracts them concurrently
+      and writes the merged knowledge dataset once.
 
     If the user chooses to load from the database:
-    - The content is retrieved from the specified path and split into smaller chunks.
-    - Each chunk is then passed to the extract_and_store_graph function using the selected topic.
+    - The content is streamed from the specified path and split into smaller chunks.
+    - The chunks are queued as a background ingestion job, whose progress is polled by
+      show_ingest_progress and which resumes from its last committed chunk after a restart.
+
+    With the incremental option, only the flashcards added, changed or removed since the last load are
+    extracted and written, through ingest_deck_incrementally, and the size of the delta is displayed.
 
     If the user prefers to proceed without uploading or loading:
     - The function checks the results stored in the database.
@@ -155,19 +257,25 @@ def upload_flashcards():
 
     # If a file is uploaded, process the file
     if uploaded_file is not None:
-        content = StringIO(uploaded_file.getvalue().decode("utf-8")).read()
-        document = Document(page_content=content)
+        # The ingest stack is only loaded once there is something to ingest
+        from backend.knowledge_graph import extract_and_store_graphs, ingest_deck_incrementally
+
         topic = st.text_input("What is the topic of the content?")
+        incremental = st.checkbox("Only update the flashcards that changed since the last upload", key="upload_incremental")
         st.write("Building knowledge graph from text or flashcards...")
-        text_splitter = LineTextSplitter(chunk_size=50, chunk_overlap=0)
-        # Split the document into smaller chunks
-        documents = text_splitter.split_documents([document])
-        first_time_load = True
-        for document in documents:
-            # loading to the dataset
-            extract_and_store_graph(document,
-                                    topic=topic,
-                                    first_time_load=first_time_load)  # Use the document from the uploaded file
+        text_splitter = TokenBudgetTextSplitter.for_topic(topic)
+        # Read the upload line by line instead of decoding it into one string
+        uploaded_file.seek(0)
+        lines = codecs.iterdecode(uploaded_file, "utf-8")
+        if incremental:
+            delta = ingest_deck_incrementally(lines, topic=topic, text_splitter=text_splitter)
+            st.write(f"{delta['added']} flashcards added, {delta['changed']} changed, "
+                     f"{delta['removed']} removed and {delta['unchanged']} unchanged")
+        else:
+            # Split the file into smaller chunks lazily
+            documents = text_splitter.lazy_split_documents(lines)
+            # loading to the dataset, the chunks are extracted concurrently while the file is read
+            extract_and_store_graphs(documents, topic=topic, first_time_load=True)
         st.success("Knowledge graph built successfully from uploaded file.")
     # If the bypass button is clicked, load flashcards from the database
     # elif bypass_db_button:
@@ -179,28 +287,54 @@ def upload_flashcards():
     with st.form("Select from database"):
         selection = st.selectbox(f"Choose one of the topics: ",
                                   flashcard_db)
+        incremental = st.checkbox("Only update the flashcards that changed since the last load")
+        fast_import = st.checkbox("Fast import: create the question,answer flashcards locally and "
+                                  "only use the LLM for relationships and MetaNodes")
         submitted = st.form_submit_button('Submit')
     # Convert your custom text into a LangChain document
     # logging.warning(f"Your choice {selections} has been submitted ")
     if submitted:
+        from backend.knowledge_graph import prepare_incremental_ingest
+
         # logging.warning(f"Your choice {selections} has been submitted ")
         st.write(f"Your choice {selection} has been submitted ")
-        with open(f"{FLASHCARD_PATH}/{selection}.csv") as f:
-            content_text = f.read()
-        document = Document(page_content=content_text)
         # Define chunking strategy (splitting the text into manageable chunks)
-        text_splitter = LineTextSplitter(chunk_size=35, chunk_overlap=0)
-
-        # Split the document into smaller chunks
-        documents = text_splitter.split_documents([document])
-        first_time_load = True
-        for doc in documents:
-            logging.warning(doc.page_content)
-            # loading to the dataset
-            extract_and_store_graph(doc, topic=selection.lower(), first_time_load=first_time_load)
-            first_time_load = False
-        st.success(f"Knowledge graph for {selection} built successfully from the stored dataset.")
-        results_check(selection=selection)
+        text_splitter = TokenBudgetTextSplitter.for_topic(selection.lower())
+
+        # The chunks are extracted by a background job, so a refresh does not lose the work
+        with open(f"{FLASHCARD_PATH}/{selection}.csv") as f:
+            if incremental:
+                delta, changed_lines, rebuild, stale_cards = prepare_incremental_ingest(f)
+                st.write(f"{delta['added']} flashcards added, {delta['changed']} changed, "
+                         f"{delta['removed']} removed and {delta['unchanged']} unchanged")
+                documents = text_splitter.lazy_split_documents(changed_lines)
+                first_time_load = rebuild
+            else:
+                # Split the file into smaller chunks lazily
+                documents = text_splitter.lazy_split_documents(f)
+                first_time_load = True
+                stale_cards = []
+            st.session_state['ingest_job'] = get_ingest_job_runner().submit(
+                documents, topic=selection.lower(), first_time_load=first_time_load, name=selection,
+                mode='csv' if fast_import else 'llm', stale_cards=stale_cards)
+
+    runner = get_ingest_job_runner()
+    job_id = st.session_state.get('ingest_job') or runner.latest_job()
+    progress = runner.progress(job_id) if job_id else None
+    if progress and progress['status'] in (QUEUED, RUNNING):
+        show_ingest_progress(job_id)
+    elif progress and progress['status'] == FAILED:
+        # A failed job keeps its chunks and the cards it replaces until it is retried
+        st.error(f"Building the knowledge graph for {progress['name']} failed: {progress['error']}")
+        if st.button("Retry from the last stored chunk", key="retry_ingest_job"):
+            runner.retry(job_id)
+            st.session_state['ingest_job'] = job_id
+            st.rerun()
+    elif progress and job_id == st.session_state.get('ingest_job'):
+        # Report the end of the job started in this session once
+        del st.session_state['ingest_job']
+        st.success(f"Knowledge graph for {progress['name']} built successfully from the stored dataset.")
+        results_check(selection=progress['name'])
 
     st.divider()
     st.markdown("### Option 3: Enter Custom Content")
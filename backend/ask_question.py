@@ -1,5 +1,5 @@
 import streamlit as st
-from langchain_config.config import llm
+from langchain_config.config import get_llm
 
 
 def answer_student_question_prompt(flashcard, student_question):
@@ -32,7 +32,7 @@ def answer_student_question_prompt(flashcard, student_question):
    If the previous knowledge is not sufficient, We may not be able to answer the question. 
     """
 
-    response = llm.predict(prompt).strip('\n')
+    response = get_llm().predict(prompt).strip('\n')
 
     return response
 
@@ -56,4 +56,3 @@ def answer_student_question(flashcard):
         st.write(f"Question: {flashcard['question']}.")
         st.write(f"Your Question: {student_question}")
         st.write(f"Response: {response}")
-        st.cache_resource.clear()
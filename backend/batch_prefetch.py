@@ -0,0 +1,141 @@
+"""
+Background prefetch of the next flashcard batch of a session.
+
+When a student is partway through a batch, the pathway asks the session's `BatchPrefetcher` to
+fetch the batch that follows, together with the hint relationship of each of its flashcards, in a
+worker thread. The batch is kept in a small buffer keyed by the arguments it was fetched with, so
+the click that finishes the current batch takes the next one from memory instead of waiting for
+the database. A batch fetched for other arguments, or before the graph changed, is not used.
+
+The fetch functions run outside of the Streamlit script, so they take the visited flashcards as
+arguments instead of reading the session state, and must not call Streamlit.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.graph_snapshot import get_hint_relationship
+from backend.graph_version import get_graph_version
+
+# Fraction of the current batch the student has to reach before the next batch is prefetched
+PREFETCH_AT = float(os.getenv('PREFETCH_AT', 0.5))
+# Number of prefetched batches a session keeps
+PREFETCH_BUFFER_SIZE = int(os.getenv('PREFETCH_BUFFER_SIZE', 2))
+# Number of worker threads prefetching batches, shared by every session
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 4))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    """Returns the process-wide thread pool running the prefetches, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='batch-prefetch')
+    return _executor
+
+
+def fetch_with_hints(fetch):
+    """
+    Fetches a batch and the hint relationship of each of its flashcards.
+
+    Args:
+        fetch (callable): Returns the flashcards of the batch.
+
+    Returns:
+        tuple: The flashcards, and a dictionary mapping every flashcard id to its hint relationship.
+    """
+    flashcards = fetch()
+    return flashcards, {flashcard['id']: get_hint_relationship(flashcard['id']) for flashcard in flashcards}
+
+
+def should_prefetch(index, batch_length, prefetch_at=PREFETCH_AT):
+    """Returns whether the student, at position `index` of the current batch, is far enough to prefetch the next one."""
+    return batch_length > 0 and index + 1 >= prefetch_at * batch_length
+
+
+class BatchPrefetcher:
+    """
+    Bounded buffer of the batches prefetched for one session.
+
+    Attributes:
+    max_batches (int): The maximum number of batches kept, the oldest one is dropped first.
+    hits (int): The number of batches taken from the buffer.
+    misses (int): The number of batches fetched on the click because they were not prefetched.
+    """
+
+    def __init__(self, max_batches=PREFETCH_BUFFER_SIZE):
+        self.max_batches = max_batches
+        self.hits = 0
+        self.misses = 0
+        # key -> (graph version, future of the flashcards and their hints)
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, key, fetch) -> None:
+        """
+        Starts fetching a batch in a worker thread, unless it is already buffered.
+
+        Args:
+            key (hashable): The arguments identifying the batch.
+            fetch (callable): Returns the flashcards of the batch, without calling Streamlit.
+        """
+        with self._lock:
+            if key in self._batches:
+                return
+            future = get_prefetch_executor().submit(fetch_with_hints, fetch)
+            self._batches[key] = (get_graph_version(), future)
+            while len(self._batches) > self.max_batches:
+                _, (_, dropped) = self._batches.popitem(last=False)
+                dropped.cancel()
+
+    def take(self, key, fetch):
+        """
+        Returns a batch, from the buffer if it was prefetched, otherwise by fetching it now.
+
+        A prefetch still running is waited for, since it started before the click.
+
+        Args:
+            key (hashable): The arguments identifying the batch.
+            fetch (callable): Returns the flashcards of the batch.
+
+        Returns:
+            tuple: The flashcards, and the hint relationship of every prefetched flashcard id.
+        """
+        with self._lock:
+            version, future = self._batches.pop(key, (None, None))
+        if future is not None and version == get_graph_version():
+            try:
+                flashcards, hints = future.result()
+                self.hits += 1
+                return flashcards, hints
+            except Exception as e:
+                logging.warning(f"Prefetching the batch {key} failed, fetching it again: {e}")
+        self.misses += 1
+        return fetch(), {}
+
+    def clear(self) -> None:
+        """Drops every buffered batch."""
+        with self._lock:
+            for _, future in self._batches.values():
+                future.cancel()
+            self._batches.clear()
+
+
+def get_batch_prefetcher(session_state):
+    """
+    Returns the prefetcher of a session, created on first use.
+
+    Args:
+        session_state: The Streamlit session state of the session.
+
+    Returns:
+        BatchPrefetcher: The prefetcher stored in the session state.
+    """
+    if 'batch_prefetcher' not in session_state:
+        session_state['batch_prefetcher'] = BatchPrefetcher()
+    return session_state['batch_prefetcher']
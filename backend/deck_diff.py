@@ -0,0 +1,115 @@
+"""
+Fingerprints flashcard lines and diffs a deck against the fingerprints stored in the graph.
+
+Every flashcard line is identified by a key, the hash of its normalized question, and a content
+hash, the hash of its normalized question and answer. Comparing them with the keys and hashes
+stored on the Flashcard nodes tells which cards were added, changed or removed, so a re-upload only
+re-extracts and rewrites those cards.
+"""
+import csv
+import hashlib
+
+
+def parse_flashcard_line(line: str):
+    """
+    Parses a `question,answer` flashcard line, honouring CSV quoting.
+
+    Args:
+        line (str): A single line of the deck.
+
+    Returns:
+        tuple: The question and the answer, the answer is empty when the line has no comma.
+    """
+    fields = next(csv.reader([line]), [])
+    if not fields:
+        return "", ""
+    question = fields[0]
+    answer = ",".join(fields[1:])
+    return question, answer
+
+
+def normalize_card_text(text: str) -> str:
+    """Lowercases and collapses whitespace so formatting-only edits do not count as changes."""
+    return " ".join(text.lower().split())
+
+
+def card_key(question: str) -> str:
+    """Returns the key identifying a flashcard across versions of the deck."""
+    return hashlib.sha1(normalize_card_text(question).encode("utf-8")).hexdigest()
+
+
+def card_hash(question: str, answer: str) -> str:
+    """Returns the hash of a flashcard's content, which changes whenever the question or answer does."""
+    content = normalize_card_text(question) + "\x00" + normalize_card_text(answer)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def fingerprint_lines(lines):
+    """
+    Fingerprints the flashcard lines of a deck.
+
+    Args:
+        lines (iterable): The lines of the deck, blank lines are ignored.
+
+    Returns:
+        dict: Maps each card key to a `(content hash, line)` tuple, the first line wins for repeated questions.
+    """
+    fingerprints = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        question, answer = parse_flashcard_line(line)
+        key = card_key(question)
+        if key not in fingerprints:
+            fingerprints[key] = (card_hash(question, answer), line)
+    return fingerprints
+
+
+def diff_deck(lines, stored):
+    """
+    Computes the cards added, changed and removed between the stored deck and a new version of it.
+
+    Args:
+        lines (iterable): The lines of the new version of the deck.
+        stored (dict): Maps each card key stored in the graph to its content hash.
+
+    Returns:
+        dict: The delta, see `diff_fingerprints`.
+    """
+    return diff_fingerprints(fingerprint_lines(lines), stored)
+
+
+def diff_fingerprints(fingerprints, stored):
+    """
+    Computes the cards added, changed and removed between the stored deck and the fingerprints of a new version of it.
+
+    Args:
+        fingerprints (dict): The fingerprints of the new version of the deck, from `fingerprint_lines`.
+        stored (dict): Maps each card key stored in the graph to its content hash.
+
+    Returns:
+        dict: With keys
+            - 'added': lines whose key is not stored,
+            - 'changed': lines whose key is stored with a different content hash,
+            - 'removed': stored keys that are no longer in the deck,
+            - 'changed_keys': the keys of the changed lines,
+            - 'unchanged': the number of cards that are identical.
+    """
+    added, changed, changed_keys = [], [], []
+    unchanged = 0
+    for key, (content_hash, line) in fingerprints.items():
+        if key not in stored:
+            added.append(line)
+        elif stored[key] != content_hash:
+            changed.append(line)
+            changed_keys.append(key)
+        else:
+            unchanged += 1
+    removed = [key for key in stored if key not in fingerprints]
+    return {
+        'added': added,
+        'changed': changed,
+        'removed': removed,
+        'changed_keys': changed_keys,
+        'unchanged': unchanged,
+    }
@@ -0,0 +1,138 @@
+"""
+Near-duplicate detection for flashcards with MinHash and locality-sensitive hashing.
+
+Every card's normalized question and answer is reduced to a MinHash signature of its character
+shingles. Splitting the signatures into bands and bucketing identical bands only pairs up cards
+that are likely to be similar, so the number of comparisons grows with the number of candidates
+instead of the square of the deck size. The candidates are then confirmed with the cosine
+similarity of their embeddings.
+"""
+import logging
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from backend.similarity_util import normalize_rows
+
+# Mersenne prime used by the universal hash functions of the MinHash permutations
+MERSENNE_PRIME = (1 << 31) - 1
+# Length of the character shingles
+SHINGLE_SIZE = 5
+# Buckets larger than this are skipped, they come from boilerplate shared by many cards
+MAX_BUCKET_SIZE = 50
+
+
+def normalize_card(question: str, answer: str) -> str:
+    """Lowercases a card and strips punctuation and repeated whitespace."""
+    text = f"{question} {answer}".lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def shingle_hashes(text: str, shingle_size=SHINGLE_SIZE) -> np.ndarray:
+    """Returns the hashes of the distinct character shingles of a text."""
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    return np.array([zlib.crc32(shingle.encode("utf-8")) % MERSENNE_PRIME for shingle in shingles],
+                    dtype=np.int64)
+
+
+def minhash_signatures(texts, num_perm=64, seed=1) -> np.ndarray:
+    """
+    Computes the MinHash signature of every text.
+
+    Args:
+        texts (list): The normalized texts.
+        num_perm (int): The number of hash functions, the length of every signature.
+        seed (int): The seed of the hash functions, signatures are only comparable with the same seed.
+
+    Returns:
+        np.ndarray: An `(len(texts), num_perm)` array of signatures.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.int64)
+    for row, text in enumerate(texts):
+        hashes = shingle_hashes(text)
+        # (a * x + b) mod p for every shingle x and every permutation, then the minimum per permutation
+        signatures[row] = ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=16, max_bucket_size=MAX_BUCKET_SIZE):
+    """
+    Lists the pairs of rows whose signatures are identical in at least one band.
+
+    Args:
+        signatures (np.ndarray): The MinHash signatures, one per row.
+        bands (int): The number of bands the signatures are split into.
+        max_bucket_size (int): Buckets with more rows than this are skipped.
+
+    Returns:
+        set: `(i, j)` tuples with `i < j`.
+    """
+    n, num_perm = signatures.shape
+    rows_per_band = max(1, num_perm // bands)
+    pairs = set()
+    for start in range(0, num_perm, rows_per_band):
+        buckets = defaultdict(list)
+        band = np.ascontiguousarray(signatures[:, start:start + rows_per_band])
+        for row in range(n):
+            buckets[band[row].tobytes()].append(row)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) > max_bucket_size:
+                logging.warning(f"Skipping an LSH bucket of {len(members)} cards")
+                continue
+            for i, left in enumerate(members):
+                for right in members[i + 1:]:
+                    pairs.add((left, right))
+    return pairs
+
+
+def find_duplicate_groups(cards, embeddings, similarity_threshold=0.95, num_perm=64, bands=16):
+    """
+    Groups near-duplicate flashcards.
+
+    Args:
+        cards (list): `(question, answer)` tuples.
+        embeddings (list or np.ndarray): The embedding of every card.
+        similarity_threshold (float): The minimum cosine similarity confirming a candidate pair.
+        num_perm (int): The length of the MinHash signatures.
+        bands (int): The number of LSH bands.
+
+    Returns:
+        list: Groups of at least two card indices, each group sorted, the first card being the one kept.
+    """
+    if len(cards) < 2:
+        return []
+    signatures = minhash_signatures([normalize_card(question, answer) for question, answer in cards],
+                                    num_perm=num_perm)
+    candidates = lsh_candidate_pairs(signatures, bands=bands)
+    matrix = normalize_rows(embeddings)
+
+    # Union-find over the confirmed pairs
+    parent = list(range(len(cards)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in candidates:
+        if float(matrix[i] @ matrix[j]) >= similarity_threshold:
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = defaultdict(list)
+    for i in range(len(cards)):
+        groups[find(i)].append(i)
+    return [sorted(members) for members in groups.values() if len(members) > 1]
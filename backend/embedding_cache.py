@@ -0,0 +1,292 @@
+"""
+Persistent, content-addressed cache of text embeddings.
+
+Embeddings are keyed by a hash of the embedding model name and the normalized text, so re-uploading
+the same deck or asking the same interest query again does not pay for the embedding twice. The
+vectors live in a float32 memory-mapped file next to a JSON index that maps each key to its row, and
+the least recently used rows are evicted once the cache reaches its size cap.
+
+Storing embeddings only appends their index records to a journal, so a lookup that embeds one text
+costs one short write instead of rewriting the whole index. The journal is replayed on load, and
+folded into the index once it holds `EMBEDDING_CACHE_COMPACT_RECORDS` records and when the process
+exits.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import unicodedata
+
+import numpy as np
+
+# Directory holding the vector file and its index
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', '.cache/embeddings')
+# Maximum number of embeddings kept on disk before the least recently used ones are evicted
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 50000))
+# Number of journal records after which the index is rewritten and the journal emptied
+EMBEDDING_CACHE_COMPACT_RECORDS = int(os.getenv('EMBEDDING_CACHE_COMPACT_RECORDS', 10000))
+# Number of rows allocated when the vector file is first created
+INITIAL_CAPACITY = 1024
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes unicode and whitespace so trivially different texts share one cache entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_name: str, text: str) -> str:
+    """Returns the content address of a text embedded with the given model."""
+    return hashlib.sha256(f"{model_name}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    An on-disk embedding store backed by a float32 memory-mapped array, a JSON index file and its journal.
+
+    The recency of the lookups is only persisted when the index is rewritten.
+
+    Attributes:
+    path (str): The directory holding `vectors.f32`, `index.json` and `index.journal`.
+    max_entries (int): The maximum number of embeddings kept before eviction.
+    hits (int): The number of lookups answered from the cache since the process started.
+    misses (int): The number of lookups that had to be embedded by the API.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(path, "index.json")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._journal_path = os.path.join(path, "index.journal")
+        self._vectors = None
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._dim = None
+        self._clock = 0
+        self._capacity = 0
+        self._journal_records = 0
+        # key -> [row, last_used]
+        self._entries = {}
+        if os.path.exists(self._index_path) and os.path.exists(self._vectors_path):
+            try:
+                with open(self._index_path) as f:
+                    index = json.load(f)
+                self._dim = index["dim"]
+                self._clock = index["clock"]
+                self._entries = index["entries"]
+                self._capacity = os.path.getsize(self._vectors_path) // (4 * self._dim)
+                self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                          shape=(self._capacity, self._dim))
+            except Exception as e:
+                logging.warning(f"Embedding cache at {self.path} could not be loaded, starting empty: {e}")
+                self._dim, self._clock, self._capacity, self._entries = None, 0, 0, {}
+                self._vectors = None
+        if self._vectors is not None and os.path.exists(self._journal_path):
+            self._replay()
+        used = {row for row, _ in self._entries.values()}
+        self._free = [row for row in range(self._capacity - 1, -1, -1) if row not in used]
+
+    def _replay(self):
+        """Applies the records of the journal, written since the index was last rewritten."""
+        with open(self._journal_path) as f:
+            for line in f:
+                try:
+                    key, row, last_used = json.loads(line)
+                except ValueError:
+                    # The last record was torn by a crash, the ones before it are complete
+                    break
+                if row is None:
+                    self._entries.pop(key, None)
+                elif row < self._capacity:
+                    self._entries[key] = [row, last_used]
+                    self._clock = max(self._clock, last_used)
+                self._journal_records += 1
+
+    def _grow(self, needed):
+        """Extends the vector file so that `needed` more rows fit, up to `max_entries` rows."""
+        new_capacity = max(self._capacity, INITIAL_CAPACITY)
+        while new_capacity - self._capacity + len(self._free) < needed and new_capacity < self.max_entries:
+            new_capacity *= 2
+        new_capacity = min(new_capacity, self.max_entries)
+        if new_capacity <= self._capacity:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(new_capacity * self._dim * 4)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                  shape=(new_capacity, self._dim))
+        self._free.extend(range(new_capacity - 1, self._capacity - 1, -1))
+        self._capacity = new_capacity
+
+    def _evict(self, count, protected):
+        """
+        Frees `count` rows by dropping the least recently used entries not in `protected`.
+
+        Returns:
+            list: The evicted keys.
+        """
+        candidates = sorted((last_used, key) for key, (_, last_used) in self._entries.items()
+                            if key not in protected)
+        evicted = [key for _, key in candidates[:count]]
+        for key in evicted:
+            row, _ = self._entries.pop(key)
+            self._free.append(row)
+        return evicted
+
+    def get_many(self, keys):
+        """
+        Looks up several keys at once.
+
+        Args:
+            keys (list): The cache keys, as returned by `cache_key`.
+
+        Returns:
+            list: The cached embedding as a list of floats for each key, or None when it is missing.
+        """
+        results = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self._clock += 1
+                entry[1] = self._clock
+                results.append(self._vectors[entry[0]].tolist())
+        return results
+
+    def put_many(self, keys, embeddings):
+        """
+        Stores several embeddings and appends them to the journal of the index.
+
+        Args:
+            keys (list): The cache keys, as returned by `cache_key`.
+            embeddings (list): The embeddings to store, in the same order as `keys`.
+        """
+        if not keys:
+            return
+        with self._lock:
+            if self._dim is None:
+                self._dim = len(embeddings[0])
+            new_keys = []
+            for key, embedding in zip(keys, embeddings):
+                if len(embedding) != self._dim:
+                    logging.warning(f"Embedding of size {len(embedding)} not cached, the cache stores size {self._dim}")
+                elif key not in self._entries and key not in new_keys:
+                    new_keys.append(key)
+            # Never store more than the cache can hold
+            new_keys = new_keys[-self.max_entries:]
+            if len(new_keys) > len(self._free):
+                self._grow(len(new_keys))
+            records = []
+            if len(new_keys) > len(self._free):
+                evicted = self._evict(len(new_keys) - len(self._free), protected=set(new_keys))
+                records.extend([key, None, None] for key in evicted)
+            vectors = dict(zip(keys, embeddings))
+            for key in new_keys:
+                row = self._free.pop()
+                self._clock += 1
+                self._vectors[row] = np.asarray(vectors[key], dtype=np.float32)
+                self._entries[key] = [row, self._clock]
+                records.append([key, row, self._clock])
+            self._append(records)
+
+    def _append(self, records):
+        """Persists index records, the vectors they point to being flushed first."""
+        if not records:
+            return
+        self._vectors.flush()
+        if not os.path.exists(self._index_path) or self._journal_records + len(records) >= EMBEDDING_CACHE_COMPACT_RECORDS:
+            self._compact()
+            return
+        with open(self._journal_path, "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        self._journal_records += len(records)
+
+    def _compact(self):
+        """Rewrites the whole index and empties the journal."""
+        if self._dim is None:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self._dim, "clock": self._clock, "entries": self._entries}, f)
+        os.replace(tmp_path, self._index_path)
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        self._journal_records = 0
+
+    def close(self) -> None:
+        """Folds the journal into the index, also saving the recency of the lookups."""
+        with self._lock:
+            self._compact()
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+
+def embed_with_cache(texts, embed_documents, model_name, cache=None):
+    """
+    Embeds texts through the cache, calling `embed_documents` only for the texts it does not hold.
+
+    Args:
+        texts (list): The texts to embed.
+        embed_documents (callable): Embeds a list of texts and returns their embeddings in order.
+        model_name (str): The name of the embedding model, part of the cache key.
+        cache (EmbeddingCache, optional): The cache to read through. Defaults to the process-wide cache.
+
+    Returns:
+        list: The embeddings, in the same order as `texts`.
+    """
+    cache = cache or get_embedding_cache()
+    keys = [cache_key(model_name, text) for text in texts]
+    embeddings = cache.get_many(keys)
+
+    # Embed each missing text once, even if it appears several times
+    missing = {}
+    for key, text, embedding in zip(keys, texts, embeddings):
+        if embedding is None and key not in missing:
+            missing[key] = text
+    if missing:
+        new_embeddings = embed_documents(list(missing.values()))
+        cache.put_many(list(missing), new_embeddings)
+        computed = dict(zip(missing, new_embeddings))
+        embeddings = [embedding if embedding is not None else computed[key]
+                      for key, embedding in zip(keys, embeddings)]
+    logging.info(f"Embedding cache stats {cache.stats()}")
+    return embeddings
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Returns the process-wide embedding cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+            atexit.register(_cache.close)
+        return _cache
@@ -0,0 +1,86 @@
+"""
+Materialized node entropy.
+
+The entropy of a node measures how diverse its outgoing relationship types are:
+
+    -sum(p * log(p) / log(2))
+
+where p is the number of outgoing relationships of a type divided by the total number of
+relationships of the node. Duplicate relationships, which link near-identical cards, are not counted. It is stored as the `entropy` property of Flashcard and Metanode nodes,
+computed in one vectorized pass after an ingest and refreshed only for the nodes whose relationships
+changed afterwards, so picking the highest-entropy node is an index lookup instead of a full scan.
+"""
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from backend.functionality_util import run_named_query
+from backend.graph_version import bump_graph_version
+
+# Number of nodes whose entropy is written in one UNWIND statement
+ENTROPY_WRITE_BATCH_SIZE = 1000
+
+
+def compute_entropy(node_ids, rel_counts, total_rels):
+    """
+    Computes the entropy of every node from its per-type relationship counts.
+
+    Args:
+        node_ids (list): The node id of every row, a node appears once per outgoing relationship type.
+        rel_counts (list): The number of outgoing relationships of the row's type.
+        total_rels (list): The total number of relationships, in both directions, of the row's node.
+
+    Returns:
+        dict: Maps every node id to its entropy.
+    """
+    if not node_ids:
+        return {}
+    unique_ids, inverse = np.unique(np.asarray(node_ids, dtype=object), return_inverse=True)
+    counts = np.asarray(rel_counts, dtype=np.float64)
+    totals = np.asarray(total_rels, dtype=np.float64)
+    # Rows without an outgoing relationship contribute nothing
+    p = np.divide(counts, totals, out=np.zeros_like(counts), where=(counts > 0) & (totals > 0))
+    contributions = np.zeros_like(p)
+    positive = p > 0
+    contributions[positive] = -p[positive] * np.log2(p[positive])
+    entropy = np.bincount(inverse, weights=contributions, minlength=len(unique_ids))
+    return dict(zip(unique_ids.tolist(), entropy.tolist()))
+
+
+def refresh_node_entropy(node_ids=None) -> int:
+    """
+    Recomputes and stores the entropy of Flashcard and Metanode nodes.
+
+    Args:
+        node_ids (iterable, optional): The ids of the nodes written or whose relationships changed, a
+            node without any relationship gets an entropy of 0. When None, the entropy of every node
+            is recomputed.
+
+    Returns:
+        int: The number of nodes updated.
+    """
+    if node_ids is not None:
+        node_ids = list(set(node_ids))
+        if not node_ids:
+            return 0
+    if node_ids is None:
+        rows = run_named_query('relationship_type_counts')
+    else:
+        rows = run_named_query('relationship_type_counts_of', {'ids': node_ids})
+    entropy = compute_entropy([row['id'] for row in rows],
+                              [row['relCount'] for row in rows],
+                              [row['totalRels'] for row in rows])
+
+    by_label = defaultdict(dict)
+    for row in rows:
+        label = 'Flashcard' if 'Flashcard' in row['labels'] else 'Metanode'
+        by_label[label][row['id']] = entropy[row['id']]
+    for label, values in by_label.items():
+        updates = [{'id': node_id, 'entropy': value} for node_id, value in values.items()]
+        for start in range(0, len(updates), ENTROPY_WRITE_BATCH_SIZE):
+            run_named_query(f'set_{label.lower()}_entropy', {'rows': updates[start:start + ENTROPY_WRITE_BATCH_SIZE]})
+    bump_graph_version()
+    logging.info(f"Refreshed the entropy of {len(entropy)} nodes")
+    return len(entropy)
+
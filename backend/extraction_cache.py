@@ -0,0 +1,84 @@
+"""
+Persistent cache of the knowledge graphs extracted by the LLM.
+
+Each chunk's structured output is stored under a hash of everything that can change it: the chunk
+content, the topic example and results from example.toml, the extraction prompt and its version,
+and the model. Re-importing an unchanged deck, or a deck where only a few chunks changed, then only
+calls the LLM for the chunks whose key is not in the cache.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Directory holding one JSON file per cached extraction
+EXTRACTION_CACHE_PATH = os.getenv('EXTRACTION_CACHE_PATH', '.cache/extractions')
+
+
+def extraction_key(content, example, results, prompt_text, model_name, prompt_version) -> str:
+    """Returns the hash identifying one extraction of `content` with the given prompt and model."""
+    payload = json.dumps([prompt_version, model_name, prompt_text, example, results, content])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Stores the raw JSON of extracted knowledge graphs, one file per key.
+
+    Attributes:
+    path (str): The directory holding the cached extractions.
+    hits (int): The number of chunks answered from the cache since the process started.
+    misses (int): The number of chunks that had to be sent to the LLM.
+    """
+
+    def __init__(self, path=EXTRACTION_CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached JSON string for `key`, or None when the chunk was never extracted."""
+        try:
+            with open(self._file(key)) as f:
+                content = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """Stores the JSON string of an extraction, replacing the file atomically."""
+        tmp_path = f"{self._file(key)}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, self._file(key))
+        except OSError as e:
+            logging.warning(f"Extraction {key} could not be cached: {e}")
+
+    def stats(self):
+        """Returns the hit/miss counters of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_extraction_cache():
+    """Returns the process-wide extraction cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache()
+        return _cache
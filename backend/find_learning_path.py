@@ -1,181 +1,132 @@
 import logging
-from backend.functionality_util import run_query
+import os
+import threading
+from collections import OrderedDict
 
+import numpy as np
 
-# TODO: Student may want to switch to a new node anytime, then we need to recalculate the order of visited nodes
-def get_node_with_highest_entropy():
-    """
-    Retrieves the node with the highest entropy from a graph database.
+from backend.vector_index import get_flashcard_index
 
-    The function constructs and runs a Cypher query that calculates the entropy for each node based on its relationships.
-    The entropy is calculated using the formula:
+# Number of planned learning paths kept in memory, one per (graph version, visited set, k)
+PLAN_CACHE_SIZE = int(os.getenv('PLAN_CACHE_SIZE', 32))
 
-        -sum(p * log(p) / log(2))
 
-    where p is the proportion of each relationship type for that node.
-
-    Returns:
-        Node with the highest entropy if exists, otherwise None.
-    """
-    query = """
-    MATCH (n)-[r]->()
-    WITH n, type(r) AS relType, count(r) AS relCount, COUNT { (n)--() } AS totalRels
-    WITH n, (relCount * 1.0 / totalRels) AS p
-    RETURN n, -sum(p * log(p) / log(2)) AS entropy
-    ORDER BY entropy DESC
-    LIMIT 1
-    """
-    result = run_query(query)
-    if result:
-        return result[0]['n']  # Return the node with the highest entropy
-    return None
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
 
 
-def get_neighbors_with_entropy(node_id):
+# TODO: Student may want to switch to a new node anytime, then we need to recalculate the order of visited nodes
+def compute_learning_path(snapshot, visited_nodes=(), k=3, index=None):
     """
+    Computes the whole entropy-guided walk over a graph snapshot.
 
-    Fetches the neighboring nodes of a given node and calculates the entropy for each neighbor based on the relationship types and counts.
+    The walk starts from the Flashcard with the highest entropy, the entropy of a node being
+    `-sum(p * log(p) / log(2))` over the proportion p of each type of its relationships, as
+    materialized by `entropy_util.refresh_node_entropy`. From the current node it moves along an
+    outgoing relationship to the unvisited neighbour with the highest entropy, and when the neighbourhood is
+    exhausted it jumps to the unvisited Flashcard with the highest entropy among the `k` nearest to the
+    current node, or to the unvisited Flashcard with the highest entropy when the current node has no
+    embedding or no unvisited neighbour in the index. The walk ends when every Flashcard with an
+    entropy is visited.
 
     Args:
-        node_id (str): The ID of the node for which neighbors are to be fetched.
+        snapshot (GraphSnapshot): The graph to walk.
+        visited_nodes (iterable): Ids of the nodes that have already been visited.
+        k (int): Number of nearest unvisited neighbours considered when the neighbourhood is exhausted.
+        index (IVFFlatIndex, optional): The vector index over the snapshot embeddings.
 
     Returns:
-        list: A list of neighbors with their corresponding entropy values, ordered by entropy in descending order.
-
+        tuple: The ids of the Flashcards in the order they are visited, the already visited ones excluded.
     """
-    query = f"""
-        MATCH (n)-[r]->(neighbor)
-        WHERE n.id = '{node_id}'
-        WITH neighbor, type(r) AS relType, count(r) AS relCount, COUNT {{ (neighbor)--() }} AS totalRels
-        WITH neighbor, (relCount * 1.0 / totalRels) AS p
-        RETURN neighbor, -sum(p * log(p) / log(2)) AS entropy
-        ORDER BY entropy DESC
-    """
-    return run_query(query)
-
-
-def find_closest_node_with_high_entropy(visited_nodes, k=1):
-    """
-    Finds the closest node based on cosine similarity that has not been visited yet.
-
-    Arguments:
-    visited_nodes -- List of nodes that have already been visited.
-    k -- Number of neighbors to consider (default is 1).
-
-    Returns:
-    The closest node with high entropy that has not been visited yet, or None if no such node is found.
-
-    Uses Neo4j Graph Data Science API to find the K-nearest neighbors based on cosine similarity.
-    """
-    visited_nodes_str = "'" + "', '".join(map(str, visited_nodes)) + "'"
-    # Use Neo4j Graph Data Science API to find the K-nearest neighbors
-    cosine_query = f"""
-        MATCH (q1:Flashcard), (q2:Flashcard)
-        WHERE NOT q1.id IN [{visited_nodes_str}] 
-        AND NOT q2.id IN [{visited_nodes_str}]
-        AND q1 <> q2
-        WITH q1, q2, gds.similarity.cosine(q1.embedding, q2.embedding) AS similarity
-        RETURN q1 as node1, q2 as node2, similarity
-        ORDER BY similarity DESC
-        LIMIT {k}
-        """
-    # print (cosine_query)
-    result = run_query(cosine_query)
-    if result:
-        # Return the closest node that has not been visited yet
-        return result[0]['node2'] if result[0]['node1'] in visited_nodes else result[0]['node1']
-    return None
-
-def query_one_node_with_id(flashcard_id):
+    n = len(snapshot)
+    visited = np.zeros(n, dtype=bool)
+    for node_id in visited_nodes:
+        position = snapshot.positions.get(node_id)
+        if position is not None:
+            visited[position] = True
+
+    # Flashcards with an entropy, highest first, for the start node and the fallback jumps
+    by_entropy = np.flatnonzero(snapshot.is_flashcard & ~np.isnan(snapshot.entropy))
+    by_entropy = by_entropy[np.argsort(-snapshot.entropy[by_entropy], kind='stable')]
+    if len(by_entropy) == 0:
+        logging.error("No starting node found.")
+        return ()
+    entropy = np.nan_to_num(snapshot.entropy, nan=0.0)
+    embedding_rows = np.full(n, -1, dtype=np.int64)
+    embedding_rows[snapshot.embedding_positions] = np.arange(len(snapshot.embedding_positions))
+    # Whether each embedded Flashcard can still be jumped to
+    available = ~visited[snapshot.embedding_positions]
+    # Every visited neighbour is skipped once, so the scan of a node resumes where it stopped
+    next_neighbour = snapshot.indptr[:-1].copy()
+    fallback = 0
+    plan = []
+
+    def visit(position):
+        visited[position] = True
+        if embedding_rows[position] >= 0:
+            available[embedding_rows[position]] = False
+        if snapshot.is_flashcard[position]:
+            plan.append(snapshot.ids[position])
+
+    node = by_entropy[0]
+    if not visited[node]:
+        visit(node)
+    while True:
+        end = snapshot.indptr[node + 1]
+        pointer = next_neighbour[node]
+        while pointer < end and visited[snapshot.indices[pointer]]:
+            pointer += 1
+        next_neighbour[node] = pointer
+        if pointer < end:
+            node = snapshot.indices[pointer]
+            visit(node)
+            continue
+
+        # The neighbourhood is exhausted, jump to a close unvisited node with high entropy
+        next_node = None
+        if index is not None and embedding_rows[node] >= 0:
+            results = index.search(snapshot.embeddings[embedding_rows[node]], k=k, mask=available)
+            if results:
+                next_node = max(results, key=lambda result: entropy[result[0]])[0]
+        if next_node is None:
+            while fallback < len(by_entropy) and visited[by_entropy[fallback]]:
+                fallback += 1
+            if fallback < len(by_entropy):
+                next_node = by_entropy[fallback]
+        if next_node is None:
+            break
+        node = next_node
+        visit(node)
+    return tuple(plan)
+
+
+def plan_learning_path(visited_nodes=(), k=3):
     """
-    Retrieves a single Flashcard node from the graph database based on the given flashcard_id.
+    Plans the entropy-guided learning path in memory.
 
-    This function constructs a Cypher query that matches Flashcard nodes excluding the one with the specified flashcard_id.
-    It then executes the query and returns the matched node.
+    The graph is loaded once per graph version as a `GraphSnapshot` and the whole walk is computed
+    in one pass over it, so the plan costs no database round trip per step. Plans are cached per
+    (graph version, visited set, k), so paging through a plan does not walk the graph again.
 
     Args:
-        flashcard_id (str): The identifier of the flashcard to exclude from the query.
-
-    Returns:
-        dict: The first matched Flashcard node, excluding the one with the specified id.
-
-    Logs:
-        Retrieves the node and logs the node id for debugging purposes.
-    """
-    query = f"""
-    MATCH (q:Flashcard)
-    WHERE NOT q.id = '{flashcard_id}' 
-    RETURN q as node
-    """
-    node = run_query(query)[0]['node']
-    logging.info(f"node retrieved is {node.id}")
-    return node
-
-def walk_with_entropy(k=3, visited_nodes=set(), starting_node_id='', logging=logging):
-    """
-    Conducts a walk-based exploration of nodes starting from a node with the highest entropy value or a specific starting node.
-
-    Arguments:
-    k: int (default: 3)
-        Number of nearest neighbors to consider when the neighborhood is exhausted.
-    visited_nodes: set
-        A set containing the IDs of the visited nodes.
-    starting_node_id: str
-        The ID of the starting node. If not provided, the function will select the node with the highest entropy.
-    logging: logging
-        Logger for information and error messages.
+        visited_nodes (iterable): Ids of the nodes that have already been visited.
+        k (int): Number of nearest unvisited neighbours considered when the neighbourhood is exhausted.
 
     Returns:
-    set
-        The set of visited node IDs.
-
-    Steps:
-    1. Identify the starting node either through highest entropy or a specific node ID.
-    2. Traverse the neighbors based on their entropy values.
-    3. Continue the traversal until there are no more nodes with high entropy to visit.
+        tuple: The ids of the Flashcards to study, in order, the already visited ones excluded.
     """
-    # Step 1: Find the node with the highest entropy
-    if not starting_node_id:
-        logging.info("Start from getting the node with highest entropy")
-        node = get_node_with_highest_entropy()
-        if not node:
-            logging.error("No starting node found.")
-            return visited_nodes
-    else:
-        node = query_one_node_with_id(starting_node_id)
-    visited_nodes.add(node['id'])
-
-    while True:
-        # Step 2: Get neighbors and walk based on entropy
-        neighbors = get_neighbors_with_entropy(node['id'])
-        if neighbors:
-            for neighbor in neighbors:
-                if neighbor['neighbor']['id'] not in visited_nodes:
-                    logging.info(f"Moving to node: {neighbor['neighbor']['id']} with entropy: {neighbor['entropy']}")
-                    visited_nodes.add(neighbor['neighbor']['id'])
-                    node = neighbor['neighbor']  # Move to the neighbor node
-                    break
-            else:
-                logging.info(f"Exhausted neighbors for node {node['id']}")
-                # Step 4: If the neighborhood is exhausted, use KNN to find the next closest node with high entropy
-                visited_ids = [visited_node["id"] for visited_node in visited_nodes]
-                next_node = find_closest_node_with_high_entropy(visited_ids, k)
-                if next_node:
-                    logging.info(f"Moving to closest node: {next_node['id']} with high entropy.")
-                    node = next_node
-                    visited_nodes.add(next_node['id'])
-                else:
-                    logging.info("No more nodes to visit.")
-                    break
-        else:
-            logging.info(f"Exhausted neighbors for node {node['id']}")
-            next_node = find_closest_node_with_high_entropy(visited_nodes, k)
-            if next_node:
-                logging.info(f"Moving to closest node: {next_node['id']} with high entropy.")
-                node = next_node
-                visited_nodes.add(next_node['id'])
-            else:
-                logging.info("No more nodes to visit.")
-                break
-    return visited_nodes
-
+    # The snapshot the shared vector index was built from, so the positions it returns are the snapshot's
+    snapshot, index = get_flashcard_index()
+    key = (snapshot.version, frozenset(visited_nodes), k)
+    with _plan_cache_lock:
+        if key in _plan_cache:
+            _plan_cache.move_to_end(key)
+            return _plan_cache[key]
+
+    plan = compute_learning_path(snapshot, key[1], k, index=index)
+    logging.warning(f"Planned a learning path of {len(plan)} flashcards for graph version {snapshot.version}")
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
@@ -1,27 +1,196 @@
 # utils.py
 # imports for the graph network
+import asyncio
+import os
+import threading
 import tomllib
+from collections import OrderedDict
 
-from neo4j_config.config import graph
+from backend.graph_backend import get_graph_backend
+from backend.graph_version import get_graph_version
+from backend.query_cache import SHARED, query_cache
+from backend.queries import QUERIES
 from fuzzywuzzy import fuzz
 import logging
-from pyvis.network import Network
-import networkx as nx
-# Function to run Cypher queries
-def run_query(query):
-    result = graph.query(query)
+
+# Set to 'true' to log how often the text of an executed query repeats a recent one
+QUERY_STATS_LOG = os.getenv('QUERY_STATS_LOG', 'false').lower() == 'true'
+# Number of executions between two logs of the query text counts
+QUERY_STATS_LOG_EVERY = int(os.getenv('QUERY_STATS_LOG_EVERY', 100))
+# Number of distinct query texts remembered, like Neo4j's default query cache size
+QUERY_TEXT_WINDOW = int(os.getenv('QUERY_TEXT_WINDOW', 1000))
+# Maximum number of seconds `gather_queries` waits for each query
+GATHER_TIMEOUT_SECONDS = float(os.getenv('GATHER_TIMEOUT_SECONDS', 60))
+
+
+class QueryTextStats:
+    """
+    Counts how often the executed query texts repeat, on the client side.
+
+    Only the distinct parameterised query texts are counted: an execution whose text is among the
+    `window` most recently used ones is a repeat. This hints at how well the queries lend
+    themselves to the database's plan cache, but it does not read the server's actual plan cache
+    hits or misses.
+
+    Attributes:
+    window (int): The number of distinct query texts remembered.
+    repeats (int): The number of executions whose text was among the remembered ones.
+    new_texts (int): The number of executions whose text was not.
+    """
+
+    def __init__(self, window=QUERY_TEXT_WINDOW):
+        self.window = window
+        self.repeats = 0
+        self.new_texts = 0
+        self._texts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, query) -> None:
+        """Counts the execution of a query text."""
+        with self._lock:
+            if query in self._texts:
+                self._texts.move_to_end(query)
+                self.repeats += 1
+            else:
+                self._texts[query] = None
+                self.new_texts += 1
+                while len(self._texts) > self.window:
+                    self._texts.popitem(last=False)
+            executions = self.repeats + self.new_texts
+        if executions % QUERY_STATS_LOG_EVERY == 0:
+            logging.warning(f"Query texts (client side, not the server plan cache): {self.stats()}")
+
+    def stats(self):
+        """Returns the number of repeated and new query texts, the distinct texts and the repeat rate."""
+        executions = self.repeats + self.new_texts
+        return {
+            'repeats': self.repeats,
+            'new_texts': self.new_texts,
+            'distinct_queries': len(self._texts),
+            'repeat_rate': self.repeats / executions if executions else 0.0,
+        }
+
+
+query_text_stats = QueryTextStats()
+
+
+# Function to run Cypher queries, values are passed as $parameters rather than inlined in the query
+# A `scope` of `backend.query_cache` reads the result through the query result cache
+def run_query(query, params=None, scope=None):
+    def load():
+        if QUERY_STATS_LOG:
+            query_text_stats.record(query)
+        return get_graph_backend().query(query, params or {})
+    return query_cache.get_or_load(scope, query, params, load)
+
+
+def run_named_query(name, params=None, scope=None):
+    """
+    Runs a query of the `backend.queries.QUERIES` registry on the configured graph backend.
+
+    Args:
+        name (str): The name of the query.
+        params (dict, optional): The values of the $parameters of the query.
+        scope (str, optional): `backend.query_cache.SHARED` or a session scope to read the result
+            through the query result cache, None to always run the query.
+
+    Returns:
+        list: The records of the query, as dictionaries.
+    """
+    def load():
+        backend = get_graph_backend()
+        if backend.supports_cypher:
+            return run_query(QUERIES[name], params)
+        return backend.run_named_query(name, params)
+    return query_cache.get_or_load(scope, name, params, load)
+
+
+async def run_query_async(query, params=None):
+    """Runs a Cypher query like `run_query`, on the asynchronous driver of the graph backend."""
+    if QUERY_STATS_LOG:
+        query_text_stats.record(query)
+    return await get_graph_backend().query_async(query, params or {})
+
+
+async def run_named_query_async(name, params=None, scope=None):
+    """Runs a query of the `backend.queries.QUERIES` registry like `run_named_query`, without blocking the event loop."""
+    if scope is not None:
+        cached, result = query_cache.get(scope, name, params)
+        if cached:
+            return result
+    version = get_graph_version()
+    backend = get_graph_backend()
+    if backend.supports_cypher:
+        result = await run_query_async(QUERIES[name], params)
+    else:
+        result = await backend.run_named_query_async(name, params)
+    if scope is not None:
+        query_cache.put(scope, name, params, result, version)
     return result
 
+
+_query_loop = None
+_query_loop_lock = threading.Lock()
+
+
+def get_query_loop():
+    """Returns the process-wide event loop running the asynchronous queries, started on first use in a daemon thread."""
+    global _query_loop
+    with _query_loop_lock:
+        if _query_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='graph-queries', daemon=True).start()
+            _query_loop = loop
+    return _query_loop
+
+
+def gather_queries(*calls, timeout=GATHER_TIMEOUT_SECONDS, executor=None, return_exceptions=False):
+    """
+    Runs independent queries at the same time from synchronous code and waits for all of them.
+
+    The Streamlit script runs in a thread without an event loop, so the queries run on the event
+    loop of `get_query_loop`, and a render waits for the slowest query instead of their sum.
+
+    Args:
+        calls: Coroutines, such as `run_named_query_async(...)`, or functions without arguments,
+            which run in the worker threads of the loop. A function must not call Streamlit.
+        timeout (float): The maximum number of seconds to wait for each call.
+        executor (concurrent.futures.Executor, optional): Runs the functions instead of the worker
+            threads of the loop, so slow calls such as LLM requests do not hold up the queries.
+        return_exceptions (bool): Returns the error of a failed or timed out call in place of its
+            result, instead of raising it and losing the results of the other calls.
+
+    Returns:
+        list: The result of every call, in the order of `calls`.
+
+    Raises:
+        Exception: The first error raised by a call, or TimeoutError, unless `return_exceptions` is set.
+    """
+    if not calls:
+        return []
+    loop = get_query_loop()
+    if threading.current_thread().name == 'graph-queries':
+        raise RuntimeError("gather_queries cannot wait on the query loop from the loop itself")
+
+    async def gather():
+        return await asyncio.gather(*(
+            asyncio.wait_for(call if asyncio.iscoroutine(call) else loop.run_in_executor(executor, call), timeout)
+            for call in calls
+        ), return_exceptions=return_exceptions)
+
+    return asyncio.run_coroutine_threadsafe(gather(), loop).result()
+
 # Interactive Graph Visualization using Pyvis
-def interactive_graph(st, display_batch=50):
+def interactive_graph(st, display_batch=50, edges=None):
     """
-    interactive_graph(st, display_batch=50)
+    interactive_graph(st, display_batch=50, edges=None)
 
     Displays an interactive graph visualization using Streamlit and Pyvis.
 
     Parameters:
     st: Streamlit module for displaying web elements.
     display_batch: Optional; Number of node relationships to fetch for graph display. Defaults to 50.
+    edges: Optional; The rows of the 'flashcard_edges' query, when the caller already read them.
 
     This function:
     1. Initializes a NetworkX graph.
@@ -31,18 +200,17 @@ def interactive_graph(st, display_batch=50):
     5. Initializes a Pyvis Network object with the NetworkX graph.
     6. Renders the graph for interactive visualization within a Streamlit web app.
     """
+    # pyvis and networkx are only loaded once the graph is shown
+    import networkx as nx
+    from pyvis.network import Network
+
     st.header("Explore the Graph Visually")
 
     # Create a NetworkX graph
     G = nx.Graph()
 
     # Get nodes and relationships from the graph database
-    query = f'''
-    MATCH (f:Flashcard)-[r]->(f2:Flashcard)
-    RETURN f.id AS from, f2.id AS to, r.type AS type
-    LIMIT {display_batch}
-    '''
-    results = run_query(query)
+    results = edges if edges is not None else run_named_query('flashcard_edges', {'limit': display_batch}, scope=SHARED)
 
     # Add nodes and edges to the graph
     for result in results:
@@ -52,13 +220,7 @@ def interactive_graph(st, display_batch=50):
 
     # Loading Single Nodes
     loaded_nodes = [node['from'] for node in results] + [node['to'] for node in results]
-    query = f"""
-    MATCH (f:Flashcard) 
-    Where not f.id in {loaded_nodes}
-    RETURN f.id As single_node
-    LIMIT {display_batch}
-    """
-    results = run_query(query)
+    results = run_named_query('unloaded_flashcards', {'ids': loaded_nodes, 'limit': display_batch}, scope=SHARED)
     for result in results:
         G.add_node(result['single_node'], label=result['single_node'])
 
@@ -99,24 +261,22 @@ def generate_hint_llm(llm, flashcard):
     return response.strip()
 
 
-def getting_hint(st, llm, flashcard, logging):
+def getting_hint(st, llm, flashcard, logging, hints=None):
     logging.warning("generating hints")
-    # Query for related flashcards
-    hint_query = f'''
-    MATCH (f:Flashcard)-[r]->(f2:Flashcard)
-    WHERE f.id = "{flashcard['id']}"
-    RETURN r.type AS relationship, f2.id AS related_id
-    LIMIT 1
-    '''
+    # Query for related flashcards, unless the hint was prefetched with the batch
     logging.warning("hint has been pressed")
-    hint_data = run_query(hint_query)
+    if hints and flashcard['id'] in hints:
+        hint_data = hints[flashcard['id']]
+    else:
+        # Imported here, the snapshot module runs its queries through this module
+        from backend.graph_snapshot import get_hint_relationship
+        hint_data = get_hint_relationship(flashcard['id'])
     if not hint_data:
         logging.warning("generating from llm")
         st.write("No related flashcards found, using LLM to generate")
         hint = generate_hint_llm(llm, flashcard)
     else:
         logging.warning("Generating from other source")
-        hint_data = hint_data[0]
         hint = f"This flashcard is related to {hint_data['related_id']}"
         if st.button("Generate another hint using LLM?", key=f"generate_hint"):
             hint = generate_hint_llm(llm, flashcard)
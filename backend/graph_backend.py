@@ -0,0 +1,560 @@
+"""
+Pluggable storage of the flashcard graph.
+
+The app reads the graph through the named queries of `backend.queries` and writes it through
+`BulkGraphWriter`, so a backend only has to run named queries and write buffered rows:
+
+- `Neo4jBackend` runs the Cypher of the registry on the Neo4j server of `neo4j_config`;
+- `SqliteBackend` stores the graph in a local SQLite file and answers every named query with SQL,
+  the embeddings being float32 blobs searched with NumPy, so a single-course deployment needs no
+  database server and no network hop.
+
+The backend is chosen with the GRAPH_BACKEND environment variable, 'neo4j' or 'sqlite'.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from backend.queries import QUERIES
+
+# Storage of the graph, 'neo4j' or 'sqlite'
+GRAPH_BACKEND = os.getenv('GRAPH_BACKEND', 'neo4j')
+# Database file of the sqlite backend
+SQLITE_GRAPH_PATH = os.getenv('SQLITE_GRAPH_PATH', '.cache/graph.sqlite3')
+
+
+class GraphBackend:
+    """
+    Interface of a graph storage.
+
+    Attributes:
+    name (str): The name of the backend, the value of GRAPH_BACKEND selecting it.
+    supports_cypher (bool): Whether arbitrary Cypher statements can be run with `query`.
+    """
+    name = ''
+    supports_cypher = False
+
+    def query(self, query, params=None):
+        """Runs a Cypher statement, only available when `supports_cypher` is True."""
+        raise NotImplementedError(f"The {self.name} backend does not run Cypher, use a named query")
+
+    def run_named_query(self, name, params=None):
+        """
+        Runs a query of the `backend.queries.QUERIES` registry.
+
+        Args:
+            name (str): The name of the query.
+            params (dict, optional): The values of the $parameters of the query.
+
+        Returns:
+            list: The records of the query, as dictionaries.
+        """
+        raise NotImplementedError
+
+    async def query_async(self, query, params=None):
+        """Runs a Cypher statement without blocking the event loop, in a worker thread by default."""
+        return await asyncio.to_thread(self.query, query, params)
+
+    async def run_named_query_async(self, name, params=None):
+        """Runs a query of the registry without blocking the event loop, in a worker thread by default."""
+        return await asyncio.to_thread(self.run_named_query, name, params)
+
+    def explain(self, query, params=None):
+        """
+        Plans a Cypher statement without running it, only available when `supports_cypher` is True.
+
+        Returns:
+            dict: The root operator of the plan, with its 'operatorType' and its 'children'.
+        """
+        raise NotImplementedError(f"The {self.name} backend does not run Cypher")
+
+    def warmup(self) -> None:
+        """Opens the connections of the backend ahead of the first query."""
+
+    def is_alive(self) -> bool:
+        """Returns whether the storage can be reached."""
+        return True
+
+    def write_rows(self, node_rows, relationship_rows, batch_size):
+        """
+        Upserts nodes and relationships in a single transaction.
+
+        Args:
+            node_rows (dict): Maps every label to dictionaries with the 'id' and 'properties' of its nodes.
+            relationship_rows (dict): Maps every (source label, relationship type, target label) to
+                dictionaries with the 'source' id, 'target' id and 'properties' of its relationships.
+            batch_size (int): The number of rows written in one statement.
+
+        Returns:
+            list: The latency, in milliseconds, of every batch.
+        """
+        raise NotImplementedError
+
+
+class Neo4jBackend(GraphBackend):
+    """The graph stored in Neo4j, queried with the Cypher of the registry."""
+    name = 'neo4j'
+    supports_cypher = True
+
+    def __init__(self, graph=None):
+        self._graph = graph
+
+    @property
+    def graph(self):
+        """The pooled Neo4j client of `neo4j_config`, created on first use."""
+        if self._graph is None:
+            from neo4j_config.config import get_graph
+            self._graph = get_graph()
+        return self._graph
+
+    def warmup(self) -> None:
+        self.graph.warmup()
+
+    def is_alive(self) -> bool:
+        return self.graph.is_alive()
+
+    def query(self, query, params=None):
+        return self.graph.query(query, params or {})
+
+    def run_named_query(self, name, params=None):
+        return self.query(QUERIES[name], params)
+
+    async def query_async(self, query, params=None):
+        return await self.graph.query_async(query, params or {})
+
+    async def run_named_query_async(self, name, params=None):
+        return await self.query_async(QUERIES[name], params)
+
+    def explain(self, query, params=None):
+        with self.graph._driver.session(database=self.graph._database) as session:
+            return session.run("EXPLAIN " + query, params or {}).consume().plan
+
+    def write_rows(self, node_rows, relationship_rows, batch_size):
+        # Imported here, the writer module depends on this one
+        from backend.graph_writer import node_merge_query, relationship_merge_query
+        statements = []
+        # Nodes are written before the relationships that reference them
+        for label, rows in node_rows.items():
+            for start in range(0, len(rows), batch_size):
+                statements.append((node_merge_query(label), rows[start:start + batch_size]))
+        for (source_label, rel_type, target_label), rows in relationship_rows.items():
+            for start in range(0, len(rows), batch_size):
+                statements.append((relationship_merge_query(source_label, rel_type, target_label),
+                                   rows[start:start + batch_size]))
+        latencies = []
+
+        def write(tx):
+            latencies.clear()
+            for query, rows in statements:
+                start = time.perf_counter()
+                tx.run(query, rows=rows).consume()
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        with self.graph._driver.session(database=self.graph._database) as session:
+            session.execute_write(write)
+        return latencies
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    label TEXT NOT NULL,
+    id TEXT NOT NULL,
+    properties TEXT NOT NULL DEFAULT '{}',
+    entropy REAL,
+    embedding BLOB,
+    PRIMARY KEY (label, id)
+);
+CREATE INDEX IF NOT EXISTS nodes_id ON nodes (id);
+CREATE INDEX IF NOT EXISTS nodes_entropy ON nodes (label, entropy);
+CREATE INDEX IF NOT EXISTS nodes_card_key ON nodes (json_extract(properties, '$.cardKey'));
+CREATE TABLE IF NOT EXISTS relationships (
+    source_label TEXT NOT NULL,
+    source TEXT NOT NULL,
+    type TEXT NOT NULL,
+    target_label TEXT NOT NULL,
+    target TEXT NOT NULL,
+    properties TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (source_label, source, type, target_label, target)
+);
+CREATE INDEX IF NOT EXISTS relationships_source ON relationships (source);
+CREATE INDEX IF NOT EXISTS relationships_target ON relationships (target);
+"""
+
+# The ids of a JSON list parameter, usable in `IN (...)`
+JSON_IDS = "SELECT value FROM json_each(?)"
+
+
+class SqliteBackend(GraphBackend):
+    """
+    The graph stored in a local SQLite database.
+
+    Nodes and relationships are rows keyed like the MERGE patterns of the Neo4j writer, their
+    properties a JSON column merged on upsert. Embeddings are float32 blobs, loaded into a NumPy
+    matrix once per graph version for the nearest neighbour queries.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_GRAPH_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # The connection is shared by the sessions and the ingest workers
+        self._lock = threading.RLock()
+        with self._lock, self._connection:
+            self._connection.executescript(SQLITE_SCHEMA)
+
+    def _rows(self, sql, args=()):
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, args)]
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._connection:
+            self._connection.execute(sql, args)
+        return []
+
+    @staticmethod
+    def _embedding(blob):
+        return np.frombuffer(blob, dtype=np.float32) if blob is not None else None
+
+    def run_named_query(self, name, params=None):
+        if name not in QUERIES:
+            raise KeyError(f"Unknown query {name}")
+        return getattr(self, f"_{name}")(**(params or {}))
+
+    def write_rows(self, node_rows, relationship_rows, batch_size):
+        latencies = []
+        with self._lock, self._connection:
+            for label, rows in node_rows.items():
+                for start in range(0, len(rows), batch_size):
+                    started = time.perf_counter()
+                    self._upsert_nodes(label, rows[start:start + batch_size])
+                    latencies.append((time.perf_counter() - started) * 1000)
+            for (source_label, rel_type, target_label), rows in relationship_rows.items():
+                for start in range(0, len(rows), batch_size):
+                    started = time.perf_counter()
+                    batch = rows[start:start + batch_size]
+                    # Like MERGE, the endpoints are created when they do not exist yet
+                    self._upsert_nodes(source_label, [{'id': row['source'], 'properties': {}} for row in batch])
+                    self._upsert_nodes(target_label, [{'id': row['target'], 'properties': {}} for row in batch])
+                    self._connection.executemany("""
+                    INSERT INTO relationships (source_label, source, type, target_label, target, properties)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (source_label, source, type, target_label, target)
+                    DO UPDATE SET properties = json_patch(relationships.properties, excluded.properties)
+                    """, [(source_label, row['source'], rel_type, target_label, row['target'],
+                           json.dumps(row['properties'] or {}, default=str)) for row in batch])
+                    latencies.append((time.perf_counter() - started) * 1000)
+        return latencies
+
+    def _upsert_nodes(self, label, rows):
+        values = []
+        for row in rows:
+            properties = dict(row['properties'] or {})
+            embedding = properties.pop('embedding', None)
+            blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+            values.append((label, row['id'], json.dumps(properties, default=str), blob))
+        self._connection.executemany("""
+        INSERT INTO nodes (label, id, properties, embedding) VALUES (?, ?, ?, ?)
+        ON CONFLICT (label, id) DO UPDATE SET
+            properties = json_patch(nodes.properties, excluded.properties),
+            embedding = coalesce(excluded.embedding, nodes.embedding)
+        """, values)
+
+    # Reads of the app
+
+    def _flashcard_edges(self, limit):
+        return self._rows("""
+        SELECT source AS "from", target AS "to", type
+        FROM relationships WHERE source_label = 'Flashcard' AND target_label = 'Flashcard'
+        LIMIT ?
+        """, (limit,))
+
+    def _unloaded_flashcards(self, ids, limit):
+        return self._rows(f"""
+        SELECT id AS single_node FROM nodes
+        WHERE label = 'Flashcard' AND id NOT IN ({JSON_IDS})
+        LIMIT ?
+        """, (json.dumps(list(ids)), limit))
+
+    def _count_flashcards(self):
+        return self._rows("SELECT COUNT(*) AS total_flashcards FROM nodes WHERE label = 'Flashcard'")
+
+    def _flashcards_by_id(self, ids):
+        return self._rows(f"""
+        SELECT json_extract(properties, '$.question') AS question, json_extract(properties, '$.answer') AS answer, id
+        FROM nodes WHERE label = 'Flashcard' AND id IN ({JSON_IDS})
+        """, (json.dumps(list(ids)),))
+
+    def _flashcard_embeddings(self):
+        rows = self._rows("""
+        SELECT id, json_extract(properties, '$.question') AS question,
+               json_extract(properties, '$.answer') AS answer, embedding
+        FROM nodes WHERE label = 'Flashcard' AND embedding IS NOT NULL
+        """)
+        for row in rows:
+            row['embedding'] = self._embedding(row['embedding'])
+        return rows
+
+    def _random_flashcards(self, ids, limit):
+        return self._rows(f"""
+        SELECT json_extract(properties, '$.question') AS question, json_extract(properties, '$.answer') AS answer, id
+        FROM nodes WHERE label = 'Flashcard' AND id NOT IN ({JSON_IDS})
+        ORDER BY random()
+        LIMIT ?
+        """, (json.dumps(list(ids)), limit))
+
+    def _flashcard_hint(self, id):
+        return self._rows("""
+        SELECT type AS relationship, target AS related_id
+        FROM relationships
+        WHERE source_label = 'Flashcard' AND source = ? AND target_label = 'Flashcard' AND type != 'Duplicate'
+        LIMIT 1
+        """, (id,))
+
+    def _related_flashcards(self, id):
+        return self._rows("""
+        SELECT n.id AS related_id, json_extract(n.properties, '$.question') AS question,
+               json_extract(n.properties, '$.answer') AS answer, r.type AS relationship
+        FROM relationships r JOIN nodes n ON n.label = 'Flashcard' AND n.id = r.target
+        WHERE r.source_label = 'Flashcard' AND r.source = ? AND r.target_label = 'Flashcard' AND r.type != 'Duplicate'
+        UNION ALL
+        SELECT n.id, json_extract(n.properties, '$.question'), json_extract(n.properties, '$.answer'),
+               r.type
+        FROM relationships r JOIN nodes n ON n.label = 'Flashcard' AND n.id = r.source
+        WHERE r.target_label = 'Flashcard' AND r.target = ? AND r.source_label = 'Flashcard' AND r.type != 'Duplicate'
+        """, (id, id))
+
+    def _duplicate_pairs(self):
+        return self._rows("""
+        SELECT source, target FROM relationships
+        WHERE source_label = 'Flashcard' AND type = 'Duplicate' AND target_label = 'Flashcard'
+        """)
+
+    def _metanode_names(self):
+        return self._rows("""
+        SELECT DISTINCT json_extract(properties, '$.name') AS metanode_name FROM nodes
+        WHERE label = 'Metanode' AND json_extract(properties, '$.name') IS NOT NULL
+        """)
+
+    def _snapshot_nodes(self):
+        rows = self._rows("""
+        SELECT id, label = 'Flashcard' AS flashcard, entropy,
+               json_extract(properties, '$.question') AS question, json_extract(properties, '$.answer') AS answer,
+               json_extract(properties, '$.name') AS name, CASE WHEN label = 'Flashcard' THEN embedding END AS embedding
+        FROM nodes WHERE label IN ('Flashcard', 'Metanode')
+        """)
+        for row in rows:
+            row['flashcard'] = bool(row['flashcard'])
+            row['embedding'] = self._embedding(row['embedding'])
+        return rows
+
+    def _snapshot_edges(self):
+        return self._rows("""
+        SELECT source, target, type FROM relationships
+        WHERE source_label IN ('Flashcard', 'Metanode') AND target_label IN ('Flashcard', 'Metanode')
+          AND type != 'Duplicate'
+        """)
+
+    # Writes and reads of the ingestion
+
+    def _delete_all(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM relationships")
+            self._connection.execute("DELETE FROM nodes")
+        return []
+
+    def _stored_fingerprints(self):
+        return self._rows("""
+        SELECT json_extract(properties, '$.cardKey') AS key, json_extract(properties, '$.cardHash') AS hash,
+               NULL AS mergedInto
+        FROM nodes WHERE label = 'Flashcard' AND json_extract(properties, '$.cardKey') IS NOT NULL
+        UNION ALL
+        SELECT merged.value, json_extract(n.properties, '$.mergedCardHashes[' || merged.key || ']'),
+               json_extract(n.properties, '$.cardKey')
+        FROM nodes n, json_each(n.properties, '$.mergedCardKeys') merged
+        WHERE n.label = 'Flashcard'
+        """)
+
+    def _forget_merged_cards(self, keys, cards):
+        cards = {tuple(card) for card in cards}
+        with self._lock, self._connection:
+            rows = self._connection.execute("""
+            SELECT id, json_extract(properties, '$.mergedCardKeys') AS merged_keys,
+                   json_extract(properties, '$.mergedCardHashes') AS merged_hashes
+            FROM nodes WHERE label = 'Flashcard' AND json_extract(properties, '$.mergedCardKeys') IS NOT NULL
+            """).fetchall()
+            for row in rows:
+                merged = list(zip(json.loads(row['merged_keys']), json.loads(row['merged_hashes'])))
+                kept = [card for card in merged if card not in cards]
+                if len(kept) == len(merged):
+                    continue
+                self._connection.execute("""
+                UPDATE nodes SET properties = json_set(properties, '$.mergedCardKeys', json(?),
+                                                      '$.mergedCardHashes', json(?), '$.mergedCards', ?)
+                WHERE label = 'Flashcard' AND id = ?
+                """, (json.dumps([key for key, _ in kept]), json.dumps([card_hash for _, card_hash in kept]),
+                      len(kept), row['id']))
+        return []
+
+    # The flashcards whose `[key, hash]` fingerprint is in the JSON array bound to the parameter
+    _FINGERPRINTED = f"""
+    SELECT id FROM nodes
+    WHERE label = 'Flashcard' AND json_array(json_extract(properties, '$.cardKey'),
+                                             coalesce(json_extract(properties, '$.cardHash'), '')) IN ({JSON_IDS})
+    """
+
+    def _card_neighbours(self, keys, cards):
+        cards = json.dumps([list(card) for card in cards])
+        return self._rows(f"""
+        WITH deleted AS ({self._FINGERPRINTED}), neighbour AS (
+            SELECT target_label AS label, target AS id FROM relationships
+            WHERE source_label = 'Flashcard' AND source IN deleted
+            UNION
+            SELECT source_label, source FROM relationships
+            WHERE target_label = 'Flashcard' AND target IN deleted
+        )
+        SELECT DISTINCT n.id FROM neighbour JOIN nodes n ON n.label = neighbour.label AND n.id = neighbour.id
+        WHERE n.label != 'Flashcard' OR n.id NOT IN deleted
+        """, (cards,))
+
+    def _delete_cards(self, keys, cards):
+        cards = json.dumps([list(card) for card in cards])
+        with self._lock, self._connection:
+            self._connection.execute(f"""
+            DELETE FROM relationships
+            WHERE (source_label = 'Flashcard' AND source IN ({self._FINGERPRINTED}))
+               OR (target_label = 'Flashcard' AND target IN ({self._FINGERPRINTED}))
+            """, (cards, cards))
+            self._connection.execute(f"DELETE FROM nodes WHERE label = 'Flashcard' AND id IN ({self._FINGERPRINTED})",
+                                     (cards,))
+        return []
+
+    def _delete_orphan_metanodes(self):
+        return self._execute("""
+        DELETE FROM nodes
+        WHERE label = 'Metanode'
+          AND NOT EXISTS (SELECT 1 FROM relationships WHERE source_label = 'Metanode' AND source = nodes.id)
+          AND NOT EXISTS (SELECT 1 FROM relationships WHERE target_label = 'Metanode' AND target = nodes.id)
+        """)
+
+    def _merge_duplicates(self, groups):
+        # Like apoc.refactor.mergeNodes with properties: 'discard' and mergeRels: true, the first card of
+        # every group is kept with its properties and the relationships of the copies are moved over
+        merged = 0
+        with self._lock, self._connection:
+            for group in groups:
+                kept = group[0]
+                rows = {row['id']: json.loads(row['properties']) for row in self._connection.execute(
+                    f"SELECT id, properties FROM nodes WHERE label = 'Flashcard' AND id IN ({JSON_IDS})",
+                    (json.dumps(list(group)),))}
+                copies = [card_id for card_id in dict.fromkeys(group[1:]) if card_id in rows and card_id != kept]
+                if kept not in rows or not copies:
+                    continue
+                # The fingerprints of the copies are kept, like in the Cypher of merge_duplicates
+                properties = rows[kept]
+                keys = list(properties.get('mergedCardKeys', []))
+                hashes = list(properties.get('mergedCardHashes', []))
+                for card_id in copies:
+                    if rows[card_id].get('cardKey') is not None:
+                        keys.append(rows[card_id]['cardKey'])
+                        hashes.append(rows[card_id].get('cardHash') or '')
+                for card_id in copies:
+                    keys.extend(rows[card_id].get('mergedCardKeys', []))
+                    hashes.extend(rows[card_id].get('mergedCardHashes', []))
+                self._connection.execute("""
+                UPDATE nodes SET properties = json_set(properties, '$.mergedCardKeys', json(?),
+                                                      '$.mergedCardHashes', json(?), '$.mergedCards', ?)
+                WHERE label = 'Flashcard' AND id = ?
+                """, (json.dumps(keys), json.dumps(hashes), len(keys), kept))
+
+                copy_ids = json.dumps(copies)
+                moved = f"""
+                (source_label = 'Flashcard' AND source IN ({JSON_IDS}))
+                OR (target_label = 'Flashcard' AND target IN ({JSON_IDS}))
+                """
+                # Relationships between the cards of the group would become loops, they are dropped
+                self._connection.execute(f"""
+                INSERT OR IGNORE INTO relationships (source_label, source, type, target_label, target, properties)
+                SELECT * FROM (
+                    SELECT source_label,
+                           CASE WHEN source_label = 'Flashcard' AND source IN ({JSON_IDS}) THEN ? ELSE source END AS source,
+                           type, target_label,
+                           CASE WHEN target_label = 'Flashcard' AND target IN ({JSON_IDS}) THEN ? ELSE target END AS target,
+                           properties
+                    FROM relationships WHERE {moved}
+                ) WHERE NOT (source_label = 'Flashcard' AND target_label = 'Flashcard' AND source = ? AND target = ?)
+                """, (copy_ids, kept, copy_ids, kept, copy_ids, copy_ids, kept, kept))
+                self._connection.execute(f"DELETE FROM relationships WHERE {moved}", (copy_ids, copy_ids))
+                self._connection.execute(f"DELETE FROM nodes WHERE label = 'Flashcard' AND id IN ({JSON_IDS})",
+                                         (copy_ids,))
+                merged += 1
+        return [{'merged': merged}]
+
+    def _relationship_type_counts(self, ids=None):
+        node_filter = f"AND n.id IN ({JSON_IDS})" if ids is not None else ''
+        args = (json.dumps(list(ids)),) if ids is not None else ()
+        counts = self._rows(f"""
+        SELECT n.label, n.id, r.type AS relType, COUNT(r.type) AS relCount
+        FROM nodes n LEFT JOIN relationships r
+          ON r.source_label = n.label AND r.source = n.id AND r.type != 'Duplicate'
+        WHERE n.label IN ('Flashcard', 'Metanode') {node_filter}
+        GROUP BY n.label, n.id, r.type
+        """, args)
+        totals = {(row['label'], row['id']): row['total'] for row in self._rows(f"""
+        SELECT n.label, n.id, COUNT(*) AS total
+        FROM nodes n JOIN relationships r
+          ON ((r.source_label = n.label AND r.source = n.id) OR (r.target_label = n.label AND r.target = n.id))
+         AND r.type != 'Duplicate'
+        WHERE n.label IN ('Flashcard', 'Metanode') {node_filter}
+        GROUP BY n.label, n.id
+        """, args)}
+        return [{'id': row['id'], 'labels': [row['label']], 'relCount': row['relCount'],
+                 'totalRels': totals.get((row['label'], row['id']), 0)} for row in counts]
+
+    def _relationship_type_counts_of(self, ids):
+        return self._relationship_type_counts(ids)
+
+    def _set_entropy(self, label, rows):
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE nodes SET entropy = ? WHERE label = ? AND id = ?",
+                                         [(row['entropy'], label, row['id']) for row in rows])
+        return []
+
+    def _set_flashcard_entropy(self, rows):
+        return self._set_entropy('Flashcard', rows)
+
+    def _set_metanode_entropy(self, rows):
+        return self._set_entropy('Metanode', rows)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_graph_backend():
+    """
+    Returns the process-wide graph backend selected by GRAPH_BACKEND.
+
+    Returns:
+        GraphBackend: The backend, created on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if GRAPH_BACKEND == 'neo4j':
+                    _backend = Neo4jBackend()
+                elif GRAPH_BACKEND == 'sqlite':
+                    _backend = SqliteBackend(SQLITE_GRAPH_PATH)
+                else:
+                    raise ValueError(f"Unknown graph backend {GRAPH_BACKEND}, expected 'neo4j' or 'sqlite'")
+                logging.warning(f"Using the {_backend.name} graph backend")
+    return _backend
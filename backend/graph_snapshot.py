@@ -0,0 +1,272 @@
+"""
+Read-only in-memory snapshot of the Flashcard graph, shared by every session.
+
+The Flashcard and Metanode nodes are loaded once per graph version and interned to consecutive
+integer positions, with their properties stored as columns indexed by position. The relationships
+are stored in compressed sparse row (CSR) form:
+
+- `indices[indptr[i]:indptr[i + 1]]` are the distinct targets of node `i` sorted by decreasing
+  entropy, which is what the entropy-guided walk follows;
+- `out_edges[out_indptr[i]:out_indptr[i + 1]]` and `in_edges[in_indptr[i]:in_indptr[i + 1]]` are
+  the relationships leaving and entering node `i`, grouped by relationship type.
+
+A snapshot is never modified once built. When the graph version changes, a new snapshot is loaded
+by one thread and swapped in with a single reference assignment, the other sessions keep reading
+the previous one meanwhile, so the read paths of every session are served from memory instead of
+one Cypher round trip per rerun.
+"""
+import logging
+import sys
+import threading
+
+import numpy as np
+
+from backend.functionality_util import gather_queries, run_named_query, run_named_query_async
+from backend.graph_version import get_graph_version
+from backend.query_cache import SHARED
+from backend.similarity_util import normalize_rows
+
+
+def _csr(keys, n, secondary=None):
+    """Returns the row pointers and the order of the rows grouping `keys`, then `secondary`, together."""
+    order = np.lexsort((secondary, keys)) if secondary is not None else np.argsort(keys, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=indptr[1:])
+    return indptr, order
+
+
+class GraphSnapshot:
+    """
+    An immutable snapshot of the Flashcard and Metanode nodes and their relationships.
+
+    Attributes:
+    ids (list): The id of the node at every position.
+    positions (dict): Maps every node id to its position.
+    is_flashcard (np.ndarray): Whether the node at every position is a Flashcard.
+    entropy (np.ndarray): The materialized entropy of every node, NaN when it is missing.
+    question (list): The question of the node at every position, None for Metanodes.
+    answer (list): The answer of the node at every position, None for Metanodes.
+    name (list): The name of the node at every position, None for Flashcards.
+    indptr (np.ndarray): The CSR row pointers of the distinct outgoing neighbours.
+    indices (np.ndarray): The positions of the distinct outgoing neighbours, highest entropy first.
+    relationship_types (list): The interned relationship types.
+    edge_source (np.ndarray): The source position of every relationship.
+    edge_target (np.ndarray): The target position of every relationship.
+    edge_type (np.ndarray): The index in `relationship_types` of the type of every relationship.
+    out_indptr (np.ndarray): The CSR row pointers of the relationships leaving every node.
+    out_edges (np.ndarray): The relationships leaving every node, grouped by type.
+    in_indptr (np.ndarray): The CSR row pointers of the relationships entering every node.
+    in_edges (np.ndarray): The relationships entering every node, grouped by type.
+    embedding_positions (np.ndarray): The positions of the Flashcard nodes that have an embedding.
+    embeddings (np.ndarray): The embeddings of those nodes scaled to unit length, one row per entry of
+        `embedding_positions`.
+    version (int): The graph version the snapshot was loaded from.
+    """
+
+    def __init__(self, nodes, edges, version=0):
+        """
+        Args:
+            nodes (list): Dictionaries with the 'id', 'flashcard' flag, 'entropy', 'question', 'answer',
+                'name' and 'embedding' of every node.
+            edges (list): Dictionaries with the 'source' id, 'target' id and 'type' of every relationship.
+            version (int): The graph version the rows were read at.
+        """
+        self.version = version
+        self.ids = []
+        self.positions = {}
+        self.question, self.answer, self.name = [], [], []
+        flashcard, entropy = [], []
+        embedding_positions, embeddings = [], []
+        for node in nodes:
+            if node['id'] is None or node['id'] in self.positions:
+                continue
+            position = len(self.ids)
+            node_id = sys.intern(node['id']) if isinstance(node['id'], str) else node['id']
+            self.positions[node_id] = position
+            self.ids.append(node_id)
+            flashcard.append(bool(node.get('flashcard')))
+            entropy.append(np.nan if node.get('entropy') is None else float(node['entropy']))
+            self.question.append(node.get('question'))
+            self.answer.append(node.get('answer'))
+            self.name.append(node.get('name'))
+            if node.get('embedding') is not None:
+                embedding_positions.append(position)
+                embeddings.append(node['embedding'])
+        n = len(self.ids)
+        self.is_flashcard = np.asarray(flashcard, dtype=bool)
+        self.entropy = np.asarray(entropy, dtype=np.float64)
+        self.embedding_positions = np.asarray(embedding_positions, dtype=np.int64)
+        self.embeddings = normalize_rows(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+        self.relationship_types = []
+        type_ids = {}
+        sources, targets, types = [], [], []
+        for edge in edges:
+            source, target = self.positions.get(edge['source']), self.positions.get(edge['target'])
+            if source is None or target is None:
+                continue
+            rel_type = edge.get('type')
+            if rel_type not in type_ids:
+                type_ids[rel_type] = len(self.relationship_types)
+                self.relationship_types.append(sys.intern(rel_type) if isinstance(rel_type, str) else rel_type)
+            sources.append(source)
+            targets.append(target)
+            types.append(type_ids[rel_type])
+        self.edge_source = np.asarray(sources, dtype=np.int64)
+        self.edge_target = np.asarray(targets, dtype=np.int64)
+        self.edge_type = np.asarray(types, dtype=np.int32)
+        self.out_indptr, self.out_edges = _csr(self.edge_source, n, self.edge_type)
+        self.in_indptr, self.in_edges = _csr(self.edge_target, n, self.edge_type)
+
+        # Distinct (source, target) pairs, like `RETURN DISTINCT neighbor`
+        pairs = np.unique(self.edge_source * max(n, 1) + self.edge_target)
+        pair_sources, pair_targets = pairs // max(n, 1), pairs % max(n, 1)
+        # Order every row by decreasing target entropy, missing entropy counting as 0
+        self.indptr, order = _csr(pair_sources, n, -np.nan_to_num(self.entropy[pair_targets], nan=0.0))
+        self.indices = pair_targets[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def neighbours(self, position):
+        """Returns the positions of the targets of a node's outgoing relationships, highest entropy first."""
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def relationships(self, position, direction='out', rel_type=None):
+        """
+        Lists the relationships of a node.
+
+        Args:
+            position (int): The position of the node.
+            direction (str): 'out', 'in' or 'both'.
+            rel_type (str, optional): Only the relationships of this type are listed.
+
+        Returns:
+            list: `(other node position, relationship type)` tuples.
+        """
+        edges = []
+        if direction in ('out', 'both'):
+            edges.extend((self.edge_target[edge], edge) for edge in
+                         self.out_edges[self.out_indptr[position]:self.out_indptr[position + 1]])
+        if direction in ('in', 'both'):
+            edges.extend((self.edge_source[edge], edge) for edge in
+                         self.in_edges[self.in_indptr[position]:self.in_indptr[position + 1]])
+        return [(int(other), self.relationship_types[self.edge_type[edge]]) for other, edge in edges
+                if rel_type is None or self.relationship_types[self.edge_type[edge]] == rel_type]
+
+
+def load_graph_snapshot():
+    """
+    Reads the Flashcard and Metanode nodes and their relationships from the graph database.
+
+    Returns:
+        GraphSnapshot: The snapshot of the current graph version.
+    """
+    version = get_graph_version()
+    # The nodes and the relationships are read at the same time
+    nodes, edges = gather_queries(run_named_query_async('snapshot_nodes'), run_named_query_async('snapshot_edges'))
+    return GraphSnapshot(nodes, edges, version=version)
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_graph_snapshot():
+    """
+    Returns the process-wide graph snapshot, reloading it when the graph version changed.
+
+    Only one thread reloads the snapshot. While it does, the other threads keep getting the
+    previous snapshot instead of waiting, except before the first snapshot is loaded.
+
+    Returns:
+        GraphSnapshot: The snapshot, shared by every session and never modified once built.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == get_graph_version():
+        return snapshot
+    if not _snapshot_lock.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if _snapshot is None or _snapshot.version != get_graph_version():
+            new_snapshot = load_graph_snapshot()
+            _snapshot = new_snapshot
+            logging.warning(f"Loaded a graph snapshot of {len(new_snapshot)} nodes and {len(new_snapshot.edge_type)} "
+                            f"relationships for graph version {new_snapshot.version}")
+        return _snapshot
+    finally:
+        _snapshot_lock.release()
+
+
+def get_hint_relationship(flashcard_id):
+    """
+    Finds a relationship from a flashcard to another flashcard, to hint at the answer.
+
+    Args:
+        flashcard_id (str): The id of the flashcard.
+
+    Returns:
+        dict: The 'relationship' type and the 'related_id' of the related flashcard, or None if there is none.
+    """
+    snapshot = get_graph_snapshot()
+    position = snapshot.positions.get(flashcard_id)
+    if position is None or not snapshot.is_flashcard[position]:
+        # The flashcard was written after the snapshot was loaded
+        rows = run_named_query('flashcard_hint', {'id': flashcard_id}, scope=SHARED)
+        return rows[0] if rows else None
+    for other, rel_type in snapshot.relationships(position, direction='out'):
+        if snapshot.is_flashcard[other]:
+            return {'relationship': rel_type, 'related_id': snapshot.ids[other]}
+    return None
+
+
+def get_related_flashcards(flashcard_id):
+    """
+    Lists the flashcards related to a flashcard in either direction.
+
+    Args:
+        flashcard_id (str): The id of the flashcard.
+
+    Returns:
+        list: A dictionary with the 'related_id', 'question', 'answer' and 'relationship' of every
+        relationship between the flashcard and another flashcard.
+    """
+    snapshot = get_graph_snapshot()
+    position = snapshot.positions.get(flashcard_id)
+    if position is None or not snapshot.is_flashcard[position]:
+        return run_named_query('related_flashcards', {'id': flashcard_id}, scope=SHARED)
+    return [{
+        'related_id': snapshot.ids[other],
+        'question': snapshot.question[other],
+        'answer': snapshot.answer[other],
+        'relationship': rel_type,
+    } for other, rel_type in snapshot.relationships(position, direction='both') if snapshot.is_flashcard[other]]
+
+
+def get_related_flashcards_of(flashcard_ids):
+    """
+    Lists the flashcards related to each of several flashcards, like `get_related_flashcards`.
+
+    The flashcards missing from the snapshot are read from the database at the same time.
+
+    Args:
+        flashcard_ids (list): The ids of the flashcards.
+
+    Returns:
+        list: The related flashcards of every id, in the order of `flashcard_ids`.
+    """
+    snapshot = get_graph_snapshot()
+    missing = [flashcard_id for flashcard_id in dict.fromkeys(flashcard_ids)
+               if flashcard_id not in snapshot.positions or not snapshot.is_flashcard[snapshot.positions[flashcard_id]]]
+    rows = gather_queries(*(run_named_query_async('related_flashcards', {'id': flashcard_id}, scope=SHARED) for flashcard_id in missing))
+    read = dict(zip(missing, rows))
+    return [read[flashcard_id] if flashcard_id in read else get_related_flashcards(flashcard_id)
+            for flashcard_id in flashcard_ids]
+
+
+def get_metanode_names():
+    """Returns the distinct names of the Metanodes, in the order they were loaded."""
+    snapshot = get_graph_snapshot()
+    names = (name for name, flashcard in zip(snapshot.name, snapshot.is_flashcard) if not flashcard and name)
+    return list(dict.fromkeys(names))
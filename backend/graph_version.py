@@ -0,0 +1,24 @@
+"""
+Write-version counter of the graph.
+
+Every write made by the ingestion code bumps the version, so in-process structures derived from
+the graph, such as vector indexes, snapshots and query results, can tell whether they are stale
+by comparing the version they were built from with the current one.
+"""
+import threading
+
+_version = 0
+_lock = threading.Lock()
+
+
+def get_graph_version() -> int:
+    """Returns the current write version of the graph."""
+    return _version
+
+
+def bump_graph_version() -> int:
+    """Marks the graph as changed and returns the new write version."""
+    global _version
+    with _lock:
+        _version += 1
+        return _version
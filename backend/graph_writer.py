@@ -0,0 +1,147 @@
+"""
+Bulk writer of extracted graph documents.
+
+Instead of one `add_graph_documents` call per chunk, the writer buffers the nodes and relationships
+of many chunks, groups them by label and relationship type, and writes them with parameterized
+`UNWIND` statements of `batch_size` rows, all the batches of a flush running in one transaction.
+The rows are written by the graph backend, see `backend.graph_backend`. A full buffer is written
+on its own, but the graph version is only bumped by `flush`, once per committed unit of work such as
+a window of chunks, so the caches are not invalidated by every partial write.
+"""
+import logging
+import os
+from collections import defaultdict
+
+from backend.graph_backend import get_graph_backend
+from backend.graph_version import bump_graph_version
+
+# Number of rows sent in one UNWIND statement
+GRAPH_WRITE_BATCH_SIZE = int(os.getenv('GRAPH_WRITE_BATCH_SIZE', 500))
+# Number of buffered rows after which the writer writes them on its own. Flashcard rows carry their
+# embedding, so the buffer is kept to a few batches for the memory of an ingest to stay flat
+GRAPH_WRITE_FLUSH_ROWS = int(os.getenv('GRAPH_WRITE_FLUSH_ROWS', 4 * GRAPH_WRITE_BATCH_SIZE))
+
+
+def escape_name(name: str) -> str:
+    """Quotes a label or relationship type so it can be used safely in a Cypher statement."""
+    return "`" + str(name).replace("`", "``") + "`"
+
+
+def node_merge_query(label):
+    return f"""
+    UNWIND $rows AS row
+    MERGE (n:{escape_name(label)} {{id: row.id}})
+    SET n += row.properties
+    """
+
+
+def relationship_merge_query(source_label, rel_type, target_label):
+    return f"""
+    UNWIND $rows AS row
+    MERGE (s:{escape_name(source_label)} {{id: row.source}})
+    MERGE (t:{escape_name(target_label)} {{id: row.target}})
+    MERGE (s)-[r:{escape_name(rel_type)}]->(t)
+    SET r += row.properties
+    """
+
+
+class BulkGraphWriter:
+    """
+    Buffers graph documents and writes them with batched UNWIND statements.
+
+    Attributes:
+    batch_size (int): The number of rows sent in one UNWIND statement.
+    flush_rows (int): The number of buffered rows after which `add_graph_documents` writes them.
+    rows_written (int): The number of node and relationship rows written so far.
+    batch_latencies (list): The latency, in milliseconds, of every batch written so far.
+    touched_ids (set): The ids of every node and of the endpoints of every relationship written so far, whose
+        entropy needs a refresh. New nodes without any relationship are included so they get an entropy of 0.
+    """
+
+    def __init__(self, batch_size=GRAPH_WRITE_BATCH_SIZE, flush_rows=GRAPH_WRITE_FLUSH_ROWS, backend=None):
+        self.batch_size = max(1, batch_size)
+        self.flush_rows = max(1, flush_rows)
+        self.backend = backend or get_graph_backend()
+        self.rows_written = 0
+        self.batch_latencies = []
+        self.touched_ids = set()
+        # label -> rows
+        self._node_rows = defaultdict(list)
+        # (source label, relationship type, target label) -> rows
+        self._relationship_rows = defaultdict(list)
+        self._buffered = 0
+        # Whether rows were written since the graph version was last bumped
+        self._unpublished = False
+
+    def add_graph_documents(self, graph_documents) -> None:
+        """
+        Buffers the nodes and relationships of graph documents, writing them when the buffer is full.
+
+        Args:
+            graph_documents (list): The GraphDocument objects to write.
+        """
+        for graph_document in graph_documents:
+            for node in graph_document.nodes:
+                self._node_rows[node.type].append({'id': node.id, 'properties': node.properties})
+            for rel in graph_document.relationships:
+                key = (rel.source.type, rel.type, rel.target.type)
+                self._relationship_rows[key].append({
+                    'source': rel.source.id,
+                    'target': rel.target.id,
+                    'properties': rel.properties,
+                })
+            self._buffered += len(graph_document.nodes) + len(graph_document.relationships)
+        self._flush_if_full()
+
+    def add_relationship_rows(self, source_label, rel_type, target_label, rows) -> None:
+        """
+        Buffers relationships that are not part of a graph document, writing them when the buffer is full.
+
+        Args:
+            source_label (str): The label of the source nodes.
+            rel_type (str): The type of the relationships.
+            target_label (str): The label of the target nodes.
+            rows (list): Dictionaries with the 'source' id, the 'target' id and the 'properties' of each relationship.
+        """
+        self._relationship_rows[(source_label, rel_type, target_label)].extend(rows)
+        self._buffered += len(rows)
+        self._flush_if_full()
+
+    def _flush_if_full(self):
+        if self._buffered >= self.flush_rows:
+            self._write()
+
+    def flush(self) -> None:
+        """Writes every buffered row, then bumps the graph version once for every row written since the last flush."""
+        self._write()
+        if self._unpublished:
+            bump_graph_version()
+            self._unpublished = False
+
+    def _write(self) -> None:
+        """Writes every buffered row in a single transaction."""
+        if not self._buffered:
+            return
+        latencies = self.backend.write_rows(self._node_rows, self._relationship_rows, self.batch_size)
+        self._unpublished = True
+
+        self.rows_written += self._buffered
+        self.batch_latencies.extend(latencies)
+        for rows in self._node_rows.values():
+            self.touched_ids.update(row['id'] for row in rows)
+        for rows in self._relationship_rows.values():
+            for row in rows:
+                self.touched_ids.update((row['source'], row['target']))
+        logging.warning(f"Wrote {self._buffered} rows in {len(latencies)} batches, "
+                        f"slowest batch took {max(latencies, default=0.0):.1f} ms")
+        self._node_rows.clear()
+        self._relationship_rows.clear()
+        self._buffered = 0
+
+    def stats(self):
+        """Returns the number of rows written and the per-batch latencies, in milliseconds."""
+        return {
+            'rows_written': self.rows_written,
+            'batches': len(self.batch_latencies),
+            'batch_latencies_ms': list(self.batch_latencies),
+        }
@@ -0,0 +1,116 @@
+"""
+Import-time profile of the app.
+
+Imports a module in a fresh interpreter with `python -X importtime` and reports the modules with the
+highest cumulative import time, which is what a Streamlit process pays before its first paint.
+A report can be saved and later runs compared with it, so an eager import of a heavy module shows up
+as a regression:
+
+    python -m backend.import_profile --save .cache/import_profile.json
+    python -m backend.import_profile --baseline .cache/import_profile.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Directory holding the app scripts, which import each other without the package prefix
+APP_PATH = os.path.join(ROOT_PATH, 'app')
+# A module is reported as a regression when it takes this many more milliseconds than in the baseline
+IMPORT_REGRESSION_MS = float(os.getenv('IMPORT_REGRESSION_MS', 50))
+
+
+def parse_import_times(stderr):
+    """
+    Parses the output of `python -X importtime`.
+
+    Args:
+        stderr (str): The standard error of the interpreter.
+
+    Returns:
+        dict: Maps every imported module to its cumulative import time in milliseconds.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            # The header line
+            continue
+        module = fields[2].strip()
+        times[module] = max(times.get(module, 0.0), int(fields[1]) / 1000)
+    return times
+
+
+def profile_imports(module='main'):
+    """
+    Imports a module in a fresh interpreter and measures the import time of every module it loads.
+
+    Args:
+        module (str): The module to import, the app entry point by default.
+
+    Returns:
+        dict: Maps every imported module to its cumulative import time in milliseconds.
+
+    Raises:
+        RuntimeError: If the module cannot be imported.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [APP_PATH, ROOT_PATH, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            env=env, cwd=ROOT_PATH, capture_output=True, text=True)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError(f"Importing {module} failed: {' '.join(errors[-3:])}")
+    return parse_import_times(result.stderr)
+
+
+def find_regressions(times, baseline, threshold_ms=IMPORT_REGRESSION_MS):
+    """
+    Compares import times with a baseline.
+
+    Args:
+        times (dict): The cumulative import time of every module, in milliseconds.
+        baseline (dict): The import times of the baseline.
+        threshold_ms (float): The increase from which a module is reported.
+
+    Returns:
+        list: `(module, milliseconds, baseline milliseconds)` tuples of the modules that got slower or
+        are newly imported, slowest first.
+    """
+    regressions = [(module, ms, baseline.get(module, 0.0)) for module, ms in times.items()
+                   if ms - baseline.get(module, 0.0) >= threshold_ms]
+    return sorted(regressions, key=lambda regression: regression[1], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reports the modules that take the longest to import.")
+    parser.add_argument('--module', default='main', help="The module to import, the app entry point by default.")
+    parser.add_argument('--top', type=int, default=25, help="The number of modules reported.")
+    parser.add_argument('--save', help="Writes the import times to this JSON file.")
+    parser.add_argument('--baseline', help="Compares the import times with this JSON file.")
+    args = parser.parse_args(argv)
+
+    times = profile_imports(args.module)
+    print(f"{'cumulative ms':>14}  module")
+    for module, ms in sorted(times.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{ms:14.1f}  {module}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(times, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(times, json.load(f))
+        for module, ms, baseline_ms in regressions:
+            print(f"Regression: {module} takes {ms:.1f} ms, {baseline_ms:.1f} ms in the baseline")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
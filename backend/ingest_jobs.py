@@ -0,0 +1,271 @@
+"""
+Background ingestion jobs with progress reporting and resume.
+
+Building a knowledge graph from a deck can take minutes, so instead of running inline in the
+Streamlit script the chunks are written to a job file and a worker thread extracts and stores them.
+The job state is checkpointed to disk after every committed window of chunks and before every
+post-processing stage, which lets the app poll the progress from a fragment, survive a browser
+refresh, and resume from the last committed chunk after a crash or a restart. A failed job is only
+resumed when it is retried. A resumed job runs the post-processing again over every chunk it stored,
+since its stages are idempotent. The chunks of a finished job are deleted, and only the states of the
+`INGEST_JOB_HISTORY` most recent finished jobs are kept.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from itertools import islice
+
+from langchain.schema import Document
+
+# Directory holding the state and the chunks of every job
+INGEST_JOB_PATH = os.getenv('INGEST_JOB_PATH', '.cache/jobs')
+# Number of worker threads running jobs, each job extracts its chunks concurrently on its own
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 1))
+# Number of finished jobs whose state is kept on disk, the older ones are deleted
+INGEST_JOB_HISTORY = int(os.getenv('INGEST_JOB_HISTORY', 20))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class IngestJobRunner:
+    """
+    Runs ingestion jobs from a local queue on worker threads.
+
+    Attributes:
+    path (str): The directory holding `<job id>.json`, the job state, and `<job id>.chunks.jsonl`, its chunks.
+    num_workers (int): The number of worker threads.
+    history (int): The number of finished jobs whose state is kept.
+    """
+
+    def __init__(self, path=INGEST_JOB_PATH, num_workers=INGEST_WORKERS, history=INGEST_JOB_HISTORY):
+        self.path = path
+        self.num_workers = max(1, num_workers)
+        self.history = max(1, history)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = {}
+        os.makedirs(path, exist_ok=True)
+        self._load_jobs()
+        for _ in range(self.num_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _state_file(self, job_id):
+        return os.path.join(self.path, f"{job_id}.json")
+
+    def _chunks_file(self, job_id):
+        return os.path.join(self.path, f"{job_id}.chunks.jsonl")
+
+    def _save(self, job):
+        tmp_path = self._state_file(job['id']) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._state_file(job['id']))
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(changes, updated=time.time())
+            self._save(job)
+
+    def _load_jobs(self):
+        """Reloads the jobs from disk and re-queues the ones that were interrupted."""
+        for file_name in sorted(os.listdir(self.path)):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, file_name)) as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ingest job file {file_name} could not be loaded: {e}")
+                continue
+            self._jobs[job['id']] = job
+        for job in sorted(self._jobs.values(), key=lambda job: job['created']):
+            if job['status'] in (QUEUED, RUNNING):
+                logging.warning(f"Resuming ingest job {job['id']} from chunk {job['next_chunk']}, "
+                                f"stage {job.get('stage', 'extract')}")
+                job['status'] = QUEUED
+                self._save(job)
+                self._queue.put(job['id'])
+        self._prune()
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _prune(self):
+        """Deletes the chunks of the jobs that are done, and every file of the finished jobs beyond the history."""
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job['status'] in (DONE, FAILED)),
+                              key=lambda job: job['created'], reverse=True)
+            for job in finished[self.history:]:
+                del self._jobs[job['id']]
+                self._remove_file(self._state_file(job['id']))
+                self._remove_file(self._chunks_file(job['id']))
+            for job in finished[:self.history]:
+                if job['status'] == DONE:
+                    self._remove_file(self._chunks_file(job['id']))
+
+    def submit(self, documents, topic, first_time_load=True, name='', mode='llm', stale_cards=()) -> str:
+        """
+        Queues an ingestion job.
+
+        The chunks are streamed to the job file before this returns, so the caller can close the
+        source file, and the extraction itself runs on a worker thread.
+
+        Args:
+            documents (iterable): The Document chunks to extract graph data from.
+            topic (str): The topic key used to retrieve example and result configurations from the example file.
+            first_time_load (bool): If True, existing nodes in the graph are deleted before the first chunk is
+                written, and the entropy and the schema are refreshed for the whole graph at the end.
+            name (str): A label for the job shown in the progress.
+            mode (str): The extractor used for the chunks, a key of EXTRACTORS, 'llm' or 'csv'.
+            stale_cards (list): The `(card key, content hash)` pairs of the stored cards the chunks
+                replace. They are kept in the job state and deleted once every chunk is stored, so
+                a failed job keeps them until it is retried with `retry`.
+
+        Returns:
+            str: The id of the job.
+        """
+        job_id = uuid.uuid4().hex
+        total = 0
+        with open(self._chunks_file(job_id), "w") as f:
+            for document in documents:
+                f.write(json.dumps(document.page_content) + "\n")
+                total += 1
+        job = {
+            'id': job_id,
+            'name': name or topic,
+            'topic': topic,
+            'first_time_load': first_time_load,
+            'mode': mode,
+            'stale_cards': [list(card) for card in stale_cards],
+            'status': QUEUED,
+            'next_chunk': 0,
+            'total': total,
+            # 'extract' until every chunk is stored, then the post-processing stage running
+            'stage': 'extract',
+            'error': None,
+            'created': time.time(),
+            'updated': time.time(),
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._save(job)
+        self._queue.put(job_id)
+        return job_id
+
+    def retry(self, job_id) -> bool:
+        """
+        Queues a failed job again, it resumes from its last committed chunk.
+
+        Args:
+            job_id (str): The id returned by `submit`.
+
+        Returns:
+            bool: Whether the job was queued, False when it is unknown or did not fail.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != FAILED:
+                return False
+            job.update(status=QUEUED, error=None, updated=time.time())
+            self._save(job)
+        logging.warning(f"Retrying ingest job {job_id} from chunk {job['next_chunk']}")
+        self._queue.put(job_id)
+        return True
+
+    def progress(self, job_id):
+        """
+        Returns the progress of a job.
+
+        Args:
+            job_id (str): The id returned by `submit`.
+
+        Returns:
+            dict: The job's 'status', the number of chunks 'done' and their 'total', its 'stage', its
+                'name' and its 'error' if it failed, or None when the job is unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {
+                'id': job['id'],
+                'name': job['name'],
+                'status': job['status'],
+                'done': job['next_chunk'],
+                'total': job['total'],
+                'stage': job.get('stage', 'extract'),
+                'error': job['error'],
+            }
+
+    def latest_job(self):
+        """Returns the id of the most recently created job, or None when there is none."""
+        with self._lock:
+            if not self._jobs:
+                return None
+            return max(self._jobs.values(), key=lambda job: job['created'])['id']
+
+    def _read_chunks(self, job_id, start):
+        with open(self._chunks_file(job_id)) as f:
+            for line in islice(f, start, None):
+                yield Document(page_content=json.loads(line))
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id):
+        # The ingest stack is loaded by the worker, the app does not pay for it until a job runs
+        from backend.knowledge_graph import EXTRACTORS, extract_and_store_graphs
+
+        with self._lock:
+            job = dict(self._jobs[job_id])
+        start = job['next_chunk']
+        self._update(job_id, status=RUNNING)
+        try:
+            extract_and_store_graphs(
+                self._read_chunks(job_id, start),
+                topic=job['topic'],
+                # The graph was already wiped before the first checkpoint, but a resumed rebuild still
+                # refreshes the whole graph, and post-processes the chunks stored before the interruption
+                first_time_load=job['first_time_load'] and start == 0,
+                rebuild=job['first_time_load'],
+                stored_before=start,
+                on_chunks_stored=lambda stored: self._update(job_id, next_chunk=start + stored),
+                on_stage=lambda stage: self._update(job_id, stage=stage),
+                extractor=EXTRACTORS[job.get('mode', 'llm')],
+                stale_cards=job.get('stale_cards', []),
+            )
+        except Exception as e:
+            logging.exception(f"Ingest job {job_id} failed")
+            self._update(job_id, status=FAILED, error=str(e))
+        else:
+            self._update(job_id, status=DONE)
+        self._prune()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_ingest_job_runner():
+    """Returns the process-wide job runner, starting it and resuming interrupted jobs on first use."""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = IngestJobRunner()
+        return _runner
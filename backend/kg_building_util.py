@@ -2,12 +2,8 @@
 This file is adopted and modified from
 https://github.com/tomasonjo/blogs/blob/master/llm/openaifunction_constructing_graph.ipynb?ref=blog.langchain.dev
 """
-from langchain.chains.openai_functions import (
-    create_openai_fn_chain,
-    create_structured_output_chain,
-)
 from langchain.prompts import ChatPromptTemplate
-from langchain_config.config import llm
+from langchain_config.config import get_llm
 
 from langchain_community.graphs.graph_document import (
     Node as BaseNode,
@@ -16,6 +12,15 @@ from langchain_community.graphs.graph_document import (
 )
 from typing import List, Dict, Any, Optional
 from langchain.pydantic_v1 import (Field, BaseModel)
+from functools import lru_cache
+import json
+import tiktoken
+
+# Context window, in tokens, of the extraction model
+EXTRACTION_CONTEXT_TOKENS = 16385
+# Expected number of output tokens for each input token of flashcards, the output repeats every card
+# as a node and adds the relationships and MetaNodes
+EXTRACTION_OUTPUT_RATIO = 3.0
 
 
 #
@@ -100,8 +105,13 @@ def map_to_base_relationship(rel: Relationship) -> BaseRelationship:
         source=source, target=target, type=rel.type, properties=properties
     )
 
-def get_extraction_chain(example, results):
-    prompt = ChatPromptTemplate.from_messages(
+# Bump whenever the extraction prompt or the KnowledgeGraph schema changes in a way the prompt text does not show
+EXTRACTION_PROMPT_VERSION = "1"
+
+
+def get_extraction_prompt(example, results):
+    """Builds the chat prompt used to extract a knowledge graph from a chunk of flashcards."""
+    return ChatPromptTemplate.from_messages(
         [(
           "system",
           f"""# Knowledge Graph Instructions for GPT-4
@@ -161,6 +171,91 @@ def get_extraction_chain(example, results):
             ("human", "Use the given format to extract information from the following input: {flashcard_question, flashcard_answer}"),
             ("human", "Tip: Make sure to answer in the correct format"),
         ])
-    return create_structured_output_chain(KnowledgeGraph, llm,  prompt, verbose=True)
 
 
+def get_prompt_text(prompt) -> str:
+    """Returns the raw templates of every message of a chat prompt, joined into a single string."""
+    templates = []
+    for message in prompt.messages:
+        message_prompt = getattr(message, "prompt", None)
+        templates.append(getattr(message_prompt, "template", None) or str(message))
+    return "\n".join(templates)
+
+
+def get_extraction_chain(example, results):
+    from langchain.chains.openai_functions import create_structured_output_chain
+    prompt = get_extraction_prompt(example, results)
+    return create_structured_output_chain(KnowledgeGraph, get_llm(),  prompt, verbose=True)
+
+
+def get_relationship_extraction_prompt():
+    """
+    Builds the compact prompt used when the flashcard nodes are created locally from a CSV deck.
+
+    Only the relationships between flashcards and the MetaNodes are asked for, and each flashcard
+    is referred to by a short handle, so the prompt and the response stay a fraction of the size of
+    the full extraction.
+    """
+    return ChatPromptTemplate.from_messages(
+        [(
+          "system",
+          """# Knowledge Graph Relationship Instructions
+              You are a professor linking the flashcards of a course into a knowledge graph.
+              Each input line is one flashcard: `handle: question -> answer`.
+              The flashcard nodes already exist, do NOT return them as nodes.
+              1. Relationships between flashcards: use the handle as the node id and "Flashcard" as the node type.
+                 Allowed Relationship: ["Causal", "Hierarchical", "Associative", "Temporal", "Comparison"]
+                 Only link flashcards that have a clear logical relationship.
+              2. MetaNodes: higher-level topics, returned as nodes of type "MetaNode" with an id ending in " MetaNode"
+                 and a "description" property. Every MetaNode must link to at least one flashcard handle
+                 with a "Defines" relationship.
+              Please condense your output to 1 long string instead of a formatted JSON file
+              """
+        ),
+            ("human", "Link the following flashcards: {flashcards}"),
+        ])
+
+
+def get_relationship_extraction_chain():
+    from langchain.chains.openai_functions import create_structured_output_chain
+    prompt = get_relationship_extraction_prompt()
+    return create_structured_output_chain(KnowledgeGraph, get_llm(), prompt, verbose=True)
+
+
+@lru_cache(maxsize=None)
+def get_token_encoding(model_name):
+    """Returns the tiktoken encoding of a model, falling back to cl100k_base for unknown models."""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name=None) -> int:
+    """Counts the tokens of a text with the encoding of the extraction model."""
+    return len(get_token_encoding(model_name or get_llm().model_name).encode(text))
+
+
+def get_chunk_token_budget(example, results,
+                           context_tokens=EXTRACTION_CONTEXT_TOKENS,
+                           output_ratio=EXTRACTION_OUTPUT_RATIO) -> int:
+    """
+    Computes how many flashcard tokens fit in one extraction call.
+
+    The system prompt, with its few-shot example, and the KnowledgeGraph function schema are
+    subtracted from the context window, and the rest is shared between the flashcards and the
+    output, which is expected to be `output_ratio` times longer than the flashcards.
+
+    Args:
+        example (str): The few-shot example input passed to the extraction prompt.
+        results (str): The few-shot example output passed to the extraction prompt.
+        context_tokens (int): The context window of the extraction model.
+        output_ratio (float): The expected number of output tokens per flashcard token.
+
+    Returns:
+        int: The maximum number of flashcard tokens to send in one chunk.
+    """
+    prompt_tokens = count_tokens(get_prompt_text(get_extraction_prompt(example, results)))
+    schema_tokens = count_tokens(json.dumps(KnowledgeGraph.schema()))
+    available = context_tokens - prompt_tokens - schema_tokens
+    return max(1, int(available / (1 + output_ratio)))
@@ -1,15 +1,50 @@
-from altair import selection
 
 from backend.kg_building_util import *
-from backend.functionality_util import toml_load, run_query
+from backend.functionality_util import toml_load, run_query, run_named_query
 from langchain.schema import Document
-from neo4j_config.config import graph
-from langchain_config.config import embedding_model
+from langchain_config.config import get_embedding_model, get_llm
+from backend.embedding_cache import embed_with_cache
+from backend.extraction_cache import extraction_key, get_extraction_cache
+from backend.graph_writer import BulkGraphWriter
+from backend.graph_version import bump_graph_version
+from backend.similarity_util import similar_pairs
+from backend.dedup_util import find_duplicate_groups
+from backend.entropy_util import refresh_node_entropy
+from backend.schema import ensure_schema
+from backend.deck_diff import (card_hash, card_key, diff_fingerprints, fingerprint_lines, normalize_card_text,
+                               parse_flashcard_line)
+from fuzzywuzzy import fuzz
 import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from langchain_community.graphs.graph_document import GraphDocument
 
 # Setting up path for examples
 EXAMPLE_PATH = 'assets/examples/example.toml'
+# Maximum number of chunks sent to the LLM at the same time
+MAX_CONCURRENT_EXTRACTIONS = int(os.getenv('MAX_CONCURRENT_EXTRACTIONS', 4))
+# Number of node texts sent in one call to the batch embedding API
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 256))
+# Maximum number of embedding batches in flight at the same time
+MAX_CONCURRENT_EMBEDDINGS = int(os.getenv('MAX_CONCURRENT_EMBEDDINGS', 2))
+# Number of times a failed embedding batch is retried before giving up
+EMBEDDING_MAX_RETRIES = 3
+# Minimum similarity between a node question and a flashcard line for the node to be tagged with the line's fingerprint
+FINGERPRINT_MATCH_THRESHOLD = 85
+# Maximum length of the id of a flashcard node created locally from its question
+CARD_ID_CHARS = 80
+# Maximum length of the question and of the answer sent to the LLM in the CSV fast path
+SUMMARY_CHARS = 120
+# Number of nearest neighbours considered per flashcard when inferring Associative relationships
+SIMILARITY_NEIGHBOURS = int(os.getenv('SIMILARITY_NEIGHBOURS', 5))
+# Minimum cosine similarity of two flashcard embeddings for an Associative relationship to be inferred
+SIMILARITY_THRESHOLD = float(os.getenv('SIMILARITY_THRESHOLD', 0.9))
+# What the ingest pipeline does with near-duplicate flashcards: 'link', 'merge', or '' to keep them as they are
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'link')
+# Minimum cosine similarity of two embeddings confirming a near-duplicate candidate
+DUPLICATE_THRESHOLD = float(os.getenv('DUPLICATE_THRESHOLD', 0.95))
 
 def get_node_embeddings(text: str):
     """
@@ -21,77 +56,640 @@ def get_node_embeddings(text: str):
     Returns:
     list: A list of embeddings generated by the API for the input text.
     """
-    # Generate embeddings for the node using the OpenAI Embeddings API
-    return embedding_model.embed_query(text)
+    # Generate embeddings for the node using the OpenAI Embeddings API, reading through the local cache
+    embedding_model = get_embedding_model()
+    return embed_with_cache([text], lambda texts: [embedding_model.embed_query(texts[0])],
+                            embedding_model.model)[0]
 
 
-def extract_and_store_graph(
-        document: Document,
-        topic,
-        first_time_load=True
-) -> None:
-    """
-    Extracts graph data from the provided document and stores the results in a graph database.
-
-    Arguments:
-    document: Document
-        An instance of the Document class containing the content from which the graph data will be extracted.
-    topic: str
-        The topic key used to retrieve example and result configurations from the example file.
-    first_time_load: bool, optional, default=True
-        Flag to indicate if this is the first time loading data into the graph. If True, existing nodes in the graph will be deleted before adding the new data.
-
-    Procedure:
-    1. Loads example configurations from a TOML file using the provided topic key.
-    2. Extracts graph data using OpenAI functions and invokes the extraction chain on the document's content.
-    3. Filters out nodes where both the question and the answer are missing.
-    4. Embeds nodes with text properties using a node embedding function.
-    5. Constructs a new graph document with nodes containing embeddings and their corresponding relationships.
-    6. If first_time_load is True, deletes all existing nodes in the graph before adding the new graph document.
+def get_batch_node_embeddings(texts, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    Generates embeddings for many texts, reading through the local embedding cache.
+
+    Only the texts missing from the cache are sent to the batch embedding API.
+
+    Args:
+        texts (list): The texts for which embeddings need to be generated.
+        batch_size (int): The number of texts sent in one API call.
+
+    Returns:
+        list: The embeddings, in the same order as `texts`.
+    """
+    return embed_with_cache(texts, lambda missing: embed_documents_in_batches(missing, batch_size=batch_size),
+                            get_embedding_model().model)
+
+
+def embed_documents_in_batches(texts, batch_size=EMBEDDING_BATCH_SIZE,
+                               max_workers=MAX_CONCURRENT_EMBEDDINGS,
+                               max_retries=EMBEDDING_MAX_RETRIES):
+    """
+    Generates embeddings for many texts using the batch endpoint of the OpenAI Embeddings API.
+
+    The texts are split into batches of `batch_size`, at most `max_workers` batches are in flight at
+    the same time, and only the batches that failed are retried, with an exponential backoff, so a
+    partial failure does not pay again for the batches that already succeeded.
+
+    Args:
+        texts (list): The texts for which embeddings need to be generated.
+        batch_size (int): The number of texts sent in one API call.
+        max_workers (int): The maximum number of API calls in flight at the same time.
+        max_retries (int): The number of times a failed batch is retried.
+
+    Returns:
+        list: The embeddings, in the same order as `texts`.
+
+    Raises:
+        Exception: The last error raised for a batch that still fails after `max_retries` retries.
+    """
+    batch_size = max(1, batch_size)
+    batches = {start: texts[start:start + batch_size] for start in range(0, len(texts), batch_size)}
+    embeddings = [None] * len(texts)
+    embedding_model = get_embedding_model()
+
+    def embed_batch(start):
+        try:
+            return start, embedding_model.embed_documents(batches[start]), None
+        except Exception as e:
+            return start, None, e
+
+    pending = list(batches)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                logging.warning(f"retrying {len(pending)} failed embedding batches, attempt {attempt}")
+                time.sleep(2 ** (attempt - 1))
+            failed = []
+            for start, batch_embeddings, error in executor.map(embed_batch, pending):
+                if error is not None:
+                    logging.warning(f"embedding batch starting at {start} failed: {error}")
+                    failed.append((start, error))
+                    continue
+                embeddings[start:start + len(batch_embeddings)] = batch_embeddings
+            pending = [start for start, _ in failed]
+            if not pending:
+                return embeddings
+    raise failed[-1][1]
+
+
+def get_node_text(node):
+    """
+    Builds the text embedded for a node from its question and answer properties.
+
+    Args:
+        node (Node): The node extracted by the LLM.
+
+    Returns:
+        str: The text to embed, or an empty string when both question and answer are missing.
+    """
+    # Check if question or answer exists
+    has_question = node.properties and len(node.properties) > 0 and node.properties[0].value
+    has_answer = node.properties and len(node.properties) > 1 and node.properties[1].value
+
+    node_text = ""
+    if has_question:
+        node_text += "question: " + node.properties[0].value
+    if has_answer:
+        node_text += " answer: " + node.properties[1].value
+    return node_text
+
+
+def load_topic_example(topic):
+    """
+    Loads the few-shot example and expected results for a topic from the example file.
+
+    Args:
+        topic (str): The topic key used to retrieve example and result configurations.
+
+    Returns:
+        tuple: The example input and the example results, empty strings if the topic is unknown.
     """
     example_file = toml_load(EXAMPLE_PATH)
-    # selected_example = example_file.get(topic, '')
     selected_example = example_file.get(topic, {})
-    example = selected_example.get('example', '' )
+    example = selected_example.get('example', '')
     results = selected_example.get('results', '')
+    return example, results
 
-    # Extract graph data using OpenAI functions
-    extract_chain = get_extraction_chain(example, results)
-    logging.warning(extract_chain)
 
-    data = extract_chain.invoke(document.page_content)['function']
+def extract_knowledge_graph(document: Document, example, results) -> KnowledgeGraph:
+    """
+    Runs the extraction chain on a chunk and keeps the nodes that have a question or an answer.
+
+    The structured output is read from the extraction cache when the same chunk was already extracted
+    with the same example, prompt and model, so only new or changed chunks reach the LLM.
+
+    Args:
+        document (Document): The chunk of flashcards from which the graph data will be extracted.
+        example (str): The few-shot example input passed to the extraction prompt.
+        results (str): The few-shot example output passed to the extraction prompt.
+
+    Returns:
+        KnowledgeGraph: The extracted nodes, without embeddings, and relationships.
+    """
+    data = invoke_cached_chain(document.page_content,
+                               get_extraction_prompt(example, results),
+                               lambda: get_extraction_chain(example, results),
+                               example, results)
 
     # Filter out nodes where both question and answer do not exist
-    filtered_nodes = []
-    for node in data.nodes:
-        # Check if question or answer exists
-        has_question = len(node.properties) > 0 and node.properties[0].value
-        has_answer = len(node.properties) > 1 and node.properties[1].value
-
-        if has_question or has_answer:
-            # If at least one exists, keep the node
-            node_text = ""
-            if has_question:
-                node_text += "question: " + node.properties[0].value
-            if has_answer:
-                node_text += " answer: " + node.properties[1].value
-
-            # Get the node embedding
-            embedding = get_node_embeddings(node_text)
-
-            # Store the node with its embedding
-            node.properties.append(Property(key='embedding', value=embedding))
-            filtered_nodes.append(node)
-
-    # Update the nodes with the filtered list
-    data.nodes = filtered_nodes
-
-    # Construct a graph document with the nodes containing embeddings
-    graph_document = GraphDocument(
+    data.nodes = [node for node in data.nodes if get_node_text(node)]
+    return data
+
+
+def invoke_cached_chain(content, prompt, get_chain, example='', results='') -> KnowledgeGraph:
+    """
+    Invokes a structured extraction chain, reading the output from the extraction cache when possible.
+
+    Args:
+        content (str): The input passed to the chain.
+        prompt (ChatPromptTemplate): The prompt of the chain, part of the cache key.
+        get_chain (callable): Builds the chain, only called on a cache miss.
+        example (str): The few-shot example input passed to the prompt, part of the cache key.
+        results (str): The few-shot example output passed to the prompt, part of the cache key.
+
+    Returns:
+        KnowledgeGraph: The structured output of the chain.
+    """
+    key = extraction_key(content, example, results, get_prompt_text(prompt),
+                         get_llm().model_name, EXTRACTION_PROMPT_VERSION)
+    cache = get_extraction_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        data = KnowledgeGraph.parse_raw(cached)
+    else:
+        # Extract graph data using OpenAI functions
+        extract_chain = get_chain()
+        logging.warning(extract_chain)
+
+        data = extract_chain.invoke(content)['function']
+        cache.put(key, data.json())
+    logging.info(f"Extraction cache stats {cache.stats()}")
+    return data
+
+
+def get_card_id(question: str) -> str:
+    """Builds the id of a flashcard node created locally from its question."""
+    question = " ".join(question.split())
+    if len(question) <= CARD_ID_CHARS:
+        return question
+    return question[:CARD_ID_CHARS].rstrip() + "..."
+
+
+def extract_csv_knowledge_graph(document: Document, example='', results='') -> KnowledgeGraph:
+    """
+    Builds the knowledge graph of a chunk of a `question,answer` CSV deck with a compact LLM call.
+
+    The Flashcard nodes, with their question and answer properties, are created locally from the
+    CSV lines. The LLM only receives a short handle and a truncated summary of every card and returns
+    the relationships between them and the MetaNodes, whose handles are then mapped back to the
+    flashcards, which cuts the prompt and response tokens of a deck by a large factor.
+
+    Args:
+        document (Document): The chunk of CSV lines, one `question,answer` flashcard per line.
+        example (str): Unused, accepted so the function can replace extract_knowledge_graph.
+        results (str): Unused, accepted so the function can replace extract_knowledge_graph.
+
+    Returns:
+        KnowledgeGraph: The flashcard nodes, without embeddings, the MetaNodes and the relationships.
+    """
+    nodes = {}
+    for line in document.page_content.splitlines():
+        question, answer = parse_flashcard_line(line)
+        if not question.strip() and not answer.strip():
+            continue
+        handle = f"c{len(nodes)}"
+        nodes[handle] = Node(id=get_card_id(question), type='Flashcard', properties=[
+            Property(key='question', value=question.strip()),
+            Property(key='answer', value=answer.strip()),
+        ])
+    if not nodes:
+        return KnowledgeGraph(nodes=[], rels=[])
+
+    def summarize(text):
+        text = " ".join(text.split())
+        return text if len(text) <= SUMMARY_CHARS else text[:SUMMARY_CHARS].rstrip() + "..."
+
+    compact_cards = "\n".join(
+        f"{handle}: {summarize(node.properties[0].value)} -> {summarize(node.properties[1].value)}"
+        for handle, node in nodes.items()
+    )
+    data = invoke_cached_chain(compact_cards, get_relationship_extraction_prompt(),
+                               get_relationship_extraction_chain)
+
+    def resolve(node):
+        # Map the handles back to the flashcard nodes, a flashcard with an unknown handle resolves to None
+        handle = node.id.strip().lower()
+        if handle in nodes or node.type.lower() == 'flashcard':
+            return nodes.get(handle)
+        return node
+
+    metanodes = [node for node in data.nodes
+                 if node.id.strip().lower() not in nodes and node.type.lower() != 'flashcard']
+    rels = []
+    for rel in data.rels:
+        source, target = resolve(rel.source), resolve(rel.target)
+        if source is None or target is None:
+            continue
+        rels.append(Relationship(source=source, target=target, type=rel.type, properties=rel.properties))
+    for node in metanodes:
+        # Keep the description first so it is used as the MetaNode's embedded text
+        node.properties = node.properties or [Property(key='description', value=node.id)]
+    return KnowledgeGraph(nodes=list(nodes.values()) + metanodes, rels=rels)
+
+
+def embed_knowledge_graphs(knowledge_graphs, batch_size=EMBEDDING_BATCH_SIZE) -> None:
+    """
+    Adds an embedding property to every node of the given knowledge graphs.
+
+    The node texts of all the graphs are collected first and embedded together in batches, so a deck
+    costs a handful of API calls instead of one call per flashcard.
+
+    Args:
+        knowledge_graphs (list): The KnowledgeGraph objects whose nodes are embedded in place.
+        batch_size (int): The number of texts sent in one API call.
+    """
+    nodes = [node for data in knowledge_graphs for node in data.nodes]
+    embeddings = get_batch_node_embeddings([get_node_text(node) for node in nodes], batch_size=batch_size)
+    for node, embedding in zip(nodes, embeddings):
+        # Store the node with its embedding
+        node.properties.append(Property(key='embedding', value=embedding))
+
+
+def to_graph_document(data: KnowledgeGraph, document: Document) -> GraphDocument:
+    """
+    Maps an extracted knowledge graph to the graph document stored in the graph database.
+
+    Args:
+        data (KnowledgeGraph): The extracted nodes, with their embeddings, and relationships.
+        document (Document): The chunk the graph data was extracted from.
+
+    Returns:
+        GraphDocument: The graph document ready to be stored.
+    """
+    return GraphDocument(
         nodes=[map_to_base_node(node) for node in data.nodes],
         relationships=[map_to_base_relationship(rel) for rel in data.rels],
         source=document
     )
-    if first_time_load:
-        graph.query("MATCH (n) DETACH DELETE n")
-    graph.add_graph_documents([graph_document])
+
+
+def tag_card_fingerprints(graph_document: GraphDocument) -> None:
+    """
+    Stores the fingerprint of its flashcard line on every Flashcard node of a graph document.
+
+    The LLM may reword the question of a card, so a node is matched to the line with the same
+    normalized question first, and otherwise to the most similar line of its chunk.
+
+    Args:
+        graph_document (GraphDocument): The graph document whose nodes are tagged in place with the
+            `cardKey` and `cardHash` properties.
+    """
+    lines = {}
+    for line in graph_document.source.page_content.splitlines():
+        question, answer = parse_flashcard_line(line)
+        if question:
+            lines[normalize_card_text(question)] = (question, answer)
+
+    for node in graph_document.nodes:
+        if node.type != 'Flashcard' or not node.properties.get('question'):
+            continue
+        node_question = normalize_card_text(str(node.properties['question']))
+        if node_question not in lines and lines:
+            best_match = max(lines, key=lambda line_question: fuzz.ratio(node_question, line_question))
+            if fuzz.ratio(node_question, best_match) < FINGERPRINT_MATCH_THRESHOLD:
+                continue
+            node_question = best_match
+        if node_question in lines:
+            question, answer = lines[node_question]
+            node.properties['cardKey'] = card_key(question)
+            node.properties['cardHash'] = card_hash(question, answer)
+
+
+def extract_and_store_graphs(
+        documents,
+        topic,
+        first_time_load=True,
+        max_workers=MAX_CONCURRENT_EXTRACTIONS,
+        on_chunks_stored=None,
+        extractor=extract_knowledge_graph,
+        link_similar=True,
+        dedup_mode=DEDUP_MODE,
+        stale_cards=(),
+        rebuild=None,
+        stored_before=0,
+        on_stage=None
+) -> dict:
+    """
+    Extracts graph data from a stream of chunks concurrently and stores the results in order.
+
+    The chunks are consumed lazily from `documents`, which may be a generator reading the deck from a
+    file, and sent to the LLM as soon as they are produced, at most `max_workers` at once, so the ingest
+    time scales with the concurrency limit rather than the number of chunks. Completed chunks are
+    gathered in the order of `documents` into windows of `2 * max_workers` chunks; the node texts of a
+    window are embedded in batches and the window is handed to a BulkGraphWriter, which writes the
+    nodes and relationships of its chunks with batched UNWIND statements, and the window is committed
+    before the next one is gathered. Only a bounded number of chunks is held in memory, and the optional wipe of the
+    existing graph happens once, before the first write, so it can never race with the other chunks.
+
+    Args:
+        documents (iterable): The Document chunks to extract graph data from.
+        topic (str): The topic key used to retrieve example and result configurations from the example file.
+        first_time_load (bool): If True, existing nodes in the graph are deleted before the new data is added.
+        max_workers (int): The maximum number of chunks extracted at the same time.
+        on_chunks_stored (callable, optional): Called with the number of chunks committed so far each
+            time a window is committed, which lets a caller checkpoint its progress.
+        extractor (callable): Extracts the KnowledgeGraph of one chunk, extract_knowledge_graph by default,
+            or extract_csv_knowledge_graph for the LLM-light path of `question,answer` CSV decks.
+        link_similar (bool): If True, once every chunk is stored, Associative relationships are inferred
+            between similar flashcards of the whole deck with link_similar_flashcards.
+        dedup_mode (str): How near-duplicate flashcards found by deduplicate_flashcards are handled once
+            every chunk is stored, 'link', 'merge', or an empty string to skip the stage.
+        stale_cards (list): The `(card key, content hash)` pairs of the cards the chunks replace, which
+            are deleted with `delete_cards` once every chunk is stored and before the duplicates and
+            similar flashcards are looked for.
+        rebuild (bool, optional): Whether the graph holds only this deck, so the entropy and the schema are
+            refreshed for the whole graph. Defaults to `first_time_load`, a resumed rebuild passes it
+            separately because it must not wipe the graph again.
+        stored_before (int): The number of chunks stored by an interrupted run of the same ingest. The
+            post-processing runs when they are not 0 even if no new chunk is stored.
+        on_stage (callable, optional): Called with the name of every post-processing stage before it
+            runs, 'delete_stale', 'deduplicate', 'link_similar', 'entropy' or 'schema', which lets a
+            caller report and checkpoint it.
+
+    Returns:
+        dict: The number of 'chunks' stored, plus the rows written and per-batch latencies of the writer.
+    """
+    example, results = load_topic_example(topic)
+    # The constraints turn the MERGE of every written node into an index lookup
+    ensure_schema()
+    max_workers = max(1, max_workers)
+    window_size = 2 * max_workers
+    stored_chunks = 0
+    wipe = first_time_load
+    writer = BulkGraphWriter()
+
+    def store_window(window):
+        nonlocal stored_chunks, wipe
+        knowledge_graphs = [data for _, data in window]
+        # The node texts of the whole window are embedded together in batches
+        embed_knowledge_graphs(knowledge_graphs)
+        graph_documents = [to_graph_document(data, doc) for doc, data in window]
+        for graph_document in graph_documents:
+            tag_card_fingerprints(graph_document)
+        if wipe:
+            run_named_query('delete_all')
+            bump_graph_version()
+            wipe = False
+        writer.add_graph_documents(graph_documents)
+        stored_chunks += len(graph_documents)
+        # Every window is committed on its own, so only one window of rows is ever buffered
+        writer.flush()
+        if on_chunks_stored is not None:
+            on_chunks_stored(stored_chunks)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Futures are kept in submission order, so the results are stored in the order of the documents
+        in_flight = deque()
+        window = []
+        for document in documents:
+            in_flight.append((document, executor.submit(extractor, document, example, results)))
+            if len(in_flight) >= window_size:
+                document, future = in_flight.popleft()
+                window.append((document, future.result()))
+            if len(window) >= window_size:
+                store_window(window)
+                window = []
+        while in_flight:
+            document, future = in_flight.popleft()
+            window.append((document, future.result()))
+        if window or wipe:
+            store_window(window)
+    writer.flush()
+    report = {'chunks': stored_chunks, **writer.stats()}
+    if rebuild is None:
+        rebuild = first_time_load
+    # The chunks stored before an interruption were never post-processed
+    stored_total = stored_before + stored_chunks
+
+    def stage(name):
+        if on_stage is not None:
+            on_stage(name)
+
+    if stale_cards:
+        stage('delete_stale')
+        delete_cards(stale_cards)
+    # Duplicates are handled first: merged copies are gone and linked copies are skipped by the
+    # similarity links, so a pair of duplicates is never also linked as Associative
+    if dedup_mode and stored_total:
+        stage('deduplicate')
+        report['duplicates'] = deduplicate_flashcards(mode=dedup_mode)
+    if link_similar and stored_total:
+        stage('link_similar')
+        report['inferred_relationships'] = link_similar_flashcards()
+    # Materialize the entropy used by the guided pathway, fully after a rebuild or a resumed ingest,
+    # whose nodes written before the interruption are not in the touched ids, incrementally otherwise
+    stage('entropy')
+    if rebuild or stored_before:
+        refresh_node_entropy()
+    elif writer.touched_ids:
+        refresh_node_entropy(writer.touched_ids)
+    if rebuild and stored_total:
+        stage('schema')
+        ensure_schema()
+    logging.warning(f"Stored {stored_chunks} chunks, {report['rows_written']} rows in {report['batches']} batches")
+    return report
+
+
+def link_similar_flashcards(k=SIMILARITY_NEIGHBOURS, threshold=SIMILARITY_THRESHOLD) -> int:
+    """
+    Connects similar flashcards across chunks with Associative relationships, without any LLM call.
+
+    Chunks are extracted separately, so the LLM never relates two cards of different chunks. The
+    stored Flashcard embeddings are loaded once, the top-k neighbours of every card are computed with
+    blocked NumPy matrix products, and the pairs above the similarity threshold are written as
+    Associative relationships in one bulk operation. Pairs already linked by a Duplicate relationship
+    are skipped, so a pair of duplicates does not count twice in the entropy.
+
+    Args:
+        k (int): The number of nearest neighbours considered per flashcard.
+        threshold (float): The minimum cosine similarity of a linked pair.
+
+    Returns:
+        int: The number of relationships written.
+    """
+    flashcards = run_named_query('flashcard_embeddings')
+    if len(flashcards) < 2:
+        return 0
+    pairs = similar_pairs([row['embedding'] for row in flashcards], k=k, threshold=threshold)
+    duplicates = {frozenset((row['source'], row['target'])) for row in run_named_query('duplicate_pairs')}
+    pairs = [(i, j, similarity) for i, j, similarity in pairs
+             if frozenset((flashcards[i]['id'], flashcards[j]['id'])) not in duplicates]
+    rows = [{
+        'source': flashcards[i]['id'],
+        'target': flashcards[j]['id'],
+        'properties': {'similarity': similarity, 'inferred': True,
+                       'description': 'The flashcards have similar content.'},
+    } for i, j, similarity in pairs]
+    writer = BulkGraphWriter()
+    writer.add_relationship_rows('Flashcard', 'Associative', 'Flashcard', rows)
+    writer.flush()
+    refresh_node_entropy(writer.touched_ids)
+    logging.warning(f"Inferred {len(rows)} Associative relationships from embeddings")
+    return len(rows)
+
+
+def deduplicate_flashcards(mode=DEDUP_MODE, threshold=DUPLICATE_THRESHOLD) -> int:
+    """
+    Finds near-duplicate flashcards and links or merges them.
+
+    Candidates are found with MinHash/LSH over the normalized question and answer, which scales
+    sub-quadratically with the deck size, and confirmed with the cosine similarity of the embeddings.
+    In 'link' mode every duplicate gets a Duplicate relationship from the card that is kept. In
+    'merge' mode the duplicates are merged into the card that is kept with apoc.refactor.mergeNodes,
+    which moves their relationships over. The card keys and hashes of the merged copies are kept on
+    the merged card, so an incremental ingest still sees their deck lines as unchanged.
+
+    Args:
+        mode (str): 'link' or 'merge'.
+        threshold (float): The minimum cosine similarity confirming a candidate pair.
+
+    Returns:
+        int: The number of duplicate flashcards found.
+    """
+    flashcards = run_named_query('flashcard_embeddings')
+    groups = find_duplicate_groups([(row['question'] or '', row['answer'] or '') for row in flashcards],
+                                   [row['embedding'] for row in flashcards],
+                                   similarity_threshold=threshold)
+    id_groups = [[flashcards[i]['id'] for i in group] for group in groups]
+    duplicates = sum(len(group) - 1 for group in id_groups)
+    if not id_groups:
+        return 0
+
+    if mode == 'merge':
+        run_named_query('merge_duplicates', {'groups': id_groups})
+        bump_graph_version()
+        # The merged relationships can touch any neighbour of the duplicates
+        refresh_node_entropy()
+    elif mode == 'link':
+        rows = [{
+            'source': group[0],
+            'target': duplicate,
+            'properties': {'description': 'The flashcards ask the same question.'},
+        } for group in id_groups for duplicate in group[1:]]
+        writer = BulkGraphWriter()
+        writer.add_relationship_rows('Flashcard', 'Duplicate', 'Flashcard', rows)
+        writer.flush()
+        refresh_node_entropy(writer.touched_ids)
+    else:
+        raise ValueError(f"Unknown deduplication mode {mode}, expected 'link' or 'merge'")
+    logging.warning(f"Found {duplicates} duplicate flashcards in {len(id_groups)} groups, mode {mode}")
+    return duplicates
+
+
+def get_stored_fingerprints():
+    """
+    Fetches the fingerprints of the flashcards stored in the graph.
+
+    Returns:
+        tuple: A dictionary mapping each stored card key to its content hash, and a dictionary mapping
+            the key of every copy merged into another card to the key of that card.
+    """
+    stored, merged_into = {}, {}
+    for row in run_named_query('stored_fingerprints'):
+        stored[row['key']] = row['hash']
+        if row['mergedInto'] is not None:
+            merged_into[row['key']] = row['mergedInto']
+    return stored, merged_into
+
+
+def delete_cards(cards) -> None:
+    """
+    Deletes the Flashcard nodes with the given fingerprints, their relationships, and the MetaNodes left without any flashcard.
+
+    A card is matched by its key and its content hash, so the card stored since for a changed deck
+    line, which has the same key, is not deleted with the card it replaces. The entropy of the
+    remaining neighbours of the deleted cards is refreshed.
+
+    Args:
+        cards (list): The `(card key, content hash)` pairs of the flashcards to delete.
+    """
+    cards = [[key, card_hash or ''] for key, card_hash in cards]
+    params = {'keys': sorted({key for key, _ in cards}), 'cards': cards}
+    neighbours = run_named_query('card_neighbours', params)
+    run_named_query('delete_cards', params)
+    # A changed or removed card may also be a copy merged into another card
+    run_named_query('forget_merged_cards', params)
+    run_named_query('delete_orphan_metanodes')
+    bump_graph_version()
+    refresh_node_entropy(row['id'] for row in neighbours)
+
+
+def prepare_incremental_ingest(lines):
+    """
+    Diffs a deck against the stored fingerprints.
+
+    Nothing is deleted yet: the stale cards are deleted once the lines replacing them are stored, so a
+    failed extraction does not lose them.
+
+    Args:
+        lines (iterable): The lines of the deck, one `question,answer` flashcard per line, for example an open file.
+
+    Returns:
+        tuple: The size of the delta, with the number of 'added', 'changed', 'removed' and 'unchanged'
+            cards, and of the unchanged cards 'restored' because they were merged into a stale card,
+            the lines that still need to be extracted, whether the graph must be rebuilt
+            because it holds no fingerprinted card yet, and the `(card key, content hash)` pairs of
+            the stored cards that were removed or changed, to pass to `delete_cards`.
+    """
+    stored, merged_into = get_stored_fingerprints()
+    fingerprints = fingerprint_lines(line.rstrip('\r\n') for line in lines)
+    delta = diff_fingerprints(fingerprints, stored)
+    stale_keys = set(delta['removed'] + delta['changed_keys'])
+    # The copies merged into a stale card are deleted with it, the ones whose line is still in the
+    # deck are extracted again so they are not lost
+    restored = [fingerprints[key][1] for key, kept_key in merged_into.items()
+                if kept_key in stale_keys and key not in stale_keys and key in fingerprints]
+    report = {
+        'added': len(delta['added']),
+        'changed': len(delta['changed']),
+        'removed': len(delta['removed']),
+        'unchanged': delta['unchanged'],
+        'restored': len(restored),
+    }
+    stale_cards = [(key, stored[key]) for key in delta['removed'] + delta['changed_keys']]
+    # Without any stored fingerprint the graph holds a deck loaded before fingerprinting, rebuild it
+    return report, delta['added'] + delta['changed'] + restored, not stored, stale_cards
+
+
+def ingest_deck_incrementally(lines, topic, text_splitter, max_workers=MAX_CONCURRENT_EXTRACTIONS) -> dict:
+    """
+    Updates the graph with only the flashcards that were added, changed or removed since the last load.
+
+    Each flashcard line is fingerprinted and compared with the fingerprints stored on the Flashcard
+    nodes. The added and changed lines are extracted and merged into the graph, then the removed
+    cards and the previous versions of the changed ones are deleted with their relationships, so
+    fixing a typo costs one card's extraction instead of a full rebuild. When the graph holds no
+    fingerprinted card yet, the deck is loaded from scratch.
+
+    Args:
+        lines (iterable): The lines of the deck, one `question,answer` flashcard per line, for example an open file.
+        topic (str): The topic key used to retrieve example and result configurations from the example file.
+        text_splitter (LineTextSplitter): The splitter used to chunk the lines that need to be extracted.
+        max_workers (int): The maximum number of chunks extracted at the same time.
+
+    Returns:
+        dict: The size of the delta, with the number of 'added', 'changed', 'removed' and 'unchanged' cards.
+    """
+    report, changed_lines, rebuild, stale_cards = prepare_incremental_ingest(lines)
+    logging.warning(f"Incremental ingest delta for {topic}: {report}")
+    if changed_lines or stale_cards:
+        documents = text_splitter.lazy_split_documents(changed_lines)
+        extract_and_store_graphs(documents, topic=topic, first_time_load=rebuild, max_workers=max_workers,
+                                 stale_cards=stale_cards)
+    return report
+
+
+# Extraction functions selectable by name, for callers that persist the choice such as ingestion jobs
+EXTRACTORS = {
+    'llm': extract_knowledge_graph,
+    'csv': extract_csv_knowledge_graph,
+}
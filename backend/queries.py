@@ -0,0 +1,176 @@
+"""
+Named Cypher queries of the app.
+
+Every value is passed as a $parameter, never formatted into the text, so a query has the same text
+on every call: the database parses and plans it once and reuses the cached plan afterwards, and ids
+coming from the session cannot change the meaning of the statement.
+
+The type of a relationship is always read from its label, `type(r)`, like in the graph snapshot,
+so a flashcard gets the same relationship types whether it is served from the snapshot or not.
+"""
+
+QUERIES = {
+    # Relationships between flashcards, for the graph visualization
+    'flashcard_edges': """
+    MATCH (f:Flashcard)-[r]->(f2:Flashcard)
+    RETURN f.id AS from, f2.id AS to, type(r) AS type
+    LIMIT $limit
+    """,
+    # Flashcards that are not in a list of ids, for the graph visualization
+    'unloaded_flashcards': """
+    MATCH (f:Flashcard)
+    WHERE NOT f.id IN $ids
+    RETURN f.id AS single_node
+    LIMIT $limit
+    """,
+    'count_flashcards': """
+    MATCH (f:Flashcard)
+    RETURN COUNT(f) AS total_flashcards
+    """,
+    'flashcards_by_id': """
+    MATCH (q1:Flashcard)
+    WHERE q1.id IN $ids
+    RETURN q1.question AS question, q1.answer AS answer, q1.id AS id
+    """,
+    'flashcard_embeddings': """
+    MATCH (f:Flashcard)
+    WHERE f.embedding IS NOT NULL
+    RETURN f.id AS id, f.question AS question, f.answer AS answer, f.embedding AS embedding
+    """,
+    'random_flashcards': """
+    MATCH (f:Flashcard)
+    WITH f, rand() AS randomValue
+    WHERE NOT f.id IN $ids
+    RETURN f.question AS question, f.answer AS answer, f.id AS id
+    ORDER BY randomValue
+    LIMIT $limit
+    """,
+    # Duplicate relationships link near-identical cards, they are left out of the hints, the related
+    # flashcards, the snapshot walked by the learning path and the entropy
+    'flashcard_hint': """
+    MATCH (f:Flashcard)-[r]->(f2:Flashcard)
+    WHERE f.id = $id AND type(r) <> 'Duplicate'
+    RETURN type(r) AS relationship, f2.id AS related_id
+    LIMIT 1
+    """,
+    'related_flashcards': """
+    MATCH (f:Flashcard)-[r]-(f2:Flashcard)
+    WHERE f.id = $id AND type(r) <> 'Duplicate'
+    RETURN f2.id AS related_id, f2.question AS question, f2.answer AS answer, type(r) AS relationship
+    """,
+    'metanode_names': """
+    MATCH (m:Metanode)
+    WHERE m.name IS NOT NULL
+    RETURN DISTINCT m.name AS metanode_name
+    """,
+    'snapshot_nodes': """
+    MATCH (n)
+    WHERE n:Flashcard OR n:Metanode
+    RETURN n.id AS id, n:Flashcard AS flashcard, n.entropy AS entropy,
+           n.question AS question, n.answer AS answer, n.name AS name,
+           CASE WHEN n:Flashcard THEN n.embedding END AS embedding
+    """,
+    'snapshot_edges': """
+    MATCH (n)-[r]->(m)
+    WHERE (n:Flashcard OR n:Metanode) AND (m:Flashcard OR m:Metanode) AND type(r) <> 'Duplicate'
+    RETURN n.id AS source, m.id AS target, type(r) AS type
+    """,
+    # Writes and reads of the ingestion
+    'delete_all': """
+    MATCH (n)
+    DETACH DELETE n
+    """,
+    # Pairs of flashcards already linked as duplicates, which are not linked again as similar
+    'duplicate_pairs': """
+    MATCH (f:Flashcard)-[:Duplicate]->(f2:Flashcard)
+    RETURN f.id AS source, f2.id AS target
+    """,
+    # The fingerprints of the flashcards, and of the copies merged into them by merge_duplicates with
+    # the key of the card they were merged into
+    'stored_fingerprints': """
+    MATCH (f:Flashcard)
+    WHERE f.cardKey IS NOT NULL
+    RETURN f.cardKey AS key, f.cardHash AS hash, null AS mergedInto
+    UNION ALL
+    MATCH (f:Flashcard)
+    WHERE f.mergedCards > 0
+    UNWIND range(0, f.mergedCards - 1) AS i
+    RETURN f.mergedCardKeys[i] AS key, f.mergedCardHashes[i] AS hash, f.cardKey AS mergedInto
+    """,
+    # The neighbours of the flashcards with the fingerprints $cards, `[key, hash]` pairs whose keys are
+    # $keys, that are not deleted with them. A card rewritten since with another hash is not matched
+    'card_neighbours': """
+    MATCH (f:Flashcard)--(neighbour)
+    WHERE f.cardKey IN $keys AND [f.cardKey, coalesce(f.cardHash, '')] IN $cards
+      AND (neighbour.cardKey IS NULL OR NOT [neighbour.cardKey, coalesce(neighbour.cardHash, '')] IN $cards)
+    RETURN DISTINCT neighbour.id AS id
+    """,
+    'delete_cards': """
+    MATCH (f:Flashcard)
+    WHERE f.cardKey IN $keys AND [f.cardKey, coalesce(f.cardHash, '')] IN $cards
+    DETACH DELETE f
+    """,
+    # Removes the fingerprints $cards from the fingerprints kept for merged copies
+    'forget_merged_cards': """
+    MATCH (f:Flashcard)
+    WHERE any(key IN f.mergedCardKeys WHERE key IN $keys)
+    WITH f, [i IN range(0, size(f.mergedCardKeys) - 1)
+             WHERE NOT [f.mergedCardKeys[i], f.mergedCardHashes[i]] IN $cards] AS kept
+    SET f.mergedCardKeys = [i IN kept | f.mergedCardKeys[i]],
+        f.mergedCardHashes = [i IN kept | f.mergedCardHashes[i]],
+        f.mergedCards = size(kept)
+    """,
+    'delete_orphan_metanodes': """
+    MATCH (m:Metanode)
+    WHERE NOT (m)--()
+    DELETE m
+    """,
+    # Merges every group of ids of $groups into its first flashcard. The properties of the copies are
+    # discarded, except their fingerprints, kept on the merged card so an incremental ingest still
+    # finds their deck lines
+    'merge_duplicates': """
+    UNWIND $groups AS group
+    CALL {
+        WITH group
+        UNWIND range(0, size(group) - 1) AS position
+        MATCH (f:Flashcard {id: group[position]})
+        WITH f ORDER BY position
+        RETURN collect(f) AS nodes
+    }
+    WITH nodes, head(nodes) AS kept, [copy IN tail(nodes) WHERE copy.cardKey IS NOT NULL] AS copies
+    SET kept.mergedCardKeys = coalesce(kept.mergedCardKeys, []) + [copy IN copies | copy.cardKey] +
+            reduce(keys = [], copy IN tail(nodes) | keys + coalesce(copy.mergedCardKeys, [])),
+        kept.mergedCardHashes = coalesce(kept.mergedCardHashes, []) + [copy IN copies | coalesce(copy.cardHash, '')] +
+            reduce(hashes = [], copy IN tail(nodes) | hashes + coalesce(copy.mergedCardHashes, []))
+    SET kept.mergedCards = size(kept.mergedCardKeys)
+    WITH nodes
+    CALL apoc.refactor.mergeNodes(nodes, {properties: 'discard', mergeRels: true}) YIELD node
+    RETURN count(node) AS merged
+    """,
+    # The number of outgoing relationships per type and the total number of relationships of every node
+    'relationship_type_counts': """
+    MATCH (n:Flashcard|Metanode)
+    OPTIONAL MATCH (n)-[r]->()
+    WHERE type(r) <> 'Duplicate'
+    WITH n, type(r) AS relType, count(r) AS relCount
+    RETURN n.id AS id, labels(n) AS labels, relCount, COUNT { (n)-[r]-() WHERE type(r) <> 'Duplicate' } AS totalRels
+    """,
+    'relationship_type_counts_of': """
+    MATCH (n:Flashcard|Metanode)
+    WHERE n.id IN $ids
+    OPTIONAL MATCH (n)-[r]->()
+    WHERE type(r) <> 'Duplicate'
+    WITH n, type(r) AS relType, count(r) AS relCount
+    RETURN n.id AS id, labels(n) AS labels, relCount, COUNT { (n)-[r]-() WHERE type(r) <> 'Duplicate' } AS totalRels
+    """,
+    'set_flashcard_entropy': """
+    UNWIND $rows AS row
+    MATCH (n:Flashcard {id: row.id})
+    SET n.entropy = row.entropy
+    """,
+    'set_metanode_entropy': """
+    UNWIND $rows AS row
+    MATCH (n:Metanode {id: row.id})
+    SET n.entropy = row.entropy
+    """,
+}
@@ -0,0 +1,168 @@
+"""
+Read-through cache of query results, invalidated by the graph write version.
+
+Every entry is keyed by its scope, the name of the query, its parameters and the graph version it
+was read at. The scope is either `SHARED`, for results that are the same for every student, or the
+scope of the current Streamlit session, for results that must stay stable across the reruns of one
+session only, such as a random batch. When ingestion bumps the graph version, the entries of the
+previous versions can no longer be hit and are dropped, so a student moving to the next flashcard
+never has to clear the cache of the other sessions.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from backend.graph_version import get_graph_version
+
+# Maximum number of results the cache holds
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', 1024))
+# Maximum number of rows the cache holds over all its results, larger results are not cached
+QUERY_CACHE_MAX_ROWS = int(os.getenv('QUERY_CACHE_MAX_ROWS', 100000))
+
+# Scope of the results shared by every session
+SHARED = 'shared'
+
+
+def freeze(value):
+    """Turns query parameters into a hashable value, sets being ordered so equal sets give equal keys."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted((freeze(item) for item in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def session_scope():
+    """
+    Returns the cache scope of the current Streamlit session.
+
+    Returns:
+        str: The scope, or None outside of a Streamlit script run, in which case nothing is cached.
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return f"session:{ctx.session_id}" if ctx is not None else None
+
+
+class QueryResultCache:
+    """
+    LRU cache of query results keyed by scope, query name, parameters and graph version.
+
+    Attributes:
+    max_entries (int): The maximum number of cached results.
+    max_rows (int): The maximum number of rows over all the cached results.
+    hits (int): The number of lookups answered from the cache.
+    misses (int): The number of lookups that ran the query.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, max_rows=QUERY_CACHE_MAX_ROWS):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(result):
+        return len(result) if isinstance(result, list) else 1
+
+    def _drop_stale(self, version):
+        # Entries of an older graph version can never be hit again
+        if version != self._version:
+            self._entries.clear()
+            self._rows = 0
+            self._version = version
+
+    def get(self, scope, name, params=None):
+        """
+        Looks up the result of a query at the current graph version.
+
+        Returns:
+            tuple: Whether the result was cached, and a copy of the cached result.
+        """
+        key = (scope, name, freeze(params or {}))
+        with self._lock:
+            self._drop_stale(get_graph_version())
+            if key not in self._entries:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            result = self._entries[key]
+        return True, list(result) if isinstance(result, list) else result
+
+    def put(self, scope, name, params, result, version):
+        """
+        Stores the result of a query, unless the graph changed since it was read.
+
+        Args:
+            scope (str): `SHARED` or the scope of a session.
+            name (str): The name of the query.
+            params (dict): The parameters of the query.
+            result: The result of the query.
+            version (int): The graph version read before running the query.
+        """
+        size = self._size(result)
+        if size > self.max_rows:
+            return
+        key = (scope, name, freeze(params or {}))
+        with self._lock:
+            self._drop_stale(get_graph_version())
+            if version != self._version:
+                # The graph was written while the query ran, its result may be stale already
+                return
+            if key in self._entries:
+                self._rows -= self._size(self._entries.pop(key))
+            self._entries[key] = list(result) if isinstance(result, list) else result
+            self._rows += size
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                _, evicted = self._entries.popitem(last=False)
+                self._rows -= self._size(evicted)
+
+    def get_or_load(self, scope, name, params, load):
+        """
+        Returns the cached result of a query, running `load` to read it on a miss.
+
+        Args:
+            scope (str): `SHARED`, the scope of a session, or None to bypass the cache.
+            name (str): The name of the query, or of the computation cached like a query.
+            params (dict): The parameters of the query.
+            load (callable): Runs the query and returns its result.
+
+        Returns:
+            The result of the query, as a new list when it is a list.
+        """
+        if scope is None:
+            return load()
+        cached, result = self.get(scope, name, params)
+        if cached:
+            return result
+        version = get_graph_version()
+        result = load()
+        self.put(scope, name, params, result, version)
+        return result
+
+    def clear(self, scope=None) -> None:
+        """Drops the results of a scope, or every result."""
+        with self._lock:
+            for key in [key for key in self._entries if scope is None or key[0] == scope]:
+                self._rows -= self._size(self._entries.pop(key))
+
+    def stats(self):
+        """Returns the number of hits, misses, cached results and rows, and the hit rate."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'rows': self._rows,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+query_cache = QueryResultCache()
@@ -1,10 +1,32 @@
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import streamlit as st
-from backend.functionality_util import run_query
-from langchain_config.config import llm
+from backend.functionality_util import gather_queries
+from backend.graph_snapshot import get_related_flashcards, get_related_flashcards_of
+from langchain_config.config import get_llm
 import logging
 
+# Maximum number of seconds a mistake waits for the LLM to generate its related questions
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', 180))
+# Number of LLM requests sent at the same time, shared by every session
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', 4))
+
+_llm_executor = None
+_llm_executor_lock = threading.Lock()
+
+
+def get_llm_executor():
+    """Returns the process-wide thread pool sending the LLM requests, created on first use."""
+    global _llm_executor
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            _llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix='llm-requests')
+    return _llm_executor
+
 def generate_flashcard_with_llm(flashcard, num_cards=1):
     """
     Generates a new flashcard or flashcards using a Large Language Model (LLM) based on the provided flashcard data.
@@ -37,7 +59,7 @@ def generate_flashcard_with_llm(flashcard, num_cards=1):
           answer: [Flashcard answer]
     """
 
-    response = llm.predict(prompt)
+    response = get_llm().predict(prompt)
     logging.warning(f"LLM Response {response}")
     try:
         results = json.loads(response)
@@ -53,7 +75,7 @@ def generate_flashcard_with_llm(flashcard, num_cards=1):
     return results
 
 
-def generate_related_questions(flashcard, num_cards=1):
+def generate_related_questions(flashcard, num_cards=1, related_nodes=None):
     """
     Generates related flashcards for a given flashcard.
 
@@ -66,17 +88,15 @@ def generate_related_questions(flashcard, num_cards=1):
         flashcard (dict): The flashcard to find related questions for.
         num_cards (int, optional): The number of related flashcards to generate.
                                    Defaults to 1.
+        related_nodes (list, optional): The related flashcards of the flashcard, when they were
+                                        already looked up.
 
     Returns:
         list: A list of related flashcards.
     """
-    # Query the knowledge graph to get related information (e.g., 3 relevant nodes)
-    related_query = f'''
-    MATCH (f:Flashcard)-[r]-(f2:Flashcard)
-    WHERE f.id = "{flashcard['id']}"
-    RETURN f2.id AS related_id, f2.question AS question, f2.answer AS answer, r.type AS relationship
-    '''
-    related_nodes = run_query(related_query)
+    # Look up related information (e.g., 3 relevant nodes) in the shared graph snapshot
+    if related_nodes is None:
+        related_nodes = get_related_flashcards(flashcard['id'])
     if related_nodes and len(related_nodes) > num_cards:
         logging.warning(related_nodes)
         return [flashcard for flashcard in related_nodes[:num_cards]]
@@ -106,12 +126,21 @@ def review_mistakes(st, num_cards=3):
     """
     flashcard_set = []
     if "mistake_card" in st.session_state and len(st.session_state["mistake_card"]) > 0:
-        for mistake in st.session_state["mistake_card"]:
-            # st.write(f"Question: {mistake['question']}")
-            # st.write(f"Your answer: {mistake['wrong_answer']}")
-            related_questions = generate_related_questions(mistake, num_cards)
-            # st.write("Here are three more questions to test your knowledge:")
-            flashcard_set.append({'mistake_card': mistake, 'flashcard': related_questions})
+        mistakes = list(st.session_state["mistake_card"])
+        # The related flashcards of every mistake are read together, then the mistakes without
+        # enough of them are completed by the LLM at the same time instead of one after the other
+        related_nodes = get_related_flashcards_of([mistake['id'] for mistake in mistakes])
+        # The LLM requests run in their own threads with their own timeout, and a failed request only
+        # leaves its own mistake without related questions
+        related_questions = gather_queries(*(partial(generate_related_questions, mistake, num_cards, related)
+                                             for mistake, related in zip(mistakes, related_nodes)),
+                                           timeout=LLM_TIMEOUT_SECONDS, executor=get_llm_executor(),
+                                           return_exceptions=True)
+        for mistake, questions in zip(mistakes, related_questions):
+            if isinstance(questions, Exception):
+                logging.warning(f"Generating the related questions of {mistake['id']} failed: {questions!r}")
+                questions = []
+            flashcard_set.append({'mistake_card': mistake, 'flashcard': questions})
     else:
         st.info("No mistakes recorded yet.")
     return flashcard_set
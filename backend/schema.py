@@ -0,0 +1,147 @@
+"""
+Schema of the graph database: constraints, indexes and the check that hot queries use them.
+
+`ensure_schema` runs at startup and before an ingest. Every statement is idempotent, so running it
+again is cheap. Without the constraints, every `MERGE` of the writer and every lookup such as
+`WHERE f.id = $id` is a scan of all the nodes of a label.
+
+After the schema is created, every query of `HOT_QUERIES` is planned with EXPLAIN, and its plan
+must contain an index operator. A query that falls back to a label scan is logged, or, in benchmark
+mode, raises so the regression cannot go unnoticed.
+"""
+import logging
+import os
+import threading
+
+from backend.graph_backend import get_graph_backend
+from backend.queries import QUERIES
+
+# Set to 'true' to raise when a hot query does not use an index
+BENCHMARK_MODE = os.getenv('BENCHMARK_MODE', 'false').lower() == 'true'
+
+SCHEMA_STATEMENTS = [
+    # The writer merges nodes on their id, the constraints also back every lookup by id
+    "CREATE CONSTRAINT flashcard_id IF NOT EXISTS FOR (f:Flashcard) REQUIRE f.id IS UNIQUE",
+    "CREATE CONSTRAINT metanode_id IF NOT EXISTS FOR (m:Metanode) REQUIRE m.id IS UNIQUE",
+    "CREATE INDEX metanode_name IF NOT EXISTS FOR (m:Metanode) ON (m.name)",
+    # Materialized properties
+    "CREATE INDEX flashcard_entropy IF NOT EXISTS FOR (f:Flashcard) ON (f.entropy)",
+    "CREATE INDEX flashcard_card_key IF NOT EXISTS FOR (f:Flashcard) ON (f.cardKey)",
+    # The flashcards holding the fingerprints of merged duplicates
+    "CREATE INDEX flashcard_merged_cards IF NOT EXISTS FOR (f:Flashcard) ON (f.mergedCards)",
+]
+
+# Queries run on every page or every ingest, with the parameters they are planned with
+HOT_QUERIES = {
+    'flashcards_by_id': {'ids': []},
+    'flashcard_hint': {'id': ''},
+    'related_flashcards': {'id': ''},
+    'metanode_names': {},
+    'stored_fingerprints': {},
+    'card_neighbours': {'keys': [], 'cards': []},
+    'set_flashcard_entropy': {'rows': []},
+}
+
+# Plan operators reading every node of a label, or of the whole graph
+SCAN_OPERATORS = ('AllNodesScan', 'NodeByLabelScan')
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+_warmup_thread = None
+# Guards `_warmup_thread` only, so a rerun never waits for `ensure_schema` to release `_schema_lock`
+_warmup_lock = threading.Lock()
+
+
+def plan_operators(plan):
+    """Lists the operator types of a query plan and of all its children."""
+    if not plan:
+        return []
+    operators = [plan.get('operatorType', '')]
+    for child in plan.get('children', []):
+        operators.extend(plan_operators(child))
+    return operators
+
+
+def check_hot_queries(strict=BENCHMARK_MODE):
+    """
+    Plans every hot query with EXPLAIN and checks that it uses an index.
+
+    Args:
+        strict (bool): Whether to raise when a hot query does not use an index.
+
+    Returns:
+        dict: Maps the name of every hot query without an index to the operators of its plan.
+
+    Raises:
+        RuntimeError: In strict mode, if a hot query does not use an index.
+    """
+    backend = get_graph_backend()
+    unindexed = {}
+    for name, params in HOT_QUERIES.items():
+        # Operator names carry a version suffix, such as NodeIndexSeek@neo4j
+        operators = [operator.split('@')[0] for operator in plan_operators(backend.explain(QUERIES[name], params))]
+        if not any('Index' in operator for operator in operators):
+            unindexed[name] = operators
+            logging.warning(f"Hot query {name} does not use an index, its plan is {' <- '.join(operators)}")
+        elif any(operator in SCAN_OPERATORS for operator in operators):
+            logging.warning(f"Hot query {name} uses an index but also scans a label, its plan is {' <- '.join(operators)}")
+    if unindexed and strict:
+        raise RuntimeError(f"Hot queries without an index: {', '.join(unindexed)}")
+    return unindexed
+
+
+def ensure_schema(force=False, strict=BENCHMARK_MODE):
+    """
+    Creates the constraints and indexes of the graph if they do not exist yet, then checks the hot queries.
+
+    Runs once per process unless forced. The embedded backend creates its tables and indexes when it
+    connects, so there is nothing to do for it.
+
+    Args:
+        force (bool): Whether to run the statements even if the schema was already ensured by this process.
+        strict (bool): Whether to raise when a hot query does not use an index.
+    """
+    global _schema_ready
+    backend = get_graph_backend()
+    if not backend.supports_cypher:
+        return
+    with _schema_lock:
+        if _schema_ready and not force:
+            return
+        for statement in SCHEMA_STATEMENTS:
+            try:
+                backend.query(statement)
+            except Exception as e:
+                # A constraint cannot be created while the graph holds duplicates, the app still works without it
+                logging.error(f"Could not run {statement}: {e}")
+                if strict:
+                    raise
+        check_hot_queries(strict=strict)
+        _schema_ready = True
+
+
+def _warmup():
+    try:
+        backend = get_graph_backend()
+        backend.warmup()
+        ensure_schema()
+    except Exception as e:
+        logging.error(f"Warming up the graph backend failed: {e}")
+
+
+def start_background_warmup():
+    """
+    Connects to the graph and ensures the schema in a background thread, once per process.
+
+    The app can render its first page while the connection handshake and the schema statements
+    run, instead of blocking on the database latency at startup.
+
+    Returns:
+        threading.Thread: The warmup thread.
+    """
+    global _warmup_thread
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=_warmup, name='graph-warmup', daemon=True)
+            _warmup_thread.start()
+        return _warmup_thread
@@ -0,0 +1,82 @@
+"""
+Vectorized similarity helpers over flashcard embeddings.
+"""
+import numpy as np
+
+
+def normalize_rows(embeddings) -> np.ndarray:
+    """
+    Converts embeddings to a float32 matrix whose rows have unit length.
+
+    Args:
+        embeddings (list or np.ndarray): One embedding per row.
+
+    Returns:
+        np.ndarray: The normalized matrix, rows of zeros are left as zeros.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_neighbours(embeddings, k=5, block_size=1024):
+    """
+    Finds the k most cosine-similar rows of every row, excluding the row itself.
+
+    The similarity matrix is computed one block of rows at a time with a matrix product, so memory
+    stays at `block_size * n` floats instead of `n * n`.
+
+    Args:
+        embeddings (list or np.ndarray): One embedding per row.
+        k (int): The number of neighbours per row.
+        block_size (int): The number of rows whose similarities are computed at once.
+
+    Returns:
+        tuple: The neighbour indices and their cosine similarities, two arrays of shape
+            `(n, min(k, n - 1))` sorted by decreasing similarity.
+    """
+    matrix = normalize_rows(embeddings)
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.empty((n, 0), dtype=np.int64), np.empty((n, 0), dtype=np.float32)
+
+    indices = np.empty((n, k), dtype=np.int64)
+    scores = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        similarities = matrix[start:end] @ matrix.T
+        # A row is never its own neighbour
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        indices[start:end] = np.take_along_axis(top, order, axis=1)
+        scores[start:end] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, scores
+
+
+def similar_pairs(embeddings, k=5, threshold=0.9, block_size=1024):
+    """
+    Lists the pairs of rows where one row is among the k nearest neighbours of the other, above a similarity threshold.
+
+    Args:
+        embeddings (list or np.ndarray): One embedding per row.
+        k (int): The number of neighbours considered per row.
+        threshold (float): The minimum cosine similarity of a pair.
+        block_size (int): The number of rows whose similarities are computed at once.
+
+    Returns:
+        list: `(i, j, similarity)` tuples with `i < j`, each pair listed once.
+    """
+    indices, scores = top_k_neighbours(embeddings, k=k, block_size=block_size)
+    rows, columns = np.nonzero(scores >= threshold)
+    pairs = {}
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        neighbour = int(indices[row, column])
+        pair = (min(row, neighbour), max(row, neighbour))
+        pairs[pair] = float(scores[row, column])
+    return [(i, j, similarity) for (i, j), similarity in sorted(pairs.items())]
@@ -0,0 +1,156 @@
+"""
+In-process approximate nearest neighbour index over the Flashcard embeddings.
+
+The index is an IVF-flat index: the normalized embeddings are clustered with k-means, every
+embedding is stored in the list of its nearest centroid, and a query only scores the embeddings of
+the `n_probe` lists whose centroids are closest to it. It is built from the graph once per graph
+snapshot and shared by every session, so an interest query costs a matrix product over a few lists
+instead of a database round trip with a cosine similarity against every flashcard.
+"""
+import logging
+import threading
+
+import numpy as np
+
+from backend.graph_snapshot import get_graph_snapshot
+from backend.similarity_util import normalize_rows
+
+# Number of k-means iterations used to train the centroids
+KMEANS_ITERATIONS = 10
+# Number of lists scored per query
+DEFAULT_N_PROBE = 8
+
+
+class IVFFlatIndex:
+    """
+    An IVF-flat cosine similarity index over float32 vectors.
+
+    Attributes:
+    ids (list): The id of every vector.
+    metadata (list): A dictionary of extra columns returned with every result.
+    n_probe (int): The number of lists scored per query.
+    """
+
+    def __init__(self, ids, vectors, metadata=None, n_lists=None, n_probe=DEFAULT_N_PROBE, seed=0, normalized=False):
+        self.ids = list(ids)
+        self.metadata = list(metadata) if metadata is not None else [{} for _ in self.ids]
+        if not self.ids:
+            self._vectors = np.empty((0, 0), dtype=np.float32)
+        else:
+            # Vectors that already have unit length are indexed without a copy
+            self._vectors = np.asarray(vectors, dtype=np.float32) if normalized else normalize_rows(vectors)
+        n = len(self.ids)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        self.n_probe = n_probe
+        self._centroids, assignment = self._train(min(n_lists, max(n, 1)), seed)
+        self._lists = [np.flatnonzero(assignment == list_id) for list_id in range(len(self._centroids))]
+        self._id_positions = {node_id: position for position, node_id in enumerate(self.ids)}
+
+    def _train(self, n_lists, seed):
+        n = len(self.ids)
+        if n == 0:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        centroids = self._vectors[rng.choice(n, size=n_lists, replace=False)]
+        assignment = np.zeros(n, dtype=np.int64)
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(self._vectors @ centroids.T, axis=1)
+            for list_id in range(n_lists):
+                members = self._vectors[assignment == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+        assignment = np.argmax(self._vectors @ centroids.T, axis=1)
+        return centroids, assignment
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k=10, exclude=(), mask=None):
+        """
+        Finds the vectors most similar to a query.
+
+        Args:
+            query (list or np.ndarray): The query embedding.
+            k (int): The number of results.
+            exclude (iterable): Ids that must not be returned, such as the visited flashcards.
+            mask (np.ndarray, optional): A boolean array over the indexed vectors, only the positions
+                set to True may be returned. Cheaper than `exclude` when many ids are excluded.
+
+        Returns:
+            list: `(id, similarity, metadata)` tuples sorted by decreasing similarity.
+        """
+        if not self.ids or k <= 0:
+            return []
+        query = normalize_rows(query)[0]
+        excluded = {self._id_positions[node_id] for node_id in exclude if node_id in self._id_positions}
+        list_order = np.argsort(-(self._centroids @ query))
+        n_probe = self.n_probe
+        while True:
+            candidates = np.concatenate([self._lists[list_id] for list_id in list_order[:n_probe]])
+            if excluded:
+                candidates = candidates[~np.isin(candidates, list(excluded))]
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            # Probe more lists when the nearest ones do not hold enough unexcluded vectors
+            if len(candidates) >= k or n_probe >= len(list_order):
+                break
+            n_probe *= 2
+        if len(candidates) == 0:
+            return []
+        scores = self._vectors[candidates] @ query
+        top = np.argsort(-scores)[:k]
+        return [(self.ids[candidates[i]], float(scores[i]), self.metadata[candidates[i]]) for i in top]
+
+
+# (graph snapshot, index over its embeddings)
+_index = (None, None)
+_index_lock = threading.Lock()
+
+
+def get_flashcard_index():
+    """
+    Returns the process-wide index over the Flashcard embeddings of the shared graph snapshot.
+
+    The index is built from the embeddings the snapshot already holds, with the snapshot position of
+    every flashcard as its id, so a new graph version costs no database read. Only one thread builds
+    the index of a new snapshot. While it does, the other threads keep getting the previous index,
+    except before the first index is built.
+
+    Returns:
+        tuple: The GraphSnapshot the index was built from, and the IVFFlatIndex.
+    """
+    global _index
+    snapshot = get_graph_snapshot()
+    indexed, index = _index
+    if indexed is snapshot:
+        return indexed, index
+    if not _index_lock.acquire(blocking=index is None):
+        return indexed, index
+    try:
+        if _index[0] is not snapshot:
+            _index = (snapshot, IVFFlatIndex(snapshot.embedding_positions.tolist(), snapshot.embeddings,
+                                             normalized=True))
+            logging.warning(f"Built the flashcard vector index over {len(_index[1])} flashcards "
+                            f"for graph version {snapshot.version}")
+        return _index
+    finally:
+        _index_lock.release()
+
+
+def search_flashcards(query, k=10, exclude=()):
+    """
+    Finds the flashcards whose embeddings are the most similar to a query.
+
+    Args:
+        query (list or np.ndarray): The query embedding.
+        k (int): The number of flashcards.
+        exclude (iterable): Ids of flashcards that must not be returned, such as the visited ones.
+
+    Returns:
+        list: The 'question', 'answer' and 'id' of every flashcard found, most similar first.
+    """
+    snapshot, index = get_flashcard_index()
+    excluded = [snapshot.positions[node_id] for node_id in exclude if node_id in snapshot.positions]
+    return [{'question': snapshot.question[position], 'answer': snapshot.answer[position], 'id': snapshot.ids[position]}
+            for position, _, _ in index.search(query, k=k, exclude=excluded)]
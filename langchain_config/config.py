@@ -1,16 +1,34 @@
 import os
-from langchain_openai import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
+from functools import lru_cache
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Set up OpenAI key
-os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+if os.getenv("OPENAI_API_KEY"):
+    os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+
+
+# The langchain and OpenAI clients take seconds to import, they are only loaded when first used
+@lru_cache(maxsize=None)
+def get_llm():
+    """Returns the process-wide chat model, created on first use."""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model="gpt-3.5-turbo-16k", temperature=0)
+
 
-# Initialize LLM
-llm = ChatOpenAI(model="gpt-3.5-turbo-16k", temperature=0)
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    """Returns the process-wide OpenAI embeddings, created on first use."""
+    from langchain.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings(model="text-embedding-ada-002")
 
 
-# Initialize the OpenAI embeddings
-embedding_model = OpenAIEmbeddings(model="text-embedding-ada-002")
+def __getattr__(name):
+    # `from langchain_config.config import llm` keeps working, the client is created when it is first imported
+    if name == 'llm':
+        return get_llm()
+    if name == 'embedding_model':
+        return get_embedding_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,10 @@
+import asyncio
+import logging
 import os
+import threading
+import time
 
-from neo4j import GraphDatabase
-from langchain.graphs import Neo4jGraph
+from neo4j import AsyncGraphDatabase, GraphDatabase
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,16 +12,134 @@ load_dotenv()
 url = os.getenv('NEO4J_URL') # neo4j+s://2794d51e.databases.neo4j.io
 username = os.getenv('NEO4J_USERNAME')
 password = os.getenv('NEO4J_PASSWORD')
+database = os.getenv('NEO4J_DATABASE', 'neo4j')
+# Maximum number of connections the process keeps open to the database
+NEO4J_MAX_POOL_SIZE = int(os.getenv('NEO4J_MAX_POOL_SIZE', 50))
+# Pooled connections idle for longer than this many seconds are checked before they are reused
+NEO4J_LIVENESS_CHECK_SECONDS = float(os.getenv('NEO4J_LIVENESS_CHECK_SECONDS', 30))
+# Number of pooled connections opened by the warmup
+NEO4J_WARMUP_CONNECTIONS = int(os.getenv('NEO4J_WARMUP_CONNECTIONS', 2))
+
+
+class Neo4jClient:
+    """
+    A pooled Neo4j client with the `query` interface of langchain's Neo4jGraph.
+
+    Creating the client does not contact the database, unlike Neo4jGraph, which verifies the
+    connection and fetches the schema in its constructor. The connection is opened by `warmup`, or
+    by the first query, and the schema is only fetched when `refresh_schema` is called.
+
+    `query_async` runs on a second, asynchronous driver with the same pool settings. It is created by
+    the first asynchronous query and bound to the event loop that query runs on.
+
+    Attributes:
+    schema (str): The node and relationship properties, as text, once `refresh_schema` was called.
+    structured_schema (dict): The 'node_props' and 'rel_props' of the graph, once `refresh_schema` was called.
+    """
+
+    def __init__(self, url, username, password, database='neo4j', max_pool_size=NEO4J_MAX_POOL_SIZE,
+                 liveness_check_seconds=NEO4J_LIVENESS_CHECK_SECONDS):
+        self._driver_settings = {
+            'auth': (username, password),
+            'max_connection_pool_size': max_pool_size,
+            'liveness_check_timeout': liveness_check_seconds,
+        }
+        self._url = url
+        self._driver = GraphDatabase.driver(url, **self._driver_settings)
+        self._database = database
+        self._async_driver = None
+        self._async_loop = None
+        self.schema = ''
+        self.structured_schema = {}
+
+    def query(self, query, params=None):
+        """Runs a Cypher statement and returns its records as dictionaries."""
+        with self._driver.session(database=self._database) as session:
+            return [record.data() for record in session.run(query, params or {})]
+
+    async def query_async(self, query, params=None):
+        """Runs a Cypher statement on the asynchronous driver and returns its records as dictionaries."""
+        loop = asyncio.get_running_loop()
+        if self._async_driver is None or self._async_loop is not loop:
+            # An asynchronous driver cannot be shared between event loops
+            self._async_driver = AsyncGraphDatabase.driver(self._url, **self._driver_settings)
+            self._async_loop = loop
+        async with self._async_driver.session(database=self._database) as session:
+            result = await session.run(query, params or {})
+            return await result.data()
+
+    def warmup(self, connections=NEO4J_WARMUP_CONNECTIONS) -> None:
+        """Verifies the connection and opens pooled connections, so the first page does not pay for the handshake."""
+        start = time.perf_counter()
+        self._driver.verify_connectivity()
+        sessions = [self._driver.session(database=self._database) for _ in range(max(1, connections))]
+        try:
+            for session in sessions:
+                session.run("RETURN 1").consume()
+        finally:
+            for session in sessions:
+                session.close()
+        logging.warning(f"Warmed up {len(sessions)} Neo4j connections in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def is_alive(self) -> bool:
+        """Returns whether the database can be reached."""
+        try:
+            self._driver.verify_connectivity()
+            return True
+        except Exception as e:
+            logging.warning(f"Neo4j is not reachable: {e}")
+            return False
+
+    def refresh_schema(self) -> str:
+        """Fetches the properties of every node label and relationship type of the graph."""
+        node_props = {
+            ':'.join(row['labels']): row['properties'] for row in self.query("""
+            CALL db.schema.nodeTypeProperties() YIELD nodeLabels, propertyName
+            RETURN nodeLabels AS labels, [name IN collect(propertyName) WHERE name IS NOT NULL] AS properties
+            """)
+        }
+        rel_props = {
+            row['type']: row['properties'] for row in self.query("""
+            CALL db.schema.relTypeProperties() YIELD relType, propertyName
+            RETURN relType AS type, [name IN collect(propertyName) WHERE name IS NOT NULL] AS properties
+            """)
+        }
+        self.structured_schema = {'node_props': node_props, 'rel_props': rel_props}
+        self.schema = "\n".join(
+            ["Node properties:"] + [f"{label} {properties}" for label, properties in node_props.items()]
+            + ["Relationship properties:"] + [f"{rel_type} {properties}" for rel_type, properties in rel_props.items()]
+        )
+        return self.schema
+
+    def close(self) -> None:
+        self._driver.close()
+        if self._async_driver is not None and self._async_loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._async_driver.close(), self._async_loop).result()
+        self._async_driver = None
 
 
 # Setup Neo4j connection
 def get_graph_driver(url, username, password):
-    graph = Neo4jGraph(
-    url=url,
-    username=username,
-    password=password
-)
+    graph = Neo4jClient(url=url, username=username, password=password, database=database)
     return graph
 
-# Get Neo4j driver
-graph = get_graph_driver(url, username, password)
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """Returns the process-wide Neo4j client, created on first use without contacting the database."""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = get_graph_driver(url, username, password)
+    return _graph
+
+
+def __getattr__(name):
+    # `from neo4j_config.config import graph` keeps working, the client is created when it is first imported
+    if name == 'graph':
+        return get_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")